@@ -1,157 +1,274 @@
-from src.database import get_connection
-from datetime import datetime, timedelta
-from config import POLL_INTERVAL
-from src.analysis.similarity import calculate_window_similarity, extract_top_keywords
+from database import get_connection, to_epoch
+from datetime import datetime, timezone
+from config import POLL_INTERVAL, ALERT_THRESHOLDS, ANN_ENABLED
+from analysis.similarity import calculate_window_similarity, extract_top_keywords
+from instrumentation import instrument, increment
 
-def detect_abnormal_patterns(z, metrics, video_id):
+def classify_alerts(z, metrics, thresholds=ALERT_THRESHOLDS):
     """
-    Uses Z-scores and raw metrics to identify specific types of
-    coordinated or robotic behavior.
+    Returns the list of behavioral alerts triggered by a window's Z-scores
+    (empty if none). Pure and cheap: no database access and no models.
+    analysis.vectorized.alert_flags is the array version of these rules.
     """
     if not z or not metrics:
-        return
-
-    total = metrics.get("total_comments", 0)
-    window_time = metrics.get("window", "Unknown Time")
+        return []
+    t = thresholds
 
     # 1. VOLUME GUARD
     # We ignore windows with very few comments because Z-scores
     # fluctuate too wildly on tiny samples.
-    if total < 5:
-        return
+    if metrics.get("total_comments", 0) < t["min_comments"]:
+        return []
 
     alerts = []
 
     # 2. PATTERN: THE "METRONOME" (Robotic Timing)
     # If gap_var_z is a deep negative (e.g., -2.0), it means the
     # timing has become unnaturally consistent compared to history.
-    if z.get("gap_var_z", 0) < -1.5:
+    if z.get("gap_var_z", 0) < t["gap_var_z"]:
         alerts.append("Automated Timing: Inter-comment gaps show unnatural statistical consistency.")
 
     # 3. PATTERN: THE "SCRIPTED NARRATIVE" (Coordinated Opinion)
     # High sentiment shift + Low sentiment diversity
-    if abs(z["sentiment_z"]) > 2.0 and z["sentiment_var_z"] < -1.0:
+    if abs(z["sentiment_z"]) > t["sentiment_z"] and z["sentiment_var_z"] < t["sentiment_var_z"]:
         alerts.append("Coordinated Sentiment: A sudden, uniform shift in tone with unusually low variance.")
 
     # 4. PATTERN: THE "BOT FLOOD" (Volume vs. People)
     # High comment count spike + Low unique author spike
-    if z["count_z"] > 2.0 and z["author_z"] < 1.0:
+    if z["count_z"] > t["count_z"] and z["author_z"] < t["author_z"]:
         alerts.append("Volume Anomaly: A massive comment spike generated by a disproportionately small number of authors.")
 
     # 5. PATTERN: THE "RAPID REPETITION" (Spamming)
-    if z["concentration_z"] > 2.5:
+    if z["concentration_z"] > t["concentration_z"]:
         alerts.append("High-Frequency Spam: Individual accounts are posting multiple times within this window.")
 
-    # OUTPUT SECTION
-    if alerts:
-        print(f"\n[ALERT - {video_id}] @ {window_time}")
-
-        # --- THE PROPAGANDA CHECK ---
-        # Fetch the raw texts for this anomalous window
-        window_data = get_comments_for_context(video_id, window_time, limit=50)
-        raw_texts = [row[2] for row in window_data]  # Extract just the text column
-
-        sim_score = calculate_window_similarity(raw_texts)
-
-        # If the comments are more than 40% linguistically identical, that is highly unnatural
-        if sim_score > 0.40:
-            keywords = extract_top_keywords(raw_texts, top_n=3)
-            print(f"Templated Text: Comments share {sim_score * 100:.1f}% linguistic similarity!")
-            if keywords:
-                print(f"Narrative Keywords: {', '.join(keywords)}")
-        # -----------------------------
-
-        # 1. Print the HIGH-LEVEL categories triggered
-        for a in alerts:
-            print(f"  {a}")
-
-        # 2. Print TARGETED evidence based on the highest Z-score
-        # If the biggest weirdness is concentration (spam), show the spammers
-        if z.get("concentration_z", 0) > 2.5:
-            print(f"\n  --- Activity Breakdown: Top Repeat Commenters ---")
-            # Inside the alert loop
-            spammers = get_spammer_context(video_id, window_time)
-            for auth, count, concat_text in spammers:
-                print(f"    User {auth[:8]} (Count: {count})")
-
-                # Split the concatenated string back into individual comment samples
-                individual_samples = concat_text.split('\x1e')
-                for i, sample in enumerate(individual_samples[:3]):  # Show first 3
-                    print(f"      - {sample[:70]}...")
-
-
-        # Otherwise, show the chronological timeline for timing/narrative alerts
-        else:
-            print(f"\n  --- Forensic Evidence: Window Timeline ---")
-            samples = get_comments_for_context(video_id, window_time)
-            for ts, auth, txt in samples:
-                print(f"    [{ts}] {auth[:8]}: {txt[:80]}...")
-
-        # 3. Print the RAW MATH for the technical screener
-        print(f"\n  --- Technical Metrics ---")
-        print(f"  Coordination Score: {metrics.get('coordination_score', 0):.2f}")
-        print(
-            f"  Z-Scores -> Count: {z['count_z']:.1f} | Gap_Var: {z['gap_var_z']:.1f} | Conc: {z['concentration_z']:.1f}")
-
-
-def get_comments_for_context(video_id, window_start, polling_rate=POLL_INTERVAL, limit=10):
-    """Fetches the first few comments from a window to show in the alert."""
-
-    start_dt = datetime.fromisoformat(window_start.replace("Z", "+00:00"))
-    end_dt = start_dt + timedelta(seconds=polling_rate)
-    window_end = end_dt.isoformat()
-
-    conn = get_connection()
-    cur = conn.cursor()
+    # 6. PATTERN: THE "COPY-PASTE CAMPAIGN" (Templated Text)
+    # Near-duplicates of comments seen anywhere before (any window, any video),
+    # straight from the MinHash index: no embedding model involved
+    duplicates = metrics.get("duplicate_comments", 0)
+    if duplicates >= t["min_duplicates"] and duplicates / max(metrics["total_comments"], 1) >= t["duplicate_ratio"]:
+        alerts.append(f"Templated Campaign: {duplicates} comments are near-copies of earlier text "
+                      f"({metrics.get('duplicate_clusters', 0)} distinct templates).")
 
-    # We want the exact time and author to spot 'bursts'
-    try:
-        cur.execute("""
-            SELECT published_at, author_id, text
-            FROM comments 
-            WHERE video_id = ? AND published_at BETWEEN ? AND ?
-            ORDER BY published_at ASC
-            LIMIT ?
-        """, (video_id, window_start, window_end, limit))
-        return cur.fetchall()
-    finally:
-        conn.close()
+    return alerts
 
 
+def detect_abnormal_patterns(z, metrics, video_id, evidence=None):
+    """
+    Uses Z-scores and raw metrics to identify specific types of
+    coordinated or robotic behavior.
 
-def get_spammer_context(video_id, window_start, polling_rate=600, limit=5):
+    `evidence` is this window's entry from collect_evidence_batch(); when
+    omitted it is fetched here, with a single query.
     """
-    Finds authors who posted multiple times WITHIN the specific 10-minute window.
+    alerts = classify_alerts(z, metrics)
+    if not alerts:
+        return
+    increment("alerts")
+
+    window_time = metrics.get("window", "Unknown Time")
+    if evidence is None:
+        evidence = collect_evidence(video_id, window_time)
+
+    # OUTPUT SECTION
+    print(f"\n[ALERT - {video_id}] @ {window_time}")
+
+    # --- THE PROPAGANDA CHECK ---
+    # The raw texts for this anomalous window
+    window_data = evidence["context"]
+    raw_texts = [row[2] for row in window_data]  # Extract just the text column
+
+    # Vectors stored at ingest: a dot product instead of a model forward pass
+    sim_score = calculate_window_similarity(raw_texts, comment_ids=[row[3] for row in window_data])
+
+    # If the comments are more than 40% linguistically identical, that is highly unnatural
+    if sim_score > 0.40:
+        keywords = extract_top_keywords(raw_texts, top_n=3)
+        print(f"Templated Text: Comments share {sim_score * 100:.1f}% linguistic similarity!")
+        if keywords:
+            print(f"Narrative Keywords: {', '.join(keywords)}")
+
+    # Has this narrative been pushed before, in an earlier window or another video?
+    if ANN_ENABLED:
+        report_narrative_history(window_data, window_time)
+    # -----------------------------
+
+    # 1. Print the HIGH-LEVEL categories triggered
+    for a in alerts:
+        print(f"  {a}")
+
+    # 2. Print TARGETED evidence based on the highest Z-score
+    # If the biggest weirdness is concentration (spam), show the spammers
+    if z.get("concentration_z", 0) > ALERT_THRESHOLDS["concentration_z"]:
+        print(f"\n  --- Activity Breakdown: Top Repeat Commenters ---")
+        for auth, count, individual_samples in evidence["spammers"]:
+            print(f"    User {auth[:8]} (Count: {count})")
+
+            for i, sample in enumerate(individual_samples[:3]):  # Show first 3
+                print(f"      - {sample[:70]}...")
+
+
+    # Otherwise, show the chronological timeline for timing/narrative alerts
+    else:
+        print(f"\n  --- Forensic Evidence: Window Timeline ---")
+        for ts, auth, txt in evidence["timeline"]:
+            print(f"    [{ts}] {auth[:8]}: {txt[:80]}...")
+
+    # 3. Print the RAW MATH for the technical screener
+    print(f"\n  --- Technical Metrics ---")
+    print(f"  Coordination Score: {metrics.get('coordination_score', 0):.2f}")
+    print(
+        f"  Z-Scores -> Count: {z['count_z']:.1f} | Gap_Var: {z['gap_var_z']:.1f} | Conc: {z['concentration_z']:.1f}")
+
+
+@instrument("alert_evidence")
+def collect_evidence_batch(windows, polling_rate=POLL_INTERVAL, context_limit=50, timeline_limit=10,
+                           spammer_limit=5, samples_per_spammer=3):
     """
-    # Calculate the exact end of the 10-minute block
-    start_dt = datetime.fromisoformat(window_start.replace("Z", "+00:00"))
-    end_dt = start_dt + timedelta(seconds=polling_rate)
-    window_end = end_dt.isoformat()
+    Alert evidence for many windows (metrics dicts with "video_id" and
+    "window"), two queries per 500 windows. Row counts are bounded in SQL,
+    so a flood of thousands of comments per window costs no more memory
+    than a quiet one.
+
+    Returns {(video_id, window_ts): evidence}, where evidence holds
+    "context" (first `context_limit` rows as (published_at, author_id,
+    text, comment_id)), "timeline" (first `timeline_limit` rows without
+    the ID) and "spammers" ([(author_id, count, sample texts)], busiest first).
+    """
+    keys = sorted({(w["video_id"], to_epoch(w["window"])) for w in windows})
+    evidence = {key: {"context": [], "timeline": [], "spammers": []} for key in keys}
+    first_rows = max(context_limit, timeline_limit)
+
+    cur = get_connection().cursor()
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        values = ",".join(["(?, ?)"] * len(chunk))
+        params = [v for key in chunk for v in key]
+
+        # 1. The first rows of each window, for similarity and the timeline
+        cur.execute(f"""
+            WITH w(video_id, start) AS (VALUES {values})
+            SELECT video_id, start, published_at, author_id, text, comment_id
+            FROM (
+                SELECT w.video_id, w.start, c.comment_id, c.author_id, c.text,
+                       strftime('%Y-%m-%dT%H:%M:%SZ', c.published_ts, 'unixepoch') AS published_at,
+                       ROW_NUMBER() OVER (PARTITION BY w.video_id, w.start ORDER BY c.published_ts) AS n
+                FROM w
+                JOIN comments c ON c.video_id = w.video_id AND c.published_ts BETWEEN w.start AND w.start + ?
+            )
+            WHERE n <= ?
+            ORDER BY video_id, start, n
+        """, params + [polling_rate, first_rows])
+        for vid, start, published_at, author, text, comment_id in cur.fetchall():
+            e = evidence[(vid, start)]
+            if len(e["context"]) < context_limit:
+                e["context"].append((published_at, author, text, comment_id))
+            if len(e["timeline"]) < timeline_limit:
+                e["timeline"].append((published_at, author, text))
+
+        # 2. Repeat commenters: counted with GROUP BY, only a few texts each
+        cur.execute(f"""
+            WITH w(video_id, start) AS (VALUES {values}),
+            top AS (
+                SELECT * FROM (
+                    SELECT w.video_id, w.start, c.author_id, COUNT(*) AS comments,
+                           ROW_NUMBER() OVER (PARTITION BY w.video_id, w.start
+                                              ORDER BY COUNT(*) DESC, MIN(c.published_ts)) AS rank
+                    FROM w
+                    JOIN comments c ON c.video_id = w.video_id AND c.published_ts BETWEEN w.start AND w.start + ?
+                    WHERE c.author_id IS NOT NULL AND c.author_id != ''
+                    GROUP BY w.video_id, w.start, c.author_id
+                    HAVING COUNT(*) > 1
+                )
+                WHERE rank <= ?
+            )
+            SELECT video_id, start, author_id, comments, text
+            FROM (
+                SELECT top.video_id, top.start, top.author_id, top.comments, top.rank, c.text,
+                       ROW_NUMBER() OVER (PARTITION BY top.video_id, top.start, top.author_id
+                                          ORDER BY c.published_ts) AS n
+                FROM top
+                JOIN comments c ON c.video_id = top.video_id AND c.author_id = top.author_id
+                               AND c.published_ts BETWEEN top.start AND top.start + ?
+            )
+            WHERE n <= ?
+            ORDER BY video_id, start, rank, n
+        """, params + [polling_rate, spammer_limit, polling_rate, samples_per_spammer])
+        for vid, start, author, count, text in cur.fetchall():
+            spammers = evidence[(vid, start)]["spammers"]
+            if not spammers or spammers[-1][0] != author:
+                spammers.append((author, count, []))
+            spammers[-1][2].append(text)
+
+    return evidence
+
+
+@instrument("alert_evidence")
+def collect_evidence(video_id, window_start, polling_rate=POLL_INTERVAL):
+    """Evidence for a single window (see collect_evidence_batch)."""
+    batch = collect_evidence_batch([{"video_id": video_id, "window": window_start}], polling_rate)
+    return next(iter(batch.values()))
+
+
+def report_narrative_history(window_data, window_time):
+    """Prints past comments (any video) that the ANN index finds close to this window's."""
+    from analysis.ann import find_similar_history
+
+    history = find_similar_history([row[3] for row in window_data], [row[2] for row in window_data],
+                                   before_ts=to_epoch(window_time))
+    if not history["matches"]:
+        return
 
-    conn = get_connection()
-    cur = conn.cursor()
+    print(f"Recurring Narrative: {sum(history['windows'].values())} earlier comments match this window "
+          f"across {len(history['windows'])} windows and {len(history['videos'])} videos")
+    for m in history["matches"][:3]:
+        seen = datetime.fromtimestamp(m["window"], timezone.utc).strftime('%Y-%m-%d %H:%M')
+        print(f"    [{m['video_id']} @ {seen}] ({m['score']:.2f}) {m['text'][:70]}...")
 
-    # Logic Change: Use BETWEEN to lock the evidence to that specific window
-    try:
-        cur.execute("""
-                SELECT author_id, COUNT(*) as comment_count, GROUP_CONCAT(text, x'1e')
-                FROM comments
-                WHERE video_id = ?
-                  AND published_at BETWEEN ? AND ?
-                GROUP BY author_id
-                HAVING comment_count > 1
-                ORDER BY comment_count DESC
-                LIMIT ?
-                """, (video_id, window_start, window_end, limit))
-        return cur.fetchall()
 
-    finally:
-        conn.close()
+def get_comments_for_context(video_id, window_start, polling_rate=POLL_INTERVAL, limit=10, with_ids=False):
+    """
+    Fetches the first few comments from a window to show in the alert.
+    Rows are (published_at, author_id, text), plus comment_id if with_ids.
+    """
 
+    start_ts = to_epoch(window_start)
+    end_ts = start_ts + polling_rate
 
+    cur = get_connection().cursor()
 
+    # We want the exact time and author to spot 'bursts'
+    id_column = ", comment_id" if with_ids else ""
+    cur.execute(f"""
+        SELECT strftime('%Y-%m-%dT%H:%M:%SZ', published_ts, 'unixepoch'), author_id, text{id_column}
+        FROM comments 
+        WHERE video_id = ? AND published_ts BETWEEN ? AND ?
+        ORDER BY published_ts ASC
+        LIMIT ?
+    """, (video_id, start_ts, end_ts, limit))
+    return cur.fetchall()
 
 
 
+def get_spammer_context(video_id, window_start, polling_rate=600, limit=5):
+    """
+    Finds authors who posted multiple times WITHIN the specific 10-minute window.
+    """
+    # Calculate the exact end of the 10-minute block
+    start_ts = to_epoch(window_start)
+    end_ts = start_ts + polling_rate
 
+    cur = get_connection().cursor()
 
+    # Logic Change: Use BETWEEN to lock the evidence to that specific window
+    cur.execute("""
+            SELECT author_id, COUNT(*) as comment_count, GROUP_CONCAT(text, x'1e')
+            FROM comments
+            WHERE video_id = ?
+              AND published_ts BETWEEN ? AND ?
+            GROUP BY author_id
+            HAVING comment_count > 1
+            ORDER BY comment_count DESC
+            LIMIT ?
+            """, (video_id, start_ts, end_ts, limit))
+    return cur.fetchall()
@@ -0,0 +1,345 @@
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+import numpy as np
+import database
+from database import iter_embeddings, count_embeddings, get_comments_by_seq, get_embedding_seqs
+from config import (ANN_LISTS, ANN_NPROBE, ANN_TRAIN_SAMPLE, ANN_TRAIN_ITERATIONS, ANN_DELTA_ROWS,
+                    ANN_REBUILD_FACTOR, ANN_TOP_K, ANN_MATCH_THRESHOLD, POLL_INTERVAL)
+from analysis.embeddings import EMBEDDING_DTYPE, load_embeddings
+from instrumentation import instrument
+
+# Rows scored per matrix multiply while assigning or brute-forcing
+CHUNK_ROWS = 65536
+# What rows.npy / delta_rows.bin hold; older indexes (comments.rowid) are rebuilt
+INDEX_KEY = "embedding_seq"
+
+
+def _normalize(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.where(norms == 0, 1, norms)
+
+
+def train_centroids(sample, lists, iterations=ANN_TRAIN_ITERATIONS, seed=0):
+    """Spherical k-means: unit-length centroids maximizing cosine similarity to their members."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        sums = np.zeros_like(centroids)
+        occupied = counts > 0
+        sums[occupied] = np.add.reduceat(sample[order], starts[occupied], axis=0)
+        # Empty lists are reseeded from random points so none go to waste
+        empty = np.flatnonzero(~occupied)
+        sums[empty] = sample[rng.choice(len(sample), len(empty))]
+        centroids = _normalize(sums)
+
+    return centroids
+
+
+def _assign(vectors, centroids):
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), CHUNK_ROWS):
+        chunk = np.asarray(vectors[start:start + CHUNK_ROWS], dtype=np.float32)
+        labels[start:start + CHUNK_ROWS] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+class IVFIndex:
+    def __init__(self, path):
+        """
+        Inverted-file (IVF) index over the stored comment embeddings, kept
+        on disk under `path` as NumPy files:
+
+            centroids.npy   (lists x dim) unit centroids from spherical k-means
+            offsets.npy     where each list starts in the main segment
+            vectors.npy     float16 vectors sorted by list, memory-mapped
+            rows.npy        embedding_seq.seq of each vector
+            delta_*.bin     vectors added since the last rebuild (append-only)
+
+        A search scores the query against the centroids, then only the
+        ANN_NPROBE closest lists of the main segment plus the small delta
+        segment, so its cost depends on list size, not corpus size.
+        sync() appends new embeddings to the delta; rebuild() retrains the
+        centroids and folds the delta into a fresh main segment.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._building = threading.Lock()
+        self.meta = {"dim": 0, "main": 0, "watermark": 0, "key": INDEX_KEY}
+        self.centroids = self.offsets = self.vectors = self.rows = None
+        self.delta_vectors = np.empty((0, 0), dtype=EMBEDDING_DTYPE)
+        self.delta_rows = np.empty(0, dtype=np.int64)
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        if not os.path.exists(self._file("meta.json")):
+            return
+        with open(self._file("meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("key") != INDEX_KEY:
+            # Keyed on comments.rowid, which VACUUM may renumber: start over
+            print("ANN index uses an old row key, rebuilding it from the stored embeddings")
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        self.meta = meta
+
+        if self.meta["main"]:
+            self.centroids = np.load(self._file("centroids.npy"))
+            self.offsets = np.load(self._file("offsets.npy"))
+            self.vectors = np.load(self._file("vectors.npy"), mmap_mode="r")
+            self.rows = np.load(self._file("rows.npy"), mmap_mode="r")
+
+        if os.path.exists(self._file("delta_rows.bin")):
+            self.delta_rows = np.fromfile(self._file("delta_rows.bin"), dtype=np.int64)
+            vectors = np.fromfile(self._file("delta_vectors.bin"), dtype=EMBEDDING_DTYPE)
+            # A crash between the two appends leaves a partial tail; drop it
+            n = min(len(self.delta_rows), len(vectors) // max(1, self.meta["dim"]))
+            self.delta_rows = self.delta_rows[:n]
+            self.delta_vectors = vectors[:n * self.meta["dim"]].reshape(n, self.meta["dim"])
+
+    def _save_meta(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file("meta.json.tmp"), "w") as f:
+            json.dump(self.meta, f)
+        os.replace(self._file("meta.json.tmp"), self._file("meta.json"))
+
+    def __len__(self):
+        return self.meta["main"] + len(self.delta_rows)
+
+    @instrument("ann_sync")
+    def sync(self):
+        """Appends every embedding stored since the last sync to the delta segment. Returns how many."""
+        added = 0
+        with self._lock:
+            for batch in iter_embeddings(self.meta["watermark"]):
+                seqs = np.array([r[0] for r in batch], dtype=np.int64)
+                vectors = np.frombuffer(b"".join(r[1] for r in batch), dtype=EMBEDDING_DTYPE)
+                if not self.meta["dim"]:
+                    self.meta["dim"] = len(batch[0][1]) // vectors.itemsize
+                vectors = vectors.reshape(len(batch), self.meta["dim"])
+
+                os.makedirs(self.path, exist_ok=True)
+                with open(self._file("delta_vectors.bin"), "ab") as f:
+                    f.write(vectors.tobytes())
+                with open(self._file("delta_rows.bin"), "ab") as f:
+                    f.write(seqs.tobytes())
+
+                self.delta_vectors = np.concatenate([self.delta_vectors.reshape(-1, self.meta["dim"]), vectors])
+                self.delta_rows = np.concatenate([self.delta_rows, seqs])
+                self.meta["watermark"] = int(seqs[-1])
+                self._save_meta()
+                added += len(batch)
+        return added
+
+    def needs_rebuild(self):
+        return len(self.delta_rows) > max(ANN_DELTA_ROWS, self.meta["main"] * ANN_REBUILD_FACTOR)
+
+    def maybe_rebuild(self, background=False):
+        """Rebuilds if the delta has outgrown its budget, optionally on a daemon thread."""
+        if not self.needs_rebuild() or self._building.locked():
+            return
+        if background:
+            threading.Thread(target=self.rebuild, daemon=True).start()
+        else:
+            self.rebuild()
+
+    @instrument("ann_rebuild")
+    def rebuild(self, lists=ANN_LISTS, sample_size=ANN_TRAIN_SAMPLE):
+        """
+        Retrains the centroids and rewrites the main segment from every
+        stored embedding. Searches keep using the old files until the new
+        ones are swapped in.
+        """
+        if not self._building.acquire(blocking=False):
+            return
+
+        build_dir = self.path + ".building"
+        try:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            os.makedirs(build_dir)
+
+            # 1. Stream every embedding into one temporary memory-mapped array
+            expected = count_embeddings()
+            if not expected:
+                return
+            dim = self.meta["dim"]
+            staging = rows = None
+            n = 0
+            watermark = 0
+            for batch in iter_embeddings(0):
+                if staging is None:
+                    dim = dim or len(batch[0][1]) // np.dtype(EMBEDDING_DTYPE).itemsize
+                    staging = np.lib.format.open_memmap(os.path.join(build_dir, "staging.npy"), mode="w+",
+                                                        dtype=EMBEDDING_DTYPE, shape=(expected, dim))
+                    rows = np.empty(expected, dtype=np.int64)
+                # Rows stored after the count was taken are left for the next sync
+                batch = batch[:expected - n]
+                staging[n:n + len(batch)] = np.frombuffer(b"".join(r[1] for r in batch),
+                                                          dtype=EMBEDDING_DTYPE).reshape(len(batch), dim)
+                rows[n:n + len(batch)] = [r[0] for r in batch]
+                n += len(batch)
+                watermark = int(rows[n - 1])
+                if n == expected:
+                    break
+            if not n:
+                return
+
+            # 2. Train on a sample; sqrt(n) lists balances probing cost against list length
+            lists = min(n, lists or int(np.clip(np.sqrt(n), 1, 65536)))
+            rng = np.random.default_rng(0)
+            sample_idx = np.sort(rng.choice(n, min(n, max(sample_size, lists)), replace=False))
+            centroids = train_centroids(np.asarray(staging[sample_idx], dtype=np.float32), lists)
+
+            # 3. Assign everything and lay the vectors out list by list
+            labels = _assign(staging[:n], centroids)
+            order = np.argsort(labels, kind="stable")
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=lists))]).astype(np.int64)
+
+            vectors = np.lib.format.open_memmap(os.path.join(build_dir, "vectors.npy"), mode="w+",
+                                                dtype=EMBEDDING_DTYPE, shape=(n, dim))
+            for start in range(0, n, CHUNK_ROWS):
+                idx = order[start:start + CHUNK_ROWS]
+                # Read the staging file in ascending order, then scatter into list order
+                ascending = np.argsort(idx)
+                block = np.empty((len(idx), dim), dtype=EMBEDDING_DTYPE)
+                block[ascending] = staging[idx[ascending]]
+                vectors[start:start + len(idx)] = block
+            vectors.flush()
+            del vectors, staging
+            os.remove(os.path.join(build_dir, "staging.npy"))
+
+            np.save(os.path.join(build_dir, "centroids.npy"), centroids)
+            np.save(os.path.join(build_dir, "offsets.npy"), offsets)
+            np.save(os.path.join(build_dir, "rows.npy"), rows[:n][order])
+
+            # 4. Swap in the new segment; delta rows newer than the build stay in the delta
+            with self._lock:
+                os.makedirs(self.path, exist_ok=True)
+                for name in ("centroids.npy", "offsets.npy", "vectors.npy", "rows.npy"):
+                    os.replace(os.path.join(build_dir, name), self._file(name))
+
+                keep = self.delta_rows > watermark
+                self.delta_rows = self.delta_rows[keep]
+                self.delta_vectors = self.delta_vectors.reshape(-1, dim)[keep]
+                self.delta_rows.tofile(self._file("delta_rows.bin"))
+                self.delta_vectors.tofile(self._file("delta_vectors.bin"))
+
+                self.meta.update(dim=dim, main=n, watermark=max(watermark, self.meta["watermark"]))
+                self._save_meta()
+                self._load()
+
+            print(f"ANN index rebuilt: {n} vectors in {lists} lists")
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            self._building.release()
+
+    def search(self, queries, k=ANN_TOP_K, nprobe=ANN_NPROBE):
+        """
+        Approximate top-k by cosine similarity for each row of `queries`
+        (unit vectors). Returns one list of (seq, score) per query, best first.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        with self._lock:
+            centroids, offsets, vectors, rows = self.centroids, self.offsets, self.vectors, self.rows
+            delta_vectors, delta_rows = self.delta_vectors, self.delta_rows
+
+        candidates = [([], []) for _ in range(len(queries))]
+
+        # Main segment: only the lists closest to each query
+        if centroids is not None:
+            nprobe = min(nprobe, len(centroids))
+            probes = np.argpartition(-(queries @ centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+            for lst in np.unique(probes):
+                start, stop = offsets[lst], offsets[lst + 1]
+                if start == stop:
+                    continue
+                who = np.flatnonzero((probes == lst).any(axis=1))
+                scores = np.asarray(vectors[start:stop], dtype=np.float32) @ queries[who].T
+                for j, q in enumerate(who):
+                    candidates[q][0].append(rows[start:stop])
+                    candidates[q][1].append(scores[:, j])
+
+        # Delta segment: small by construction, so brute force
+        for start in range(0, len(delta_rows), CHUNK_ROWS):
+            scores = np.asarray(delta_vectors[start:start + CHUNK_ROWS], dtype=np.float32) @ queries.T
+            for q in range(len(queries)):
+                candidates[q][0].append(delta_rows[start:start + CHUNK_ROWS])
+                candidates[q][1].append(scores[:, q])
+
+        results = []
+        for row_parts, score_parts in candidates:
+            if not row_parts:
+                results.append([])
+                continue
+            all_rows = np.concatenate(row_parts)
+            all_scores = np.concatenate(score_parts)
+            top = np.argpartition(-all_scores, min(k, len(all_scores)) - 1)[:k]
+            top = top[np.argsort(-all_scores[top])]
+            results.append([(int(all_rows[i]), float(all_scores[i])) for i in top])
+        return results
+
+
+_indexes = {}
+
+
+def get_index():
+    """The index belonging to the current database file (one instance per path)."""
+    path = os.path.splitext(database.DB_PATH)[0] + "-ann"
+    if path not in _indexes:
+        _indexes[path] = IVFIndex(path)
+    return _indexes[path]
+
+
+@instrument("narrative_search")
+def find_similar_history(comment_ids, texts, before_ts=None, k=ANN_TOP_K, threshold=ANN_MATCH_THRESHOLD,
+                         polling_rate=POLL_INTERVAL):
+    """
+    Past comments whose embedding is close to any of the given comments
+    (e.g. an anomalous window's), excluding those comments themselves and,
+    with `before_ts`, anything published at or after it.
+
+    Returns {"matches": [{score, comment_id, video_id, window, text}, ...]
+    best first, "windows": Counter of (video_id, window), "videos": Counter}.
+    """
+    index = get_index()
+    if not len(index) or not comment_ids:
+        return {"matches": [], "windows": Counter(), "videos": Counter()}
+
+    own = set(get_embedding_seqs(list(comment_ids)).values())
+    # Over-fetch: the window's own comments are usually each other's nearest neighbours
+    hits = index.search(load_embeddings(comment_ids, texts), k=k + len(own))
+
+    best = {}
+    for per_query in hits:
+        for seq, score in per_query:
+            if score >= threshold and seq not in own and score > best.get(seq, -1.0):
+                best[seq] = score
+
+    info = get_comments_by_seq(list(best))
+    matches = []
+    for seq, score in sorted(best.items(), key=lambda item: -item[1]):
+        if seq not in info:
+            continue
+        comment_id, video_id, ts, text = info[seq]
+        if before_ts is not None and (ts is None or ts >= before_ts):
+            continue
+        window = ts - ts % polling_rate if ts is not None else None
+        matches.append({"score": round(score, 4), "comment_id": comment_id, "video_id": video_id,
+                        "window": window, "text": text})
+
+    return {
+        "matches": matches[:k],
+        "windows": Counter((m["video_id"], m["window"]) for m in matches),
+        "videos": Counter(m["video_id"] for m in matches),
+    }
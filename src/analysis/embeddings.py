@@ -0,0 +1,80 @@
+import numpy as np
+from database import get_embeddings, insert_embeddings
+from config import EMBEDDING_BATCH
+from analysis.models import registry
+import analysis.similarity  # Registers the "similarity" model
+from analysis.sentiment_cache import text_key
+from instrumentation import timed, observe
+
+# Vectors are L2-normalized before storage, so cosine similarity is a dot product
+EMBEDDING_DTYPE = np.float16
+
+
+def embed_texts(texts, batch_size=EMBEDDING_BATCH):
+    """
+    Encodes texts with the similarity model into an (n x dim) float16
+    array of unit vectors. Identical normalized texts (bot copies) are
+    encoded once.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=EMBEDDING_DTYPE)
+
+    keys = [text_key(t) for t in texts]
+    unique = {}
+    for key, text in zip(keys, texts):
+        unique.setdefault(key, text)
+
+    observe("batch_size", "similarity", len(unique))
+    with timed("embedding_inference"):
+        vectors = registry.get("similarity").encode(
+            list(unique.values()), batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True
+        )
+    row = {key: i for i, key in enumerate(unique)}
+    return vectors[[row[k] for k in keys]].astype(EMBEDDING_DTYPE)
+
+
+def embed_comments(comments):
+    """
+    Attaches an "embedding" (float16 bytes) to each parsed comment, in
+    place, for insert_comments_batch to store next to the comment.
+    """
+    if not comments:
+        return comments
+
+    vectors = embed_texts([c["text"] for c in comments])
+    for comment, vector in zip(comments, vectors):
+        comment["embedding"] = vector.tobytes()
+    return comments
+
+
+def load_embeddings(comment_ids, texts):
+    """
+    (n x dim) float32 matrix for the given comments, in order. Stored
+    vectors are read back; comments ingested before the store existed are
+    encoded now and saved, so they are only encoded once.
+    """
+    stored = get_embeddings(list(comment_ids))
+    missing = [i for i, cid in enumerate(comment_ids) if cid not in stored]
+
+    if missing:
+        vectors = embed_texts([texts[i] for i in missing])
+        new_rows = [(comment_ids[i], v.tobytes()) for i, v in zip(missing, vectors)]
+        insert_embeddings(new_rows)
+        stored.update(new_rows)
+
+    return np.stack([np.frombuffer(stored[cid], dtype=EMBEDDING_DTYPE) for cid in comment_ids]).astype(np.float32)
+
+
+def mean_pairwise_similarity(vectors):
+    """
+    Average cosine similarity over all unique pairs of unit vectors.
+    The sum over every pair is |sum of vectors|^2 minus the n self-pairs,
+    so no n x n matrix is built.
+    """
+    n = len(vectors)
+    if n < 2:
+        return 0.0
+
+    total = vectors.sum(axis=0)
+    self_pairs = np.einsum("ij,ij->", vectors, vectors)
+    return float((total @ total - self_pairs) / (n * (n - 1)))
@@ -0,0 +1,68 @@
+import hashlib
+import re
+import unicodedata
+import zlib
+import numpy as np
+from config import MINHASH_PERMUTATIONS, MINHASH_BANDS, MINHASH_SHINGLE, MINHASH_MIN_CHARS
+
+# MinHash over character shingles, banded for LSH. Two texts with Jaccard
+# similarity s share at least one band bucket with probability
+# 1 - (1 - s^rows)^bands, i.e. a soft threshold near (1/bands)^(1/rows).
+# Bucket hits are only candidates: they are confirmed by comparing full
+# signatures against MINHASH_THRESHOLD. Only stable hashes (crc32, blake2b)
+# are used so signatures and bucket keys stored in the database mean the
+# same thing on every run.
+
+# Universal hashing (a * x + b) mod p with p prime: x, a and b all below
+# p = 2^31 - 1, so a * x + b stays far inside uint64 and wraps p many times
+_PRIME = (1 << 31) - 1
+_WHITESPACE = re.compile(r"\s+")
+
+# Fixed seed: the permutations must never change between runs
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(1, _PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingles(text, k=MINHASH_SHINGLE):
+    """Set of k-character shingles of the normalized text (empty if it is too short to judge)."""
+    normalized = _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text or "").casefold()).strip()
+    if len(normalized) < MINHASH_MIN_CHARS:
+        return set()
+    return {normalized[i:i + k] for i in range(len(normalized) - k + 1)}
+
+
+def signature(text):
+    """MinHash signature (MINHASH_PERMUTATIONS uint64 values), or None for short texts."""
+    grams = shingles(text)
+    if not grams:
+        return None
+
+    hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) % _PRIME for g in grams), dtype=np.uint64, count=len(grams))
+    # (permutations x shingles), min over shingles
+    return ((hashes[None, :] * _A[:, None] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def band_keys(sig, bands=MINHASH_BANDS):
+    """
+    One signed 64-bit bucket key per LSH band of a signature (band index
+    included, so keys from different bands never collide).
+    """
+    keys = []
+    for band, rows in enumerate(sig.reshape(bands, -1)):
+        digest = hashlib.blake2b(band.to_bytes(2, "big") + rows.tobytes(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "big", signed=True))
+    return keys
+
+
+def similarity(sig_a, sig_b):
+    """Fraction of matching MinHash values: an unbiased estimate of shingle Jaccard similarity."""
+    return float(np.mean(sig_a == sig_b))
+
+
+def to_bytes(sig):
+    return sig.astype(np.uint64).tobytes()
+
+
+def from_bytes(blob):
+    return np.frombuffer(blob, dtype=np.uint64)
@@ -0,0 +1,55 @@
+import gc
+import sys
+import threading
+
+
+class ModelRegistry:
+    def __init__(self):
+        """
+        Holds heavyweight models behind named loaders. Nothing is loaded
+        until the first get(), so importing the analysis package stays cheap
+        and code paths that never touch a model never pay for it.
+        """
+        self._loaders = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        """Registers a zero-argument function that builds the model."""
+        self._loaders[name] = loader
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._lock:
+            # Another thread may have finished loading while we waited
+            if name not in self._models:
+                if name not in self._loaders:
+                    raise KeyError(f"No model registered under '{name}'")
+                self._models[name] = self._loaders[name]()
+            return self._models[name]
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def warm(self, *names):
+        """Loads the given models (or every registered one) ahead of first use."""
+        for name in names or list(self._loaders):
+            self.get(name)
+
+    def unload(self, *names):
+        """Drops the given models (or all of them) and releases their memory."""
+        with self._lock:
+            for name in names or list(self._models):
+                self._models.pop(name, None)
+
+        gc.collect()
+        # Only touch torch if a model already imported it
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+registry = ModelRegistry()
@@ -0,0 +1,355 @@
+import bisect
+from array import array
+from itertools import accumulate
+from math import log
+from random import random
+from config import MAX_WINDOWS, WARMUP_PERIOD, TDIGEST_COMPRESSION, TDIGEST_PANES
+from analysis.rollingbaseline import RollingBaseline, METRICS
+
+
+class _Node:
+    __slots__ = ("value", "next", "width")
+
+    def __init__(self, value, next, width):
+        self.value = value
+        self.next = next
+        self.width = width
+
+
+# Tail sentinel: compares greater than every real value
+_NIL = _Node(float("inf"), [], [])
+
+
+class IndexableSkiplist:
+    def __init__(self, expected_size=100):
+        """
+        Sorted multiset with O(log n) insert, remove and access by rank.
+        Each link stores how many positions it skips, which is what makes
+        s[i] (and therefore medians) cheap.
+        """
+        self.size = 0
+        self.maxlevels = int(1 + log(max(expected_size, 2), 2))
+        self.head = _Node("HEAD", [_NIL] * self.maxlevels, [1] * self.maxlevels)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        node = self.head
+        i += 1
+        for level in reversed(range(self.maxlevels)):
+            while node.width[level] <= i:
+                i -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def insert(self, value):
+        # Last node on each level whose successor is > value
+        chain = [None] * self.maxlevels
+        steps_at_level = [0] * self.maxlevels
+        node = self.head
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value <= value:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        # Geometric tower height; 1.0 - random() is never 0
+        d = min(self.maxlevels, 1 - int(log(1.0 - random(), 2.0)))
+        new_node = _Node(value, [None] * d, [None] * d)
+        steps = 0
+        for level in range(d):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(d, self.maxlevels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        # Last node on each level whose successor is >= value
+        chain = [None] * self.maxlevels
+        node = self.head
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value < value:
+                node = node.next[level]
+            chain[level] = node
+        if value != chain[0].next[0].value:
+            raise KeyError(f"{value} not in skiplist")
+
+        d = len(chain[0].next[0].next)
+        for level in range(d):
+            prev = chain[level]
+            prev.width[level] += prev.next[level].width[level] - 1
+            prev.next[level] = prev.next[level].next[level]
+        for level in range(d, self.maxlevels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def median(self):
+        n = self.size
+        mid = n // 2
+        if n % 2:
+            return self[mid]
+        return (self[mid - 1] + self[mid]) / 2
+
+    def median_absolute_deviation(self, median):
+        """
+        Median of |x - median| without materializing the deviations.
+        Left of the median the deviations ascend as we walk down, right of
+        it they ascend as we walk up: two sorted runs, so any rank of their
+        merge is found by binary search.
+        """
+        n = self.size
+        # Number of values <= median (the left run)
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] <= median:
+                lo = mid + 1
+            else:
+                hi = mid
+        split = lo
+
+        left_len, right_len = split, n - split
+
+        def left(i):
+            return median - self[split - 1 - i]
+
+        def right(j):
+            return self[split + j] - median
+
+        def kth(k):
+            # i = how many of the k+1 smallest come from the left run
+            lo = max(0, k + 1 - right_len)
+            hi = min(k + 1, left_len)
+            while lo < hi:
+                i = (lo + hi) // 2
+                if left(i) < right(k - i):
+                    lo = i + 1
+                else:
+                    hi = i
+            i, j = lo, k + 1 - lo
+            candidates = []
+            if i > 0:
+                candidates.append(left(i - 1))
+            if j > 0:
+                candidates.append(right(j - 1))
+            return max(candidates)
+
+        mid = n // 2
+        if n % 2:
+            return kth(mid)
+        return (kth(mid - 1) + kth(mid)) / 2
+
+
+def _first(n, test):
+    """Smallest i in [0, n) for which test(i) holds (n if none); test must be monotone."""
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if test(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+class SlidingDigest:
+    # Smaller panes are mostly eviction granularity, not compression
+    MIN_PANE_SIZE = 3
+
+    def __init__(self, max_windows, compression=TDIGEST_COMPRESSION, panes=TDIGEST_PANES):
+        """
+        Approximate sliding-window quantiles in the spirit of a t-digest.
+        The window is split into panes; each closed pane is compressed to
+        weighted centroids, and the oldest pane is dropped whole. The window
+        therefore covers between max_windows and max_windows + pane_size
+        observations. Memory and query cost depend on `compression`, not on
+        max_windows.
+
+        The closed panes' summary is only rebuilt when a pane closes; queries
+        fold the open pane in by binary search instead of merging the two.
+        """
+        if max_windows // panes < self.MIN_PANE_SIZE:
+            raise ValueError(f"Approx baseline needs at least {self.MIN_PANE_SIZE} windows per pane, but "
+                             f"{max_windows} windows over {panes} panes gives {max_windows // panes}; "
+                             f"use the 'exact' engine or fewer TDIGEST_PANES")
+
+        self.compression = compression
+        self.pane_size = max_windows // panes
+        self.max_panes = -(-max_windows // self.pane_size)
+        self.closed = []      # compressed [(mean, weight), ...] per closed pane, oldest first
+        self.means = []       # all closed panes compressed together: centroid means, ascending
+        self.cum = [0]        # cum[i] = total weight of means[:i]
+        self.open = []        # sorted raw values of the pane being filled
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _compress(self, centroids):
+        """Merges sorted (mean, weight) pairs under the t-digest size bound."""
+        total = sum(w for _, w in centroids)
+        merged = []
+        seen = 0.0
+        for mean, weight in centroids:
+            if merged:
+                m_mean, m_weight = merged[-1]
+                # Centroids near the median may grow large, those in the tails stay small
+                q = (seen + m_weight / 2) / total
+                if m_weight + weight <= max(1.0, 4 * total * q * (1 - q) / self.compression):
+                    new_weight = m_weight + weight
+                    merged[-1] = ((m_mean * m_weight + mean * weight) / new_weight, new_weight)
+                    continue
+                seen += m_weight
+            merged.append((mean, weight))
+        return merged
+
+    def add(self, value):
+        bisect.insort(self.open, value)
+        self.count += 1
+        if len(self.open) < self.pane_size:
+            return
+
+        self.closed.append(self._compress([(v, 1) for v in self.open]))
+        self.open = []
+        if len(self.closed) > self.max_panes:
+            self.count -= sum(w for _, w in self.closed.pop(0))
+        summary = self._compress(sorted(c for pane in self.closed for c in pane))
+        self.means = [m for m, _ in summary]
+        self.cum = [0, *accumulate(w for _, w in summary)]
+
+    def _weighted_median(self, runs, weight_upto):
+        """
+        Weighted median of the candidates in `runs` ((length, value_at(i))
+        pairs, each ascending), where weight_upto(v) is the weight at or
+        below v: the smallest candidate holding half the weight, averaged
+        with the next one up on an exact split, as a walk through every
+        centroid in order would find.
+        """
+        half = (self.cum[-1] + len(self.open)) / 2
+        best = self._smallest(runs, lambda v: weight_upto(v) >= half)
+        if weight_upto(best) > half:
+            return best
+
+        # Even split: average with the next candidate up
+        above = self._smallest(runs, lambda v: v > best)
+        return (best + above) / 2 if above is not None else best
+
+    @staticmethod
+    def _smallest(runs, test):
+        """Smallest candidate in `runs` passing `test`, which must be monotone (None if none does)."""
+        found = None
+        for n, at in runs:
+            i = _first(n, lambda i: test(at(i)))
+            if i < n and (found is None or at(i) < found):
+                found = at(i)
+        return found
+
+    def median(self):
+        means, cum, open_ = self.means, self.cum, self.open
+        return self._weighted_median(
+            [(len(means), means.__getitem__), (len(open_), open_.__getitem__)],
+            lambda v: cum[bisect.bisect_right(means, v)] + bisect.bisect_right(open_, v),
+        )
+
+    @staticmethod
+    def _within(values, split, median, d, weight_before):
+        """
+        Weight of sorted `values` within distance d of `median` (split =
+        bisect_right(values, median)), with distances computed exactly as
+        the MAD candidates are. x - median is monotone in x, so C bisection
+        on median +- d only needs nudging past rounding at the edges.
+        """
+        lo = bisect.bisect_left(values, median - d, 0, split)
+        while lo > 0 and values[lo - 1] - median >= -d:
+            lo -= 1
+        while lo < split and values[lo] - median < -d:
+            lo += 1
+        hi = bisect.bisect_right(values, median + d, split)
+        while hi > split and values[hi - 1] - median > d:
+            hi -= 1
+        while hi < len(values) and values[hi] - median <= d:
+            hi += 1
+        return weight_before(hi) - weight_before(lo)
+
+    def median_absolute_deviation(self, median):
+        means, cum, open_ = self.means, self.cum, self.open
+        m_split = bisect.bisect_right(means, median)
+        o_split = bisect.bisect_right(open_, median)
+
+        # Distances ascend walking left from the median, and walking right from it
+        def weight_upto(d):
+            return (self._within(means, m_split, median, d, cum.__getitem__)
+                    + self._within(open_, o_split, median, d, int))
+
+        return self._weighted_median([
+            (m_split, lambda i: -(means[m_split - 1 - i] - median)),
+            (len(means) - m_split, lambda i: means[m_split + i] - median),
+            (o_split, lambda i: -(open_[o_split - 1 - i] - median)),
+            (len(open_) - o_split, lambda i: open_[o_split + i] - median),
+        ], weight_upto)
+
+
+class OrderStatBaseline(RollingBaseline):
+    def __init__(self, max_windows=MAX_WINDOWS, warmup=WARMUP_PERIOD, mode="exact"):
+        """
+        Drop-in RollingBaseline for long baselines (days of 1-minute windows).
+
+        "exact": every metric keeps an indexable skiplist, so the median and
+        MAD come from O(log n) rank lookups instead of sorting two fresh
+        lists per metric per evaluate(). The raw values live in one flat ring
+        buffer (a single array of doubles) so evicted values can be removed.
+
+        "approx": every metric keeps a SlidingDigest with bounded memory,
+        trading exactness for a footprint independent of max_windows.
+        """
+        if mode not in ("exact", "approx"):
+            raise ValueError(f"Unknown baseline mode '{mode}', expected 'exact' or 'approx'")
+
+        self.max_windows = max_windows
+        self.warmup = warmup
+        self.mode = mode
+        self.updates = 0
+
+        if mode == "exact":
+            self.ring = array("d", bytes(8 * len(METRICS) * max_windows))
+            self.stats = [IndexableSkiplist(max_windows) for _ in METRICS]
+        else:
+            self.stats = [SlidingDigest(max_windows) for _ in METRICS]
+
+    def update(self, metrics):
+        values = self._values(metrics)
+
+        if self.mode == "exact":
+            width = len(METRICS)
+            slot = (self.updates % self.max_windows) * width
+            evicting = self.updates >= self.max_windows
+
+            for i, value in enumerate(values):
+                if evicting:
+                    self.stats[i].remove(self.ring[slot + i])
+                # Store as a double first so the skiplist and ring agree exactly
+                self.ring[slot + i] = value
+                self.stats[i].insert(self.ring[slot + i])
+        else:
+            for digest, value in zip(self.stats, values):
+                digest.add(value)
+
+        self.updates += 1
+
+    def _size(self):
+        return len(self.stats[0])
+
+    def _z(self, index, value, noise_floor):
+        structure = self.stats[index]
+        if len(structure) < 3:
+            return 0
+
+        median = structure.median()
+        mad = structure.median_absolute_deviation(median)
+        return self._robust_z(value, median, mad, noise_floor)
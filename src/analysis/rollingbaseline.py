@@ -1,6 +1,35 @@
 from collections import deque
 import statistics
-from config import WEIGHTS, NOISE_FLOOR, ROBOTIC_PENALTY_MULTIPLIER, ROBOTIC_THRESHOLD, MAX_WINDOWS, WARMUP_PERIOD
+from config import (WEIGHTS, NOISE_FLOOR, ROBOTIC_PENALTY_MULTIPLIER, ROBOTIC_THRESHOLD, MAX_WINDOWS, WARMUP_PERIOD,
+                    BASELINE_ENGINE)
+
+
+# (history key, z-score key, noise floor) for every tracked metric, in the
+# order RollingBaseline._values() produces them
+METRICS = (
+    ("counts", "count_z", 2.0),
+    ("authors", "author_z", 2.0),
+    ("lengths", "length_z", 10.0),
+    ("sentiments", "sentiment_z", 0.1),
+    # A floor of 0.15 means the ratio has to jump to at least 1.38 before
+    # hitting a Z-score of 2.5 (the trigger for your alert).
+    ("concentration", "concentration_z", 0.15),
+    ("sentiment_var", "sentiment_var_z", 0.05),
+    ("avg_gaps", "gap_z", 5.0),
+    ("gap_vars", "gap_var_z", 10.0),
+)
+
+
+def create_baseline(engine=BASELINE_ENGINE, **kwargs):
+    """
+    Builds a baseline for one video. "deque" is the original engine;
+    "exact" and "approx" are the order-statistic engines for long baselines.
+    """
+    if engine == "deque":
+        return RollingBaseline(**kwargs)
+
+    from analysis.orderstat import OrderStatBaseline
+    return OrderStatBaseline(mode=engine, **kwargs)
 
 
 class RollingBaseline:
@@ -12,27 +41,31 @@ class RollingBaseline:
         self.warmup = warmup
 
         # Using a dictionary of deques to track the rolling state of each metric
-        self.history = {
-            "counts": deque(maxlen=self.max_windows),
-            "authors": deque(maxlen=self.max_windows),
-            "lengths": deque(maxlen=self.max_windows),
-            "sentiments": deque(maxlen=self.max_windows),
-            "concentration": deque(maxlen=self.max_windows),
-            "sentiment_var": deque(maxlen=self.max_windows),
-            "avg_gaps": deque(maxlen=self.max_windows),
-            "gap_vars": deque(maxlen=self.max_windows),
-        }
+        self.history = {key: deque(maxlen=self.max_windows) for key, _, _ in METRICS}
 
-    def update(self, metrics):
+    @staticmethod
+    def _values(metrics):
+        """The eight tracked values for one window, in METRICS order."""
+        total = metrics.get("total_comments", 0)
         authors = max(metrics.get("unique_authors", 0), 1)
-        self.history["counts"].append(metrics.get("total_comments", 0))
-        self.history["authors"].append(authors)
-        self.history["lengths"].append(metrics.get("avg_length", 0))
-        self.history["sentiments"].append(metrics.get("avg_sentiment", 0))
-        self.history["concentration"].append(metrics.get("total_comments", 0) / authors)
-        self.history["sentiment_var"].append(metrics.get("sentiment_variance", 0))
-        self.history["avg_gaps"].append(metrics.get("avg_gap", 0))
-        self.history["gap_vars"].append(metrics.get("gap_variance", 0))
+        return (
+            total,
+            authors,
+            metrics.get("avg_length", 0),
+            metrics.get("avg_sentiment", 0),
+            total / authors,
+            metrics.get("sentiment_variance", 0),
+            metrics.get("avg_gap", 0),
+            metrics.get("gap_variance", 0),
+        )
+
+    def update(self, metrics):
+        for (key, _, _), value in zip(METRICS, self._values(metrics)):
+            self.history[key].append(value)
+
+    def _size(self):
+        """How many windows the baseline currently remembers."""
+        return len(self.history["counts"])
 
     @staticmethod
     def _safe_z(value, series, noise_floor=0.01):
@@ -41,6 +74,10 @@ class RollingBaseline:
         median = statistics.median(series)
         deviations = [abs(x - median) for x in series]
         mad = statistics.median(deviations)
+        return RollingBaseline._robust_z(value, median, mad, noise_floor)
+
+    @staticmethod
+    def _robust_z(value, median, mad, noise_floor):
         consistent_mad = mad * 1.4826
 
         # --- THE FIX ---
@@ -54,28 +91,17 @@ class RollingBaseline:
         # Cap to prevent composite score blowout
         return max(-20.0, min(20.0, raw_z))
 
+    def _z(self, index, value, noise_floor):
+        """Z-score of `value` against the history of metric number `index`."""
+        return self._safe_z(value, self.history[METRICS[index][0]], noise_floor=noise_floor)
 
     def evaluate(self, metrics):
-        if len(self.history["counts"]) < self.warmup:
+        if self._size() < self.warmup:
             return None
 
-        total = metrics.get("total_comments", 0)
-        authors = max(metrics.get("unique_authors", 1), 1)
-
         return {
-            "count_z": self._safe_z(total, self.history["counts"], noise_floor=2.0),
-            "author_z": self._safe_z(authors, self.history["authors"], noise_floor=2.0),
-            "length_z": self._safe_z(metrics.get("avg_length", 0), self.history["lengths"], noise_floor=10.0),
-            "sentiment_z": self._safe_z(metrics.get("avg_sentiment", 0), self.history["sentiments"], noise_floor=0.1),
-
-            # A floor of 0.15 means the ratio has to jump to at least 1.38 before
-            # hitting a Z-score of 2.5 (the trigger for your alert).
-            "concentration_z": self._safe_z(total / authors, self.history["concentration"], noise_floor=0.15),
-
-            "sentiment_var_z": self._safe_z(metrics.get("sentiment_variance", 0), self.history["sentiment_var"],
-                                            noise_floor=0.05),
-            "gap_z": self._safe_z(metrics.get("avg_gap", 0), self.history["avg_gaps"], noise_floor=5.0),
-            "gap_var_z": self._safe_z(metrics.get("gap_variance", 0), self.history["gap_vars"], noise_floor=10.0),
+            z_key: self._z(i, value, noise_floor)
+            for i, ((_, z_key, noise_floor), value) in enumerate(zip(METRICS, self._values(metrics)))
         }
 
     @staticmethod
@@ -1,21 +1,109 @@
-from transformers import pipeline, AutoTokenizer
-
-my_tokenizer = AutoTokenizer.from_pretrained(
-    "cardiffnlp/twitter-roberta-base-sentiment-latest",
-    #token="hf_YOUR_TOKEN_HERE"
-)
-
-sentiment_pipeline = pipeline(
-    "sentiment-analysis",
-    model="cardiffnlp/twitter-roberta-base-sentiment-latest",
-    tokenizer=my_tokenizer,
-    device=0,
-    truncation=True,
-    max_length=512,
-    batch_size=32,
-    use_safetensors=True,  # Forces the secure file format
-    #token="hf_YOUR_TOKEN_HERE"
-)
+import os
+from config import (SENTIMENT_BACKEND, INFERENCE_THREADS, SENTIMENT_PARITY_TOLERANCE,
+                    SENTIMENT_TOKEN_BUDGET, SENTIMENT_MAX_BATCH)
+from analysis.models import registry
+from instrumentation import timed, observe, increment
+
+# torch and transformers are imported inside the loaders: importing this
+# module must not cost seconds of startup for callers that never score text.
+
+MODEL_NAME = "cardiffnlp/twitter-roberta-base-sentiment-latest"
+BACKENDS = ("auto", "torch", "torch-int8", "onnx")
+
+
+def resolve_device():
+    """Pipeline device index: 0 for the first GPU when one is usable, -1 for CPU."""
+    import torch
+    return 0 if torch.cuda.is_available() else -1
+
+
+def resolve_backend(backend=SENTIMENT_BACKEND):
+    """The backend 'auto' stands for on this machine: fp32 torch on a GPU, int8 torch on CPU."""
+    if backend == "auto":
+        return "torch" if resolve_device() >= 0 else "torch-int8"
+    return backend
+
+
+def model_tag(backend=SENTIMENT_BACKEND):
+    """Model and concrete backend behind score_texts. Cached scores are only valid under the same tag."""
+    return f"{MODEL_NAME}:{resolve_backend(backend)}"
+
+
+def cpu_threads():
+    """
+    Intra-op threads for CPU inference. GEMM-heavy models gain nothing from
+    hyperthreads, so default to one thread per physical core (approximated
+    as half the logical CPUs).
+    """
+    if INFERENCE_THREADS:
+        return INFERENCE_THREADS
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+def _load_model(backend):
+    import torch
+    from transformers import AutoModelForSequenceClassification
+
+    if backend == "torch":
+        return AutoModelForSequenceClassification.from_pretrained(MODEL_NAME, use_safetensors=True)
+
+    if backend == "torch-int8":
+        # Dynamic quantization: Linear weights stored as int8, activations quantized on the fly
+        model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME, use_safetensors=True)
+        return torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+    if backend == "onnx":
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+        except ImportError as e:
+            raise RuntimeError("The 'onnx' backend needs: pip install optimum[onnxruntime]") from e
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = cpu_threads()
+        return ORTModelForSequenceClassification.from_pretrained(
+            MODEL_NAME, export=True, provider="CPUExecutionProvider", session_options=options
+        )
+
+    raise ValueError(f"Unknown sentiment backend '{backend}', expected one of {BACKENDS}")
+
+
+def build_sentiment_pipeline(backend=SENTIMENT_BACKEND):
+    """
+    Builds the sentiment pipeline for the requested backend.
+    'auto' uses fp32 torch on a GPU when one is present, and int8 torch on CPU.
+    """
+    import torch
+    from transformers import pipeline, AutoTokenizer
+
+    device = resolve_device()
+    backend = resolve_backend(backend)
+
+    # Quantized and ONNX models only run on CPU
+    if backend != "torch":
+        device = -1
+    if device < 0:
+        torch.set_num_threads(cpu_threads())
+
+    print(f"Loading sentiment model ({backend} on {'cuda:0' if device >= 0 else 'cpu'})...")
+    return pipeline(
+        "sentiment-analysis",
+        model=_load_model(backend),
+        tokenizer=AutoTokenizer.from_pretrained(MODEL_NAME),  #token="hf_YOUR_TOKEN_HERE"
+        device=device,
+        truncation=True,
+        max_length=512,
+        batch_size=32,
+    )
+
+
+registry.register("sentiment", build_sentiment_pipeline)
+
+
+def sentiment_pipeline(texts, **kwargs):
+    """Calls the sentiment pipeline, loading it on first use."""
+    return registry.get("sentiment")(texts, **kwargs)
+
 
 def sentiment_score(result):
     """
@@ -37,3 +125,89 @@ def sentiment_score(result):
     return (val - 0.5) * 2.0
 
 
+def token_lengths(tokenizer, texts, max_length=512):
+    """Token count of each text after truncation (fast tokenizers do this in Rust)."""
+    encoded = tokenizer(texts, truncation=True, max_length=max_length)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+def plan_batches(lengths, token_budget=SENTIMENT_TOKEN_BUDGET, max_batch=SENTIMENT_MAX_BATCH):
+    """
+    Groups text indices into batches of similar length. Every batch is
+    padded to its longest row, so its cost is rows x longest; a batch is
+    closed once adding the next (longer) text would exceed `token_budget`.
+    Short replies end up in large batches, long comments in small ones.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches = []
+    current = []
+
+    for i in order:
+        # Sorted ascending, so lengths[i] is the padded width if i joins
+        if current and ((len(current) + 1) * lengths[i] > token_budget or len(current) >= max_batch):
+            batches.append(current)
+            current = []
+        current.append(i)
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def score_texts(texts):
+    """
+    Runs the pipeline over raw texts and returns one [-1.0, 1.0] score per
+    text, in the same order as `texts`. Texts are scored in length-bucketed
+    batches so one long comment doesn't pad a batch of one-word replies.
+    """
+    pipe = registry.get("sentiment")
+    with timed("tokenize"):
+        lengths = token_lengths(pipe.tokenizer, texts)
+    scores = [0.0] * len(texts)
+
+    for batch in plan_batches(lengths):
+        observe("batch_size", "sentiment", len(batch))
+        with timed("sentiment_inference"):
+            results = pipe([texts[i] for i in batch], batch_size=len(batch), truncation=True, max_length=512)
+
+        # Scatter back to the original positions
+        for i, result in zip(batch, results):
+            scores[i] = sentiment_score(result)
+
+    increment("texts_scored", len(texts))
+    return scores
+
+
+def check_parity(texts, backend=SENTIMENT_BACKEND, tolerance=SENTIMENT_PARITY_TOLERANCE):
+    """
+    Scores `texts` with both the fp32 reference model and `backend`, and
+    reports how far the optimized backend drifts from the reference.
+    """
+    reference = build_sentiment_pipeline("torch")
+    candidate = build_sentiment_pipeline(backend)
+
+    ref_results = reference(texts, batch_size=32, truncation=True, max_length=512)
+    new_results = candidate(texts, batch_size=32, truncation=True, max_length=512)
+
+    diffs = [abs(sentiment_score(a) - sentiment_score(b)) for a, b in zip(ref_results, new_results)]
+    same_label = sum(a["label"] == b["label"] for a, b in zip(ref_results, new_results))
+    max_diff = max(diffs) if diffs else 0.0
+
+    return {
+        "backend": backend,
+        "texts": len(texts),
+        "max_abs_diff": max_diff,
+        "mean_abs_diff": sum(diffs) / len(diffs) if diffs else 0.0,
+        "label_agreement": same_label / len(texts) if texts else 1.0,
+        "passed": max_diff <= tolerance
+    }
+
+
+if __name__ == "__main__":
+    samples = [
+        "This is the best video I've seen all year!",
+        "Absolutely terrible, unsubscribed.",
+        "First",
+        "Can someone explain what happened at 3:42? I didn't get the reference.",
+    ]
+    print(check_parity(samples))
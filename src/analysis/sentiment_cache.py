@@ -0,0 +1,97 @@
+import hashlib
+import re
+import unicodedata
+from collections import OrderedDict
+from database import get_cached_sentiments, insert_cached_sentiments
+from config import SENTIMENT_CACHE_SIZE
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def text_key(text, namespace=""):
+    """
+    Content address for a comment: hash of the text after Unicode, case and
+    whitespace normalization, so trivially varied bot copies share one entry.
+    Keys under different `namespace`s never collide.
+    """
+    normalized = _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text).casefold()).strip()
+    if namespace:
+        normalized = f"{namespace}\0{normalized}"
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class SentimentCache:
+    def __init__(self, scorer, max_entries=SENTIMENT_CACHE_SIZE, namespace=None):
+        """
+        Memoizes `scorer` (a function mapping a list of texts to a list of
+        sentiment floats) behind a bounded in-memory LRU and the
+        sentiment_cache table, so repeated texts cost no inference.
+
+        `namespace` (called once, on first use) names the model behind
+        `scorer`, e.g. sentiment.model_tag. It is part of every key, so
+        scores persisted by another model or backend are never served.
+        """
+        self.scorer = scorer
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self._tag = None
+        self.memory = OrderedDict()
+        self.stats = {"texts": 0, "batch_duplicates": 0, "memory_hits": 0, "db_hits": 0, "misses": 0}
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def score(self, texts):
+        if self._tag is None:
+            self._tag = self.namespace() if self.namespace else ""
+        keys = [text_key(t, self._tag) for t in texts]
+        self.stats["texts"] += len(texts)
+
+        # 1. Dedupe within the batch, keeping the first text seen for each key
+        unique = {}
+        for key, text in zip(keys, texts):
+            unique.setdefault(key, text)
+        self.stats["batch_duplicates"] += len(texts) - len(unique)
+
+        # 2. In-memory LRU
+        scores = {}
+        for key in unique:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                scores[key] = self.memory[key]
+        self.stats["memory_hits"] += len(scores)
+
+        # 3. Persistent cache from previous runs
+        pending = [k for k in unique if k not in scores]
+        from_db = get_cached_sentiments(pending)
+        self.stats["db_hits"] += len(from_db)
+        for key, value in from_db.items():
+            scores[key] = value
+            self._remember(key, value)
+
+        # 4. Only genuinely new texts reach the model
+        misses = [k for k in pending if k not in from_db]
+        self.stats["misses"] += len(misses)
+        if misses:
+            results = self.scorer([unique[k] for k in misses])
+            for key, value in zip(misses, results):
+                scores[key] = value
+                self._remember(key, value)
+            insert_cached_sentiments(list(zip(misses, results)))
+
+        return [scores[k] for k in keys]
+
+    def hit_rate(self):
+        """Fraction of requested texts that were answered without inference."""
+        if not self.stats["texts"]:
+            return 0.0
+        return 1.0 - self.stats["misses"] / self.stats["texts"]
+
+    def report(self):
+        s = self.stats
+        return (f"Sentiment cache: {s['texts']} texts, {s['batch_duplicates']} batch duplicates, "
+                f"{s['memory_hits']} memory hits, {s['db_hits']} DB hits, {s['misses']} inferred "
+                f"({self.hit_rate() * 100:.1f}% hit rate)")
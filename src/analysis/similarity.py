@@ -1,23 +1,39 @@
-from sentence_transformers import SentenceTransformer, util
-import torch
-from sklearn.feature_extraction.text import TfidfVectorizer
+from analysis.models import registry
 
-# This model is tiny (~80MB) and optimized for exactly this task
-sim_model = SentenceTransformer('all-MiniLM-L6-v2', device='cuda:0')
 
+def load_similarity_model():
+    from sentence_transformers import SentenceTransformer
+    import torch
 
-def calculate_window_similarity(texts):
+    # This model is tiny (~80MB) and optimized for exactly this task
+    return SentenceTransformer('all-MiniLM-L6-v2', device='cuda:0' if torch.cuda.is_available() else 'cpu')
+
+
+registry.register("similarity", load_similarity_model)
+
+
+def calculate_window_similarity(texts, comment_ids=None):
     """
     Takes a list of strings and calculates the average linguistic
     similarity across the entire group.
     Returns a float between 0.0 (completely different) and 1.0 (identical).
+
+    With `comment_ids`, the vectors stored at ingest are reused and no
+    model forward pass is needed for comments that already have one.
     """
     # If there's 0 or 1 comment, there's nothing to compare
     if len(texts) < 2:
         return 0.0
 
+    if comment_ids is not None:
+        from analysis.embeddings import load_embeddings, mean_pairwise_similarity
+        return round(mean_pairwise_similarity(load_embeddings(comment_ids, texts)), 4)
+
+    from sentence_transformers import util
+    import torch
+
     # 1. Convert texts to 384-dimensional mathematical vectors
-    embeddings = sim_model.encode(texts, convert_to_tensor=True)
+    embeddings = registry.get("similarity").encode(texts, convert_to_tensor=True)
 
     # 2. Compute the cosine similarity matrix for all pairs
     cosine_scores = util.cos_sim(embeddings, embeddings)
@@ -41,6 +57,8 @@ def extract_top_keywords(texts, top_n=3):
     if len(texts) < 2:
         return []
 
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
     # Initialize TF-IDF, automatically filtering out 'the', 'and', 'is', etc.
     vectorizer = TfidfVectorizer(stop_words='english', max_df=0.95)
 
@@ -0,0 +1,123 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from config import WEIGHTS, NOISE_FLOOR, ROBOTIC_PENALTY_MULTIPLIER, ROBOTIC_THRESHOLD, ALERT_THRESHOLDS
+from analysis.rollingbaseline import RollingBaseline, METRICS
+
+# Rows of the (windows x metrics x history) cube processed at once
+CHUNK_ROWS = 4096
+
+NOISE_FLOORS = np.array([floor for _, _, floor in METRICS])
+Z_KEYS = [z_key for _, z_key, _ in METRICS]
+
+
+def metric_matrix(windows):
+    """(n_windows x 8) array of the values RollingBaseline tracks, in METRICS order."""
+    if not windows:
+        return np.empty((0, len(METRICS)))
+    return np.array([RollingBaseline._values(w) for w in windows], dtype=float)
+
+
+def rolling_z_scores(values, max_windows, warmup, noise_floors=NOISE_FLOORS):
+    """
+    Z-scores for a whole window series at once, identical to feeding the
+    windows one by one through a fresh RollingBaseline (evaluate, then
+    update). Row i is scored against rows max(0, i - max_windows) .. i - 1.
+
+    Returns (z, ready): z is (n x 8), ready[i] is False where evaluate()
+    would still have returned None (warmup).
+    """
+    n, width = values.shape
+    history_len = np.minimum(np.arange(n), max_windows)
+    ready = history_len >= warmup
+
+    # NaN padding lets every row see exactly max_windows slots of history
+    padded = np.vstack([np.full((max_windows, width), np.nan), values])
+    z = np.zeros((n, width))
+    if max_windows < 3:
+        return z, ready
+
+    # _safe_z returns 0 until there are at least 3 points of history, so
+    # scoring starts at row 3. Rows before max_windows still have NaN
+    # padding and need nanmedian; the rest use the much faster median.
+    full_from = min(max(3, max_windows), n)
+    segments = [(3, full_from, np.nanmedian)] + [
+        (start, min(start + CHUNK_ROWS, n), np.median) for start in range(full_from, n, CHUNK_ROWS)
+    ]
+
+    for start, stop, median_fn in segments:
+        if start >= stop:
+            continue
+        # history[i, m, :] = previous max_windows values of metric m before row i
+        history = sliding_window_view(padded[start:stop + max_windows - 1], max_windows, axis=0)
+
+        median = median_fn(history, axis=2)
+        mad = median_fn(np.abs(history - median[:, :, None]), axis=2)
+
+        consistent_mad = mad * 1.4826
+        consistent_mad = np.where(consistent_mad < noise_floors, noise_floors, consistent_mad)
+        z[start:stop] = np.clip((values[start:stop] - median) / consistent_mad, -20.0, 20.0)
+
+    return z, ready
+
+
+def _dampen(z, noise_floor=NOISE_FLOOR):
+    magnitude = np.abs(z)
+    return np.where(magnitude > noise_floor, magnitude, magnitude * 0.1)
+
+
+def coordination_scores(z, weights=WEIGHTS, robotic_threshold=ROBOTIC_THRESHOLD,
+                        robotic_multiplier=ROBOTIC_PENALTY_MULTIPLIER, noise_floor=NOISE_FLOOR):
+    """Vectorized RollingBaseline.coordination_score over rows of z (unrounded)."""
+    column = {key: z[:, i] for i, key in enumerate(Z_KEYS)}
+
+    gap_signal = _dampen(column["gap_var_z"], noise_floor)
+    gap_signal = np.where(column["gap_var_z"] < robotic_threshold, gap_signal * robotic_multiplier, gap_signal)
+
+    # Same operation order as coordination_score so results match bit for bit
+    return (
+            _dampen(column["concentration_z"], noise_floor) * weights.get("concentration", 0.4) +
+            gap_signal * weights.get("gap_variance", 0.3) +
+            _dampen(column["sentiment_var_z"], noise_floor) * weights.get("sentiment_var", 0.2) +
+            _dampen(column["count_z"], noise_floor) * weights.get("count", 0.1)
+    )
+
+
+# classify_alerts rules in the order they are checked (the volume guard is not a rule)
+ALERT_RULES = ("automated_timing", "coordinated_sentiment", "volume_anomaly", "high_frequency_spam",
+               "templated_campaign")
+
+
+def alert_flags(z, totals, duplicates, thresholds=ALERT_THRESHOLDS):
+    """
+    (n x len(ALERT_RULES)) booleans: which classify_alerts rules fire for
+    each row of z, given each window's total_comments and
+    duplicate_comments. Rows still in warmup must be masked by the caller.
+    """
+    t = thresholds
+    column = {key: z[:, i] for i, key in enumerate(Z_KEYS)}
+    flags = np.column_stack([
+        column["gap_var_z"] < t["gap_var_z"],
+        (np.abs(column["sentiment_z"]) > t["sentiment_z"]) & (column["sentiment_var_z"] < t["sentiment_var_z"]),
+        (column["count_z"] > t["count_z"]) & (column["author_z"] < t["author_z"]),
+        column["concentration_z"] > t["concentration_z"],
+        (duplicates >= t["min_duplicates"]) & (duplicates / np.maximum(totals, 1) >= t["duplicate_ratio"]),
+    ])
+    return flags & (totals >= t["min_comments"])[:, None]
+
+
+def score_window_series(windows, max_windows, warmup):
+    """
+    Bulk equivalent of the replay loop. Returns one (z_dict or None, score)
+    pair per window, where score is 0.0 for warmup windows like the loop.
+    """
+    z, ready = rolling_z_scores(metric_matrix(windows), max_windows, warmup)
+    scores = coordination_scores(z)
+
+    results = []
+    for i in range(len(windows)):
+        if not ready[i]:
+            results.append((None, 0.0))
+            continue
+        z_dict = {key: float(z[i, j]) for j, key in enumerate(Z_KEYS)}
+        results.append((z_dict, round(float(scores[i]), 4)))
+    return results
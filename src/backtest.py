@@ -0,0 +1,236 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from config import (WEIGHTS, NOISE_FLOOR, ROBOTIC_THRESHOLD, ROBOTIC_PENALTY_MULTIPLIER, MAX_WINDOWS, WARMUP_PERIOD,
+                    ALERT_THRESHOLDS, POLL_INTERVAL, BACKTEST_WORKERS, BACKTEST_CHUNK_CONFIGS)
+from analysis.vectorized import rolling_z_scores, coordination_scores, alert_flags, metric_matrix, ALERT_RULES
+
+# Parameter sweeps over the detection settings. Window series are loaded
+# once, packed into one float64 matrix in shared memory and attached (not
+# copied) by every worker. Z-scores only depend on max_windows, so each
+# worker computes them once per distinct value and reuses them for every
+# weight, noise floor, warmup and threshold combination it is handed.
+
+# A sweep config is this dict with some values replaced
+BASE_CONFIG = {
+    "max_windows": MAX_WINDOWS,
+    "warmup": WARMUP_PERIOD,
+    "noise_floor": NOISE_FLOOR,
+    "robotic_threshold": ROBOTIC_THRESHOLD,
+    "robotic_multiplier": ROBOTIC_PENALTY_MULTIPLIER,
+    "weights": WEIGHTS,
+    "thresholds": ALERT_THRESHOLDS,
+}
+
+# Packed matrix columns: the 8 baseline metrics (METRICS order), then duplicate_comments
+DUPLICATES_COLUMN = 8
+
+# Set in each worker by _attach
+_shm = None
+_series = None
+_spans = None
+_z_cache = {}
+
+
+def expand_grid(grid):
+    """
+    Cartesian product of a grid spec over BASE_CONFIG. Keys are config
+    names, or "weights.<name>" / "thresholds.<name>" for single entries:
+        {"max_windows": [20, 40], "thresholds.count_z": [2.0, 2.5]} -> 4 configs
+    """
+    keys = list(grid)
+    configs = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        config = {key: dict(value) if isinstance(value, dict) else value for key, value in BASE_CONFIG.items()}
+        for key, value in zip(keys, values):
+            section, _, name = key.partition(".")
+            if section not in config:
+                raise KeyError(f"Unknown backtest parameter {key!r}")
+            if name:
+                config[section][name] = value
+            else:
+                config[section] = value
+        configs.append(config)
+    return configs
+
+
+def load_windows(video_ids=None, polling_rate=POLL_INTERVAL, parquet_root=None):
+    """
+    {video_id: [window metrics dicts, oldest first]}, from the database or,
+    with `parquet_root`, from a columnar.export() copy of it.
+    """
+    if parquet_root:
+        import columnar
+        comments = columnar.read_table("comments", parquet_root, video_ids,
+                                       columns=["video_id", "author_id", "sentiment", "text_length",
+                                                "published_ts", "cluster_id", "duplicate"])
+        rows = columnar.window_metrics_frame(comments, polling_rate).to_dict("records")
+    else:
+        from database import get_all_window_metrics
+        rows = []
+        for video_id in video_ids or [None]:
+            rows.extend(get_all_window_metrics(video_id, polling_rate))
+
+    windows = defaultdict(list)
+    for row in rows:
+        windows[row["video_id"]].append(row)
+    return dict(windows)
+
+
+def pack(windows):
+    """(matrix, spans, labels): one row per window, spans[i] = (start, stop) of video i, labels[row] = (video, window)."""
+    blocks, spans, labels = [], [], []
+    row = 0
+    for video_id, series in windows.items():
+        duplicates = np.array([w.get("duplicate_comments", 0) or 0 for w in series], dtype=float)
+        blocks.append(np.column_stack([metric_matrix(series), duplicates]))
+        spans.append((row, row + len(series)))
+        labels.extend((video_id, w["window"]) for w in series)
+        row += len(series)
+
+    matrix = np.vstack(blocks) if blocks else np.empty((0, DUPLICATES_COLUMN + 1))
+    return np.ascontiguousarray(matrix, dtype=float), spans, labels
+
+
+def _attach(shm_name, shape, spans):
+    """Worker initializer: maps the shared window matrix without copying it."""
+    global _shm, _series, _spans
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _series = np.ndarray(shape, dtype=float, buffer=_shm.buf)
+    _spans = spans
+
+
+def _z_for(max_windows):
+    """Stacked z-scores and per-row history length for every video (one max_windows cached at a time)."""
+    if max_windows not in _z_cache:
+        _z_cache.clear()
+        zs, history = [], []
+        for start, stop in _spans:
+            # warmup only decides which rows count, so it is applied per config
+            z, _ = rolling_z_scores(_series[start:stop, :DUPLICATES_COLUMN], max_windows, 0)
+            zs.append(z)
+            history.append(np.minimum(np.arange(stop - start), max_windows))
+        _z_cache[max_windows] = (np.vstack(zs) if zs else np.empty((0, DUPLICATES_COLUMN)),
+                                 np.concatenate(history) if history else np.empty(0, dtype=int))
+    return _z_cache[max_windows]
+
+
+def evaluate_config(config, keep_alerts=False):
+    """Alert counts, per-rule counts and the coordination-score distribution for one config."""
+    z, history = _z_for(config["max_windows"])
+    ready = history >= config["warmup"]
+
+    scores = coordination_scores(z, config["weights"], config["robotic_threshold"], config["robotic_multiplier"],
+                                 config["noise_floor"])[ready]
+    flags = alert_flags(z, _series[:, 0], _series[:, DUPLICATES_COLUMN], config["thresholds"]) & ready[:, None]
+    fired = flags.any(axis=1)
+
+    result = {
+        "config": config,
+        "windows": int(ready.sum()),
+        "alerts": int(fired.sum()),
+        "rule_counts": {rule: int(n) for rule, n in zip(ALERT_RULES, flags.sum(axis=0))},
+        "score": {
+            "mean": round(float(scores.mean()), 4) if len(scores) else 0.0,
+            **{f"p{q}": round(float(np.percentile(scores, q)), 4) if len(scores) else 0.0 for q in (50, 90, 99)},
+            "max": round(float(scores.max()), 4) if len(scores) else 0.0,
+        },
+    }
+    if keep_alerts:
+        # Row index and a bitmask of ALERT_RULES; the parent turns them into labels
+        masks = flags[fired] @ (1 << np.arange(len(ALERT_RULES)))
+        result["fired"] = list(zip(np.flatnonzero(fired).tolist(), masks.tolist()))
+    return result
+
+
+def _evaluate_chunk(configs, keep_alerts):
+    return [evaluate_config(config, keep_alerts) for config in configs]
+
+
+def run_sweep(configs, windows, workers=BACKTEST_WORKERS, chunk=BACKTEST_CHUNK_CONFIGS, keep_alerts=False):
+    """
+    Evaluates every config against the same window series, in parallel.
+    Results come back in the order of `configs`; with keep_alerts each has
+    "fired": [(video_id, window, [rules])] for every alerting window.
+    """
+    global _series, _spans
+    matrix, spans, labels = pack(windows)
+    workers = workers or os.cpu_count() or 1
+
+    # Neighbouring configs share max_windows, so each worker reuses its z-scores
+    order = sorted(range(len(configs)), key=lambda i: configs[i]["max_windows"])
+    chunks = [order[i:i + chunk] for i in range(0, len(order), chunk)]
+    results = [None] * len(configs)
+
+    if workers == 1 or len(chunks) == 1:
+        # Not worth starting processes: evaluate in place
+        _series, _spans = matrix, spans
+        _z_cache.clear()
+        for ids in chunks:
+            for i, result in zip(ids, _evaluate_chunk([configs[i] for i in ids], keep_alerts)):
+                results[i] = result
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+        try:
+            np.ndarray(matrix.shape, dtype=float, buffer=shm.buf)[:] = matrix
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_attach,
+                                     initargs=(shm.name, matrix.shape, spans)) as pool:
+                futures = [(ids, pool.submit(_evaluate_chunk, [configs[i] for i in ids], keep_alerts))
+                           for ids in chunks]
+                for ids, future in futures:
+                    for i, result in zip(ids, future.result()):
+                        results[i] = result
+        finally:
+            shm.close()
+            shm.unlink()
+
+    if keep_alerts:
+        for result in results:
+            result["fired"] = [
+                (*labels[row], [rule for bit, rule in enumerate(ALERT_RULES) if mask >> bit & 1])
+                for row, mask in result["fired"]
+            ]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtests a grid of detection settings on stored windows.")
+    parser.add_argument("grid", help='Path to a JSON grid file, or the JSON itself, '
+                                     'e.g. {"max_windows": [20, 40], "thresholds.count_z": [2, 3]}')
+    parser.add_argument("--video", action="append", help="Only these videos (repeatable)")
+    parser.add_argument("--parquet", help="Read windows from this Parquet export instead of the database")
+    parser.add_argument("--workers", type=int, default=BACKTEST_WORKERS)
+    parser.add_argument("--alerts", action="store_true", help="Include every alerting window in the results")
+    parser.add_argument("--output", default="backtest_results.jsonl")
+    args = parser.parse_args()
+
+    if os.path.exists(args.grid):
+        with open(args.grid) as f:
+            configs = expand_grid(json.load(f))
+    else:
+        configs = expand_grid(json.loads(args.grid))
+
+    if not args.parquet:
+        from database import init_db
+        init_db()
+
+    start = time.perf_counter()
+    windows = load_windows(args.video, parquet_root=args.parquet)
+    print(f"Loaded {sum(len(s) for s in windows.values())} windows from {len(windows)} videos "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    results = run_sweep(configs, windows, workers=args.workers, keep_alerts=args.alerts)
+    print(f"Evaluated {len(configs)} configs in {time.perf_counter() - start:.1f}s -> {args.output}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
@@ -0,0 +1,92 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeYouTubeAPI:
+    """
+    Local stand-in for the commentThreads endpoint (config.YTAPIURL).
+
+    Serves pre-generated items per videoId in pages of maxResults, with
+    nextPageToken pagination, and sleeps `latency` (+ up to `jitter`)
+    seconds per request to mimic the network. Use as a context manager;
+    `url` is what ingestion.YTAPIURL should point at.
+    """
+
+    def __init__(self, videos, latency=0.0, jitter=0.0, seed=0):
+        self.videos = videos
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/youtube/v3/commentThreads"
+
+    def page(self, video_id, page_token=None, max_results=100):
+        """The JSON body the real API would return for this request."""
+        items = self.videos.get(video_id, [])
+        offset = int(page_token or 0)
+        body = {"kind": "youtube#commentThreadListResponse", "items": items[offset:offset + max_results]}
+        if offset + max_results < len(items):
+            body["nextPageToken"] = str(offset + max_results)
+        return body
+
+    def _delay(self):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like googleapis.com
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/youtube/v3/commentThreads":
+                    self.send_error(404)
+                    return
+
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                api._delay()
+                payload = json.dumps(api.page(query.get("videoId"), query.get("pageToken"),
+                                              int(query.get("maxResults", 100)))).encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass  # One line per page would drown the results
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
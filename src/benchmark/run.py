@@ -0,0 +1,175 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+import database
+import ingestion
+from config import POLL_INTERVAL, STREAM_FLUSH_COMMENTS, EMBED_AT_INGEST, ANN_ENABLED
+from benchmark.synthetic import generate_fleet
+from benchmark.fakeapi import FakeYouTubeAPI
+
+# Usage (from src/):
+#   python -m benchmark.run --videos 4 --comments 20000 --latency 0.05
+# Every scenario appends one JSON line to --output, so runs from different
+# commits can be compared with any JSON tool.
+
+API_KEY = "benchmark"
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    """Times scenarios and appends one result line per scenario to a JSONL file."""
+
+    def __init__(self, output, params):
+        self.output = output
+        self.base = {
+            "run_id": datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "params": params,
+        }
+        self.results = []
+
+    @contextlib.contextmanager
+    def scenario(self, name, items=0):
+        """
+        Times the block. Inside it, set result["items"] if the count is only
+        known afterwards, or result["seconds"] to report a narrower timing.
+        """
+        result = {"scenario": name, "items": items}
+        # Alerts and progress lines go to a buffer so they don't distort the timing
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            yield result
+            result.setdefault("seconds", round(time.perf_counter() - start, 6))
+
+        result["per_second"] = round(result["items"] / result["seconds"], 2) if result["seconds"] else None
+        self.results.append(result)
+        with open(self.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**self.base, **result}) + "\n")
+        print(f"{name:<28} {result['seconds']:>10.3f}s {result['items']:>10} items "
+              f"{result['per_second'] or 0:>12.1f}/s")
+
+
+def run(videos=1, comments=10000, hours=24, floods=1, latency=0.0, jitter=0.0, real_models=False,
+        output="benchmark_results.jsonl"):
+    params = {"videos": videos, "comments": comments, "hours": hours, "floods": floods, "latency": latency,
+              "jitter": jitter, "models": "real" if real_models else "stub"}
+    if not real_models:
+        from benchmark import stubs
+        stubs.install()
+
+    # Imported after the stubs so nothing has loaded a real model yet
+    from main import sentiment_cache, replay_historical
+    from analysis.embeddings import embed_comments
+    from analysis.rollingbaseline import create_baseline
+    from analysis.abnormal_patterns import classify_alerts, detect_abnormal_patterns
+    from analysis.ann import get_index
+
+    fleet = generate_fleet(videos, comments, hours, floods)
+    recorder = Recorder(output, params)
+    total_items = sum(len(items) for items in fleet.values())
+    print(f"Benchmark: {videos} video(s), {total_items} comments, {params['models']} models -> {output}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database.DB_PATH = os.path.join(workdir, "benchmark.db")
+        database.init_db()
+
+        # 1. Ingestion against the local API stand-in
+        with FakeYouTubeAPI(fleet, latency=latency, jitter=jitter) as api:
+            ingestion.YTAPIURL = api.url
+            ingestion.quota_budget = ingestion.QuotaBudget(daily_units=10 ** 9)
+
+            fetched = {}
+            with recorder.scenario("fetch_all_comments", total_items):
+                for video_id in fleet:
+                    fetched[video_id] = ingestion.fetch_all_comments(API_KEY, video_id)
+
+            with recorder.scenario("fetch_all_comments_concurrent", total_items):
+                ingestion.fetch_all_comments_concurrent(API_KEY, list(fleet),
+                                                        quota=ingestion.QuotaBudget(daily_units=10 ** 9))
+            # Its pooled connections point at the stand-in, which is about to go away
+            ingestion.close_fetcher()
+
+        # 2. Model work, then storage
+        parsed = [c for video_id, items in fetched.items()
+                  for c in (ingestion.parse_comment(item, video_id) for item in items) if c]
+        with recorder.scenario("score_comments", len(parsed)):
+            scores = sentiment_cache.score([c["text"] for c in parsed])
+            for comment, score in zip(parsed, scores):
+                comment["sentiment"] = score
+            if EMBED_AT_INGEST:
+                embed_comments(parsed)
+
+        with recorder.scenario("insert_comments_batch", len(parsed)):
+            for i in range(0, len(parsed), STREAM_FLUSH_COMMENTS):
+                database.insert_comments_batch(parsed[i:i + STREAM_FLUSH_COMMENTS])
+
+        # 3. Window reads and replay
+        with recorder.scenario("get_all_window_metrics") as result:
+            windows = {video_id: database.get_all_window_metrics(video_id, POLL_INTERVAL) for video_id in fleet}
+            result["items"] = sum(len(w) for w in windows.values())
+
+        with recorder.scenario("replay_historical", sum(len(w) for w in windows.values())):
+            for video_id in fleet:
+                replay_historical(create_baseline(), video_id)
+
+        # 4. The per-window baseline step of the live loop
+        alerting = []
+        with recorder.scenario("rolling_baseline_evaluate", sum(len(w) for w in windows.values())) as result:
+            evaluate_seconds = 0.0
+            for video_id, series in windows.items():
+                baseline = create_baseline()
+                for w in series:
+                    start = time.perf_counter()
+                    z = baseline.evaluate(w)
+                    evaluate_seconds += time.perf_counter() - start
+                    if z:
+                        w["coordination_score"] = baseline.coordination_score(z)
+                        if classify_alerts(z, w):
+                            alerting.append((z, w, video_id))
+                    baseline.update(w)
+            # Only evaluate() itself, not the updates and alert checks around it
+            result["seconds"] = round(evaluate_seconds, 6)
+
+        # 5. Alert forensics (evidence queries, similarity, narrative history)
+        if ANN_ENABLED:
+            index = get_index()
+            index.sync()
+            index.maybe_rebuild()
+        with recorder.scenario("detect_abnormal_patterns", len(alerting)):
+            for z, w, video_id in alerting:
+                detect_abnormal_patterns(z, w, video_id)
+
+        database.close_connection()
+
+    return recorder.results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the pipeline stages on synthetic comment data.")
+    parser.add_argument("--videos", type=int, default=1)
+    parser.add_argument("--comments", type=int, default=10000, help="Organic comments per video")
+    parser.add_argument("--hours", type=float, default=24, help="Time span of each video's comments")
+    parser.add_argument("--floods", type=int, default=1, help="Bot campaigns per video")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API page")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency, up to this many seconds")
+    parser.add_argument("--real-models", action="store_true", help="Use the real sentiment/similarity models")
+    parser.add_argument("--output", default="benchmark_results.jsonl")
+    args = parser.parse_args()
+
+    run(args.videos, args.comments, args.hours, args.floods, args.latency, args.jitter, args.real_models,
+        args.output)
@@ -0,0 +1,51 @@
+import zlib
+import numpy as np
+from analysis.models import registry
+import analysis.sentiment  # Register the real loaders first so the stubs replace them
+import analysis.similarity
+
+# Deterministic, dependency-free stand-ins for the two models. They keep
+# the real call signatures, so everything downstream of the model (batch
+# planning, caching, storage, similarity maths) is still measured.
+
+EMBEDDING_DIM = 384  # all-MiniLM-L6-v2
+
+
+class StubTokenizer:
+    def __call__(self, texts, truncation=True, max_length=512):
+        return {"input_ids": [[0] * min(len(t.split()) + 2, max_length) for t in texts]}
+
+
+class StubSentiment:
+    """Callable like a transformers text-classification pipeline."""
+
+    def __init__(self):
+        self.tokenizer = StubTokenizer()
+
+    def __call__(self, texts, **kwargs):
+        results = []
+        for text in texts:
+            h = zlib.crc32(text.encode("utf-8"))
+            results.append({"label": "POSITIVE" if h & 1 else "NEGATIVE", "score": 0.5 + (h % 500) / 1000})
+        return results
+
+
+class StubSimilarity:
+    """encode() like a SentenceTransformer: one pseudo-random vector per distinct text."""
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False, convert_to_numpy=True,
+               convert_to_tensor=False, **kwargs):
+        vectors = np.stack([
+            np.random.default_rng(zlib.crc32(t.encode("utf-8"))).standard_normal(EMBEDDING_DIM, dtype=np.float32)
+            for t in texts
+        ]) if texts else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+def install():
+    """Swaps the stubs in for the real sentiment and similarity models."""
+    registry.unload("sentiment", "similarity")
+    registry.register("sentiment", StubSentiment)
+    registry.register("similarity", StubSimilarity)
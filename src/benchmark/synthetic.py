@@ -0,0 +1,105 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+# Synthetic comment threads in the exact shape commentThreads.list returns,
+# so they go through parse_comment and the rest of the pipeline unchanged.
+
+WORDS = (
+    "great video love this song finally someone said it the editing is insane who is watching in "
+    "can't believe how good this was part two please underrated channel my favourite moment was "
+    "when they laughed honestly this deserves more views came here from the podcast agree disagree "
+    "what about the ending thanks for sharing learned a lot today the sound mix is off at the start"
+).split()
+
+TEMPLATES = (
+    "Everyone needs to see this, {name} is {adj}! Share before it gets taken down",
+    "{name} has always been {adj}, the media won't tell you this #{tag}",
+    "Wake up people, {name} is {adj} and this video proves it #{tag}",
+)
+TEMPLATE_SLOTS = {
+    "name": ("the senator", "this channel", "the company", "the mayor"),
+    "adj": ("lying", "a fraud", "corrupt", "finished"),
+    "tag": ("truth", "exposed", "wakeup"),
+}
+
+
+def bot_flood(start_hour, minutes=30, bots=20, interval=45.0, jitter=2.0, templates=TEMPLATES):
+    """
+    One coordinated campaign: `bots` accounts each posting every `interval`
+    seconds (+/- `jitter`, "metronome" timing) for `minutes`, starting
+    `start_hour` hours into the video, with slot-filled template text.
+    """
+    return {"start_hour": start_hour, "minutes": minutes, "bots": bots, "interval": interval,
+            "jitter": jitter, "templates": templates}
+
+
+def _thread(comment_id, author_id, text, published):
+    return {
+        "id": comment_id,
+        "snippet": {
+            "topLevelComment": {
+                "snippet": {
+                    "authorChannelId": {"value": author_id},
+                    "textOriginal": text,
+                    "publishedAt": published.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                }
+            }
+        },
+    }
+
+
+def _organic_text(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(2, 25)))
+
+
+def _template_text(rng, templates):
+    slots = {key: rng.choice(values) for key, values in TEMPLATE_SLOTS.items()}
+    return rng.choice(templates).format(**slots)
+
+
+def generate_comments(video_id, comments=10000, hours=24, floods=(), authors=None, start=None, seed=0):
+    """
+    API items for one video, newest first like the real endpoint.
+
+    `comments` organic comments arrive at random times over `hours`, from
+    a heavy-tailed pool of `authors` (regulars comment far more often);
+    every entry of `floods` (see bot_flood) adds a bot campaign on top.
+    """
+    rng = random.Random(f"{video_id}:{seed}")
+    start = start or datetime(2024, 1, 1, tzinfo=timezone.utc)
+    authors = authors or max(comments // 3, 1)
+    span = hours * 3600
+    items = []
+
+    # 1. Organic traffic: uniform arrival times, Pareto-weighted authors
+    author_weights = [1.0 / (i + 1) for i in range(authors)]
+    author_ids = rng.choices(range(authors), weights=author_weights, k=comments)
+    for i, author in enumerate(author_ids):
+        published = start + timedelta(seconds=rng.uniform(0, span))
+        items.append(_thread(f"{video_id}-c{i}", f"UC-user-{author}", _organic_text(rng), published))
+
+    # 2. Bot floods: fixed cadence per bot, templated text
+    for f, flood in enumerate(floods):
+        flood_start = start + timedelta(hours=flood["start_hour"])
+        for bot in range(flood["bots"]):
+            t = rng.uniform(0, flood["interval"])  # Bots don't all fire on the same second
+            n = 0
+            while t < flood["minutes"] * 60:
+                published = flood_start + timedelta(seconds=t)
+                items.append(_thread(f"{video_id}-f{f}-b{bot}-{n}", f"UC-bot-{f}-{bot}",
+                                     _template_text(rng, flood["templates"]), published))
+                t += flood["interval"] + rng.uniform(-flood["jitter"], flood["jitter"])
+                n += 1
+
+    items.sort(key=lambda item: item["snippet"]["topLevelComment"]["snippet"]["publishedAt"], reverse=True)
+    return items
+
+
+def generate_fleet(videos=1, comments=10000, hours=24, floods_per_video=1, seed=0):
+    """{video_id: items} for `videos` videos with evenly spaced bot floods."""
+    fleet = {}
+    for v in range(videos):
+        floods = [bot_flood(start_hour=hours * (i + 1) / (floods_per_video + 1)) for i in range(floods_per_video)]
+        video_id = f"bench{v:05d}"
+        fleet[video_id] = generate_comments(video_id, comments, hours, floods, seed=seed)
+    return fleet
@@ -0,0 +1,278 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import numpy as np
+import pandas as pd
+import database
+from config import POLL_INTERVAL, MAX_WINDOWS, WARMUP_PERIOD, PARQUET_DIR, EXPORT_CHUNK_ROWS
+from analysis.vectorized import rolling_z_scores, coordination_scores, Z_KEYS
+
+# Offline analytics over Parquet copies of `comments` and `window_metrics`,
+# partitioned as <root>/<table>/video_id=<id>/day=<YYYY-MM-DD>/*.parquet.
+# export() is the only function that reads SQLite (through its own read-only
+# connection); everything else works from the files, so research reruns
+# never contend with the live monitor. pyarrow is an optional dependency.
+
+STATE_FILE = "_export_state.json"
+
+COMMENT_COLUMNS = """
+    s.seq, c.comment_id, c.video_id, c.author_id, c.text, LENGTH(c.text) AS text_length, c.sentiment,
+    c.published_ts, c.fetched_ts, cc.cluster_id, cc.duplicate
+"""
+WINDOW_COLUMNS = ("video_id", "window_ts", "total_comments", "unique_authors", "avg_length", "avg_sentiment",
+                  "sentiment_variance", "avg_gap", "gap_variance", "coordination_score", "duplicate_comments",
+                  "duplicate_clusters")
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+
+def default_root():
+    return PARQUET_DIR or os.path.join(os.path.dirname(database.DB_PATH), "parquet")
+
+
+def _partitioning(pa):
+    # Explicit string types: hive inference would turn numeric-looking video IDs into ints
+    return pa.dataset.partitioning(pa.schema([("video_id", pa.string()), ("day", pa.string())]), flavor="hive")
+
+
+def _day(ts):
+    """'YYYY-MM-DD' (UTC) for each epoch second; None where the timestamp is missing."""
+    days = pd.to_datetime(ts, unit="s", utc=True).dt.strftime("%Y-%m-%d")
+    return days.where(ts.notna(), None)
+
+
+def _load_state(root):
+    path = os.path.join(root, STATE_FILE)
+    if not os.path.exists(path):
+        return {"comments_seq": 0, "clusters_version": None, "windows_seq": 0, "windows_version": None}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(root, state):
+    # Written last and atomically: an interrupted export is simply redone
+    tmp = os.path.join(root, STATE_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, os.path.join(root, STATE_FILE))
+
+
+def _write(pa, frame, directory, basename, time_column, replace=False):
+    frame = frame.assign(day=_day(frame[time_column]))
+    pa.dataset.write_dataset(
+        pa.Table.from_pandas(frame, preserve_index=False), directory, format="parquet",
+        partitioning=_partitioning(pa), basename_template=basename + "-{i}.parquet",
+        # replace: a written (video, day) partition loses its old files first
+        existing_data_behavior="delete_matching" if replace else "overwrite_or_ignore",
+    )
+
+
+def export(root=None, full=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Incrementally copies the database into Parquet under `root`.
+
+    comments are append-only, so only rows past the last exported
+    comment_seq are written, as new files. They are all rewritten when the
+    duplicate index was rebuilt since (clusters are exported with them).
+    window_metrics rows are upserted (late comments rescore old windows),
+    so every (video, day) partition holding a window written since the
+    last export (by window_updates seq) is rewritten whole. All of them are
+    rewritten after a window resize. full=True starts from scratch.
+    Returns {"comments": n, "windows": n}.
+    """
+    pa = _pyarrow()
+    root = root or default_root()
+    state = _load_state(root)
+    os.makedirs(root, exist_ok=True)
+
+    conn = sqlite3.connect(f"file:{database.DB_PATH}?mode=ro", uri=True)
+    exported = {"comments": 0, "windows": 0}
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'clusters_version'").fetchone()
+        clusters_version = int(row[0]) if row else None
+        # Exports from before comment_seq were keyed on comments.rowid
+        if full or "comments_seq" not in state or state["clusters_version"] != clusters_version:
+            shutil.rmtree(os.path.join(root, "comments"), ignore_errors=True)
+            state["comments_seq"] = 0
+        row = conn.execute("SELECT value FROM meta WHERE key = 'windows_version'").fetchone()
+        windows_version = int(row[0]) if row else None
+        # Exports from before window_updates only tracked the last day per video
+        if full or "windows_seq" not in state or state["windows_version"] != windows_version:
+            shutil.rmtree(os.path.join(root, "window_metrics"), ignore_errors=True)
+            state["windows_seq"] = 0
+
+        # 1. Comments: new seqs only, in chunks, each chunk its own files
+        last_seq = state["comments_seq"]
+        while True:
+            frame = pd.read_sql_query(f"""
+                SELECT {COMMENT_COLUMNS}
+                FROM comment_seq s
+                JOIN comments c USING (comment_id)
+                LEFT JOIN comment_clusters cc USING (comment_id)
+                WHERE s.seq > ?
+                ORDER BY s.seq
+                LIMIT ?
+            """, conn, params=(last_seq, chunk_rows))
+            if frame.empty:
+                break
+            _write(pa, frame.drop(columns="seq"), os.path.join(root, "comments"), f"part-{last_seq + 1}",
+                   "published_ts")
+            last_seq = int(frame["seq"].iloc[-1])
+            exported["comments"] += len(frame)
+
+        # 2. Window metrics: every partition with a window written since the last export.
+        # Windows written while this runs get a seq above windows_seq and go out next time.
+        windows_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM window_updates").fetchone()[0]
+        changed = {}
+        for video_id, day in conn.execute("""
+            SELECT DISTINCT video_id, window_ts - window_ts % 86400
+            FROM window_updates
+            WHERE seq > ? AND seq <= ?
+        """, (state["windows_seq"], windows_seq)):
+            changed.setdefault(video_id, []).append(day)
+
+        for video_id, days in changed.items():
+            frame = pd.concat([
+                pd.read_sql_query(
+                    f"""SELECT {', '.join(WINDOW_COLUMNS)} FROM window_metrics
+                        WHERE video_id = ? AND window_ts >= ? AND window_ts < ?""",
+                    conn, params=(video_id, day, day + 86400))
+                for day in sorted(days)
+            ], ignore_index=True)
+            if frame.empty:
+                continue
+            _write(pa, frame, os.path.join(root, "window_metrics"), "part-0", "window_ts", replace=True)
+            exported["windows"] += len(frame)
+    finally:
+        conn.close()
+
+    _save_state(root, {"comments_seq": last_seq, "clusters_version": clusters_version,
+                       "windows_seq": windows_seq, "windows_version": windows_version})
+    return exported
+
+
+def read_table(table, root=None, video_ids=None, start_day=None, end_day=None, columns=None):
+    """
+    One exported table as a DataFrame. Filters on video_id and day
+    ('YYYY-MM-DD', inclusive) only open the matching partitions.
+    """
+    pa = _pyarrow()
+    dataset = pa.dataset.dataset(os.path.join(root or default_root(), table), format="parquet",
+                                 partitioning=_partitioning(pa))
+
+    field = pa.dataset.field
+    conditions = []
+    if video_ids:
+        conditions.append(field("video_id").isin(list(video_ids)))
+    if start_day:
+        conditions.append(field("day") >= start_day)
+    if end_day:
+        conditions.append(field("day") <= end_day)
+
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def window_metrics_frame(comments, polling_rate=POLL_INTERVAL):
+    """
+    Vectorized get_all_window_metrics over a comments DataFrame (needs
+    video_id, author_id, sentiment, text_length, published_ts, cluster_id
+    and duplicate). Same definitions as the SQL scan: gaps run across
+    window edges, variances are population variances clamped at 0.
+    """
+    frame = comments[comments["published_ts"].notna()].sort_values(["video_id", "published_ts"], kind="stable")
+    frame = frame.assign(
+        window_ts=(frame["published_ts"] // polling_rate * polling_rate).astype("int64"),
+        gap=frame.groupby("video_id", sort=False)["published_ts"].diff(),
+        duplicate=frame["duplicate"].fillna(0),
+    )
+    frame["sentiment_sq"] = frame["sentiment"] ** 2
+    frame["gap_sq"] = frame["gap"] ** 2
+    frame["duplicate_cluster"] = frame["cluster_id"].where(frame["duplicate"] == 1)
+
+    grouped = frame.groupby(["video_id", "window_ts"], sort=False)
+    windows = grouped.agg(
+        total_comments=("published_ts", "size"),
+        unique_authors=("author_id", "nunique"),
+        avg_length=("text_length", "mean"),
+        avg_sentiment=("sentiment", "mean"),
+        sentiment_sq=("sentiment_sq", "mean"),
+        avg_gap=("gap", "mean"),
+        gap_sq=("gap_sq", "mean"),
+        duplicate_comments=("duplicate", "sum"),
+        duplicate_clusters=("duplicate_cluster", "nunique"),
+    ).reset_index()
+
+    windows["sentiment_variance"] = (windows.pop("sentiment_sq") - windows["avg_sentiment"] ** 2).clip(lower=0.0)
+    windows["gap_variance"] = (windows.pop("gap_sq") - windows["avg_gap"] ** 2).clip(lower=0.0)
+    windows = windows.fillna({"avg_length": 0, "avg_sentiment": 0, "sentiment_variance": 0.0, "avg_gap": 0,
+                              "gap_variance": 0.0})
+    windows["duplicate_comments"] = windows["duplicate_comments"].astype("int64")
+    windows["window"] = pd.to_datetime(windows["window_ts"], unit="s", utc=True).dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return windows.sort_values(["window_ts", "video_id"], kind="stable", ignore_index=True)
+
+
+def score_windows(windows, max_windows=MAX_WINDOWS, warmup=WARMUP_PERIOD):
+    """
+    Adds the baseline z-scores and coordination_score to a window frame,
+    per video, as a fresh RollingBaseline replay would (0 during warmup).
+    """
+    scored = []
+    for _, series in windows.sort_values(["video_id", "window_ts"], kind="stable").groupby("video_id", sort=False):
+        total = series["total_comments"].to_numpy(float)
+        authors = np.maximum(series["unique_authors"].to_numpy(float), 1)
+        # Same columns, same order as RollingBaseline._values
+        values = np.column_stack([
+            total, authors, series["avg_length"], series["avg_sentiment"], total / authors,
+            series["sentiment_variance"], series["avg_gap"], series["gap_variance"],
+        ]).astype(float)
+
+        z, ready = rolling_z_scores(values, max_windows, warmup)
+        series = series.assign(**{key: np.where(ready, z[:, i], np.nan) for i, key in enumerate(Z_KEYS)})
+        series["coordination_score"] = np.where(ready, np.round(coordination_scores(z), 4), 0.0)
+        scored.append(series)
+
+    if not scored:
+        return windows.assign(coordination_score=pd.Series(dtype=float))
+    return pd.concat(scored, ignore_index=True)
+
+
+def analyze(root=None, video_ids=None, start_day=None, end_day=None, polling_rate=POLL_INTERVAL):
+    """Window metrics and baseline scores for the selected range, straight from Parquet."""
+    comments = read_table("comments", root, video_ids, start_day, end_day,
+                          columns=["video_id", "author_id", "sentiment", "text_length", "published_ts",
+                                   "cluster_id", "duplicate"])
+    return score_windows(window_metrics_frame(comments, polling_rate))
+
+
+if __name__ == "__main__":
+    # python columnar.py export [--full]
+    # python columnar.py analyze [VIDEO_ID ...]
+    command = sys.argv[1] if len(sys.argv) > 1 else "export"
+    start = time.perf_counter()
+
+    if command == "export":
+        counts = export(full="--full" in sys.argv)
+        print(f"Exported {counts['comments']} comments and {counts['windows']} windows to {default_root()} "
+              f"in {time.perf_counter() - start:.1f}s")
+    elif command == "analyze":
+        result = analyze(video_ids=sys.argv[2:] or None)
+        print(f"{len(result)} windows scored in {time.perf_counter() - start:.2f}s")
+        top = result.nlargest(10, "coordination_score")
+        columns = ["video_id", "window", "total_comments", "unique_authors", "coordination_score"]
+        print(top[columns].to_string(index=False))
+    else:
+        print(f"Unknown command {command!r}: use export or analyze")
@@ -1,11 +1,45 @@
 import sqlite3
 import os
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from config import POLL_INTERVAL, MINHASH_THRESHOLD
+from analysis import minhash
+from instrumentation import timed, instrument, increment, set_gauge
 
 
 # Calculate the absolute path
 DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "comments.db"))
 
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",         # Enables concurrent Readers/Writers
+    "PRAGMA synchronous=NORMAL;",       # Reduces fsync() calls
+    "PRAGMA busy_timeout=5000;",        # Wait for other writers instead of failing
+    "PRAGMA cache_size=-65536;",        # 64 MB page cache per connection
+    "PRAGMA mmap_size=268435456;",      # Read through a 256 MB memory map
+    "PRAGMA temp_store=MEMORY;",        # Sorts and temp indexes stay off disk
+)
+
+# One connection per thread, reused for the life of the thread
+_local = threading.local()
+
+# Bumped whenever the on-disk layout changes; stored in PRAGMA user_version.
+# v2: timestamps are INTEGER epoch seconds instead of ISO text.
+# v3: near-duplicate clusters (MinHash LSH) and per-window duplicate counts.
+SCHEMA_VERSION = 3
+# Rows copied per transaction while migrating, so writers are never blocked for long
+MIGRATION_CHUNK_ROWS = 50000
+
+# Bucket size of the incremental window_aggregates table
+AGGREGATE_WINDOW = POLL_INTERVAL
+
+# window_aggregates columns in the order _metrics_from_aggregate unpacks them
+AGGREGATE_COLUMNS = """
+    video_id, window_ts, total_comments, unique_authors, sum_length, sum_sentiment,
+    sum_sentiment_sq, gap_count, sum_gap, sum_gap_sq, first_ts, last_ts,
+    duplicate_comments, duplicate_clusters
+"""
+
 METRIC_COLUMNS = """
     COUNT(*) AS total_comments,
     COUNT(DISTINCT author_id) AS unique_authors,
@@ -22,6 +56,11 @@ def init_db():
     conn = get_connection()
     cur = conn.cursor()
 
+    # Older databases keep their data; it is converted in place first
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < 2:
+        migrate_to_epoch_schema()
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS comments (
         comment_id TEXT PRIMARY KEY,
@@ -29,15 +68,15 @@ def init_db():
         author_id TEXT,
         text TEXT,
         sentiment REAL,
-        published_at TEXT,
-        fetched_at TEXT
+        published_ts INTEGER,       -- Epoch seconds (UTC)
+        fetched_ts INTEGER
     )
     """)
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS window_metrics(
             video_id TEXT,
-            window_start TEXT,
+            window_ts INTEGER,      -- Window start, epoch seconds
             total_comments INTEGER,
             unique_authors INTEGER,
             avg_length REAL,
@@ -46,55 +85,683 @@ def init_db():
             avg_gap REAL,           
             gap_variance REAL,      
             coordination_score REAL,
-            PRIMARY KEY (video_id, window_start)
+            duplicate_comments INTEGER,
+            duplicate_clusters INTEGER,
+            PRIMARY KEY (video_id, window_ts)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ingestion_state(
+            video_id TEXT PRIMARY KEY,
+            next_page_token TEXT,       -- Where to resume an unfinished backfill
+            newest_comment_id TEXT,     -- stop_at_id for the live loop
+            backfill_complete INTEGER DEFAULT 0,
+            updated_at TEXT,
+            closed_until INTEGER        -- Windows starting before this are scored (event-time watermark)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sentiment_cache(
+            text_hash TEXT PRIMARY KEY,     -- Hash of the normalized comment text
+            sentiment REAL
+        )
+    """)
+    # Sentence embeddings computed at ingest, reused by alert-time similarity.
+    # L2-normalized float16 vectors, 768 bytes each for MiniLM's 384 dims.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS comment_embeddings(
+            comment_id TEXT PRIMARY KEY,
+            vector BLOB
+        ) WITHOUT ROWID
+    """)
+    # Stable, ever-growing number per stored embedding: the ANN index's key
+    # and sync watermark. Declared INTEGER PRIMARY KEY so VACUUM keeps it.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_seq(
+            seq INTEGER PRIMARY KEY,
+            comment_id TEXT UNIQUE
+        )
+    """)
+    # Running sums per bucket, maintained at insert time (see _add_to_aggregates).
+    # Gap sums only cover gaps *inside* the bucket; the gap from the previous
+    # bucket's last comment is stitched in at read time via first_ts/last_ts.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS window_aggregates(
+            video_id TEXT,
+            window_ts INTEGER,          -- Bucket start, epoch seconds
+            total_comments INTEGER,
+            unique_authors INTEGER,
+            sum_length REAL,
+            sum_length_sq REAL,
+            sum_sentiment REAL,
+            sum_sentiment_sq REAL,
+            gap_count INTEGER,
+            sum_gap REAL,
+            sum_gap_sq REAL,
+            first_ts INTEGER,
+            last_ts INTEGER,
+            duplicate_comments INTEGER DEFAULT 0,   -- Comments matching an earlier comment's cluster
+            duplicate_clusters INTEGER DEFAULT 0,   -- Distinct clusters those comments belong to
+            PRIMARY KEY (video_id, window_ts)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS window_authors(
+            video_id TEXT,
+            window_ts INTEGER,
+            author_id TEXT,
+            PRIMARY KEY (video_id, window_ts, author_id)
+        ) WITHOUT ROWID
+    """)
+    # Near-duplicate index (see _add_to_clusters). A cluster is named after
+    # its first comment, whose MinHash signature is the one members are
+    # compared against. Each LSH band bucket points at the cluster whose
+    # first comment claimed it. Clusters span windows and videos.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cluster_signatures(
+            cluster_id TEXT PRIMARY KEY,
+            signature BLOB                  -- MINHASH_PERMUTATIONS uint64 values
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS lsh_buckets(
+            bucket INTEGER PRIMARY KEY,     -- Band index and band hash, see analysis.minhash.band_keys
+            cluster_id TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS comment_clusters(
+            comment_id TEXT PRIMARY KEY,
+            cluster_id TEXT,
+            duplicate INTEGER               -- 1 if it joined an existing cluster
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS window_clusters(
+            video_id TEXT,
+            window_ts INTEGER,
+            cluster_id TEXT,
+            PRIMARY KEY (video_id, window_ts, cluster_id)
+        ) WITHOUT ROWID
+    """)
+    # Closed windows that received late comments and must be rescored
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dirty_windows(
+            video_id TEXT,
+            window_ts INTEGER,
+            PRIMARY KEY (video_id, window_ts)
+        ) WITHOUT ROWID
+    """)
+    # Insertion order of comments, for incremental exports. Declared INTEGER
+    # PRIMARY KEY so VACUUM keeps it (comments.rowid is not guaranteed to survive)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS comment_seq(
+            seq INTEGER PRIMARY KEY,
+            comment_id TEXT UNIQUE
+        )
+    """)
+    # Last write of each window_metrics row, for incremental exports. AUTOINCREMENT so a
+    # rewritten window always gets a seq above every one handed out before
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS window_updates(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            video_id TEXT,
+            window_ts INTEGER,
+            UNIQUE (video_id, window_ts)
+        )
+    """)
+    # Settings the stored data depends on, e.g. the aggregate bucket size
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS meta(
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stage_stats(
+            ts INTEGER,
+            metric TEXT,
+            label TEXT,
+            value REAL
         )
     """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_vid_time ON comments (video_id, published_at)")
+    # v2 databases predate the duplicate columns
+    for table in ("window_aggregates", "window_metrics"):
+        columns = _columns(conn, table)
+        for column in ("duplicate_comments", "duplicate_clusters"):
+            if column not in columns:
+                default = " DEFAULT 0" if table == "window_aggregates" else ""
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER{default}")
+    if "closed_until" not in _columns(conn, "ingestion_state"):
+        cur.execute("ALTER TABLE ingestion_state ADD COLUMN closed_until INTEGER")
+    # Covers range scans, gap (LAG) and author/sentiment reads without touching the table
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_vid_ts
+        ON comments (video_id, published_ts, author_id, sentiment)
+    """)
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
-    conn.close()
+
+    # Databases created before window_aggregates or the duplicate index
+    # existed get them filled once
+    cur.execute("SELECT EXISTS(SELECT 1 FROM comments), EXISTS(SELECT 1 FROM window_aggregates)")
+    has_comments, has_aggregates = cur.fetchone()
+    cur.execute("SELECT value FROM meta WHERE key = 'aggregate_window'")
+    stored_window = cur.fetchone()
+    # Buckets written before the size was recorded are assumed to match it
+    resized = has_aggregates and stored_window is not None and int(stored_window[0]) != AGGREGATE_WINDOW
+
+    if resized:
+        # POLL_INTERVAL changed: every bucket, window and watermark is in the old size
+        print(f"Aggregate window changed from {stored_window[0]}s to {AGGREGATE_WINDOW}s, rebuilding windows...")
+        with transaction() as conn:
+            conn.execute("DELETE FROM window_metrics")
+            conn.execute("DELETE FROM window_updates")
+            conn.execute("DELETE FROM dirty_windows")
+            conn.execute("UPDATE ingestion_state SET closed_until = NULL")
+            # Tells incremental exports that windows they already copied are gone
+            conn.execute("""
+                INSERT INTO meta (key, value) VALUES ('windows_version', 1)
+                ON CONFLICT(key) DO UPDATE SET value = value + 1
+            """)
+
+    # Comments, embeddings and windows stored before their sequence tables existed get numbers once
+    cur.execute("SELECT NOT EXISTS(SELECT 1 FROM comment_seq)")
+    if has_comments and cur.fetchone()[0]:
+        with transaction() as conn:
+            conn.execute("INSERT INTO comment_seq (comment_id) SELECT comment_id FROM comments ORDER BY rowid")
+    cur.execute("SELECT EXISTS(SELECT 1 FROM window_metrics), NOT EXISTS(SELECT 1 FROM window_updates)")
+    if all(cur.fetchone()):
+        with transaction() as conn:
+            conn.execute("""
+                INSERT INTO window_updates (video_id, window_ts)
+                SELECT video_id, window_ts FROM window_metrics ORDER BY window_ts
+            """)
+    cur.execute("""
+        SELECT EXISTS(SELECT 1 FROM comment_embeddings), NOT EXISTS(SELECT 1 FROM embedding_seq)
+    """)
+    if all(cur.fetchone()):
+        with transaction() as conn:
+            conn.execute("""
+                INSERT OR IGNORE INTO embedding_seq (comment_id)
+                SELECT e.comment_id FROM comment_embeddings e
+                LEFT JOIN comments c ON c.comment_id = e.comment_id
+                ORDER BY c.published_ts
+            """)
+
+    if has_comments and version < 3:
+        rebuild_duplicate_index()
+    elif has_comments and (resized or not has_aggregates):
+        rebuild_window_aggregates()
+
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('aggregate_window', ?)",
+                     (str(AGGREGATE_WINDOW),))
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def migrate_to_epoch_schema():
+    """
+    v1 -> v2: converts comments.published_at/fetched_at and
+    window_metrics.window_start from ISO text to INTEGER epoch seconds.
+
+    comments is copied into a new table in rowid chunks, each its own short
+    transaction, so a large database stays usable while it runs and an
+    interrupted migration resumes from the last copied chunk. The final
+    swap copies the stragglers and renames under one write lock.
+    """
+    conn = get_connection()
+
+    if "published_at" in _columns(conn, "comments"):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS comments_v2 (
+                comment_id TEXT PRIMARY KEY,
+                video_id TEXT,
+                author_id TEXT,
+                text TEXT,
+                sentiment REAL,
+                published_ts INTEGER,
+                fetched_ts INTEGER
+            )
+        """)
+        copy_chunk = """
+            INSERT OR IGNORE INTO comments_v2 (rowid, comment_id, video_id, author_id, text, sentiment,
+                                               published_ts, fetched_ts)
+            SELECT rowid, comment_id, video_id, author_id, text, sentiment,
+                   unixepoch(published_at), unixepoch(fetched_at)
+            FROM comments
+            WHERE rowid > ? AND rowid <= ?
+        """
+
+        # Rowids are preserved, so the copy resumes after the highest one present
+        copied = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM comments_v2").fetchone()[0]
+        last = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM comments").fetchone()[0]
+        print(f"Migrating comments to epoch timestamps ({last - copied} rows to go)...")
+
+        while copied < last:
+            with transaction() as conn:
+                conn.execute(copy_chunk, (copied, copied + MIGRATION_CHUNK_ROWS))
+            copied += MIGRATION_CHUNK_ROWS
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(copy_chunk, (copied, 2 ** 63 - 1))
+            conn.execute("DROP TABLE comments")
+            conn.execute("ALTER TABLE comments_v2 RENAME TO comments")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    if "window_start" in _columns(conn, "window_metrics"):
+        # One row per window, small enough to convert in a single transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("ALTER TABLE window_metrics RENAME TO window_metrics_v1")
+            conn.execute("""
+                CREATE TABLE window_metrics(
+                    video_id TEXT,
+                    window_ts INTEGER,
+                    total_comments INTEGER,
+                    unique_authors INTEGER,
+                    avg_length REAL,
+                    avg_sentiment REAL,
+                    sentiment_variance REAL,
+                    avg_gap REAL,
+                    gap_variance REAL,
+                    coordination_score REAL,
+                    PRIMARY KEY (video_id, window_ts)
+                )
+            """)
+            conn.execute("""
+                INSERT OR REPLACE INTO window_metrics
+                SELECT video_id, unixepoch(window_start), total_comments, unique_authors, avg_length,
+                       avg_sentiment, sentiment_variance, avg_gap, gap_variance, coordination_score
+                FROM window_metrics_v1
+                WHERE unixepoch(window_start) IS NOT NULL
+            """)
+            conn.execute("DROP TABLE window_metrics_v1")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        print("Migrated window_metrics to epoch timestamps. Run VACUUM to reclaim the freed space.")
+
 
 def get_connection():
+    """
+    Returns this thread's long-lived connection, opening it on first use.
+    Connections are never shared across threads or forked processes, and
+    a new one is opened if DB_PATH changes.
+    """
+    key = (os.getpid(), DB_PATH)
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.key == key:
+        return conn
+
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")  # Enables concurrent Readers/Writers
-    conn.execute("PRAGMA synchronous=NORMAL;") # Reduces fsync() calls
+    # Statements are cached by SQL text, so hot queries are only prepared once
+    conn = sqlite3.connect(DB_PATH, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    _local.conn = conn
+    _local.key = key
     return conn
 
 
-def insert_comments_batch(comments):
-    """Inserts a list of comments in a single transaction"""
+@contextmanager
+def transaction():
+    """Commits on success and rolls back on any exception."""
     conn = get_connection()
-    cur = conn.cursor()
+    with conn:
+        yield conn
+
+
+def close_connection():
+    """Closes this thread's connection (e.g. on shutdown)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        if _local.key[0] == os.getpid():
+            conn.close()
+        _local.conn = None
 
-    # Normalization happens in a list comprehension
+
+def insert_comments_batch(comments, checkpoint=None):
+    """
+    Inserts a list of comments in a single transaction, folding each
+    genuinely new comment into window_aggregates as it goes. New comments
+    landing in windows the live loop has already closed mark those
+    windows dirty (see take_dirty_windows).
+
+    `checkpoint` is an optional (video_id, newest_comment_id) saved in the
+    same transaction, so the live loop's stop_at_id never gets ahead of
+    the comments actually stored.
+    """
+    # Parsed once here; everything downstream is integer arithmetic
     for c in comments:
-        c["published_at"] = normalize_window(c["published_at"])
-        c["fetched_at"] = normalize_window(c["fetched_at"])
+        c["published_ts"] = to_epoch(c.get("published_at"))
+        c["fetched_ts"] = to_epoch(c.get("fetched_at"))
 
-    try:
-        # IGNORE handles the IntegrityError (duplicates) automatically in SQL
-        cur.executemany("""
-                        INSERT OR IGNORE INTO comments (comment_id, video_id, author_id, text, published_at, fetched_at,
+    inserted = 0
+    new_ids = []
+    touched = set()
+    with timed("db_insert"), transaction() as conn:
+        cur = conn.cursor()
+        for c in comments:
+            # IGNORE handles the IntegrityError (duplicates) automatically in SQL
+            cur.execute("""
+                        INSERT OR IGNORE INTO comments (comment_id, video_id, author_id, text, published_ts, fetched_ts,
                                                         sentiment)
-                        VALUES (:comment_id, :video_id, :author_id, :text, :published_at, :fetched_at, :sentiment)
-                        """, comments)
-        conn.commit()
-    finally:
-        conn.close()
+                        VALUES (:comment_id, :video_id, :author_id, :text, :published_ts, :fetched_ts, :sentiment)
+                        """, c)
+            # rowcount is 0 for duplicates, which must not be counted twice
+            if cur.rowcount == 1:
+                inserted += 1
+                new_ids.append((c["comment_id"],))
+                _add_to_aggregates(cur, c)
+                _add_to_clusters(cur, c)
+                if c["published_ts"] is not None:
+                    touched.add((c["video_id"], c["published_ts"] - c["published_ts"] % AGGREGATE_WINDOW))
+
+        cur.executemany("INSERT OR IGNORE INTO comment_seq (comment_id) VALUES (?)", new_ids)
+
+        # One statement per touched bucket; only buckets behind the watermark stick
+        cur.executemany("""
+            INSERT OR IGNORE INTO dirty_windows (video_id, window_ts)
+            SELECT :video_id, :window_ts
+            WHERE :window_ts < (SELECT closed_until FROM ingestion_state WHERE video_id = :video_id)
+        """, [{"video_id": vid, "window_ts": window_ts} for vid, window_ts in touched])
+
+        # Vectors attached by analysis.embeddings.embed_comments, if enabled
+        embedded = [c for c in comments if c.get("embedding") is not None]
+        cur.executemany("INSERT OR IGNORE INTO comment_embeddings (comment_id, vector) VALUES (?, ?)",
+                        [(c["comment_id"], c["embedding"]) for c in embedded])
+        cur.executemany(INSERT_EMBEDDING_SEQ, [(c["comment_id"],) for c in embedded])
+        if checkpoint:
+            cur.execute(UPSERT_NEWEST_COMMENT_ID, checkpoint)
+    increment("comments_inserted", inserted)
+
+
+def to_epoch(value):
+    """
+    Epoch seconds for an ISO string ('...Z', '...+00:00' or
+    'YYYY-MM-DD HH:MM:SS'), a datetime or a number. Naive values are UTC.
+    Returns None for anything unparseable.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
 
+def _iso(ts):
+    """Epoch seconds -> the same ISO format normalize_window produces."""
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='seconds')
 
+
+def _add_to_aggregates(cur, c):
+    """Folds one freshly inserted comment into its bucket's running sums."""
+    ts = c.get("published_ts")
+    if ts is None:
+        return
+
+    window_ts = ts - ts % AGGREGATE_WINDOW
+    length = len(c.get("text") or "")
+    sentiment = c.get("sentiment") or 0.0
+
+    # Neighbours inside the same bucket, in published_ts order. Inserting
+    # after every equal timestamp means `before` <= ts < `after`.
+    cur.execute("""
+        SELECT
+            (SELECT MAX(published_ts) FROM comments
+             WHERE video_id = :video_id AND published_ts >= :bucket_start AND published_ts <= :ts
+               AND comment_id != :comment_id),
+            (SELECT MIN(published_ts) FROM comments
+             WHERE video_id = :video_id AND published_ts > :ts AND published_ts < :bucket_end)
+    """, {
+        "video_id": c["video_id"], "comment_id": c["comment_id"], "ts": ts,
+        "bucket_start": window_ts, "bucket_end": window_ts + AGGREGATE_WINDOW
+    })
+    before, after = cur.fetchone()
+
+    # The new comment splits the gap (after - before) into two
+    gaps_added, gaps_removed = [], []
+    if before is not None:
+        gaps_added.append(ts - before)
+    if after is not None:
+        gaps_added.append(after - ts)
+    if before is not None and after is not None:
+        gaps_removed.append(after - before)
+
+    cur.execute("""
+        INSERT INTO window_aggregates (video_id, window_ts, total_comments, unique_authors,
+                                       sum_length, sum_length_sq, sum_sentiment, sum_sentiment_sq,
+                                       gap_count, sum_gap, sum_gap_sq, first_ts, last_ts)
+        VALUES (:video_id, :window_ts, 1, 0, :len, :len_sq, :sent, :sent_sq, :gap_n, :gap, :gap_sq, :ts, :ts)
+        ON CONFLICT(video_id, window_ts) DO UPDATE SET
+            total_comments = total_comments + 1,
+            sum_length = sum_length + excluded.sum_length,
+            sum_length_sq = sum_length_sq + excluded.sum_length_sq,
+            sum_sentiment = sum_sentiment + excluded.sum_sentiment,
+            sum_sentiment_sq = sum_sentiment_sq + excluded.sum_sentiment_sq,
+            gap_count = gap_count + excluded.gap_count,
+            sum_gap = sum_gap + excluded.sum_gap,
+            sum_gap_sq = sum_gap_sq + excluded.sum_gap_sq,
+            first_ts = MIN(first_ts, excluded.first_ts),
+            last_ts = MAX(last_ts, excluded.last_ts)
+    """, {
+        "video_id": c["video_id"], "window_ts": window_ts, "ts": ts,
+        "len": length, "len_sq": length * length,
+        "sent": sentiment, "sent_sq": sentiment * sentiment,
+        "gap_n": len(gaps_added) - len(gaps_removed),
+        "gap": sum(gaps_added) - sum(gaps_removed),
+        "gap_sq": sum(g * g for g in gaps_added) - sum(g * g for g in gaps_removed)
+    })
+
+    # COUNT(DISTINCT author_id) ignores NULL authors, so do we
+    if c.get("author_id"):
+        cur.execute("INSERT OR IGNORE INTO window_authors (video_id, window_ts, author_id) VALUES (?, ?, ?)",
+                    (c["video_id"], window_ts, c["author_id"]))
+        if cur.rowcount == 1:
+            cur.execute("UPDATE window_aggregates SET unique_authors = unique_authors + 1 "
+                        "WHERE video_id = ? AND window_ts = ?", (c["video_id"], window_ts))
+
+
+def _match_cluster(candidates, sig):
+    """Best (cluster_id, similarity) among [(cluster_id, signature), ...] at or above MINHASH_THRESHOLD."""
+    best = None
+    for cluster_id, leader_sig in candidates:
+        score = minhash.similarity(sig, leader_sig)
+        if score >= MINHASH_THRESHOLD and (best is None or score > best[1]):
+            best = (cluster_id, score)
+    return best[0] if best else None
+
+
+def _add_to_clusters(cur, c):
+    """
+    Streams one new comment through the MinHash LSH index. Clusters whose
+    first comment shares a band bucket with it are candidates; the closest
+    one above MINHASH_THRESHOLD adopts it as a near-duplicate, otherwise it
+    starts a cluster of its own. Costs one indexed lookup of MINHASH_BANDS
+    keys plus a few signature comparisons, however many comments are stored.
+    """
+    sig = minhash.signature(c.get("text"))
+    if sig is None:
+        return
+    keys = minhash.band_keys(sig)
+
+    placeholders = ",".join("?" * len(keys))
+    cur.execute(f"""
+        SELECT cluster_id, signature FROM cluster_signatures
+        WHERE cluster_id IN (SELECT cluster_id FROM lsh_buckets WHERE bucket IN ({placeholders}))
+    """, keys)
+    cluster_id = _match_cluster(((cid, minhash.from_bytes(blob)) for cid, blob in cur.fetchall()), sig)
+    duplicate = cluster_id is not None
+
+    if not duplicate:
+        # Only a cluster's first comment claims buckets, so clusters can't drift by chaining
+        cluster_id = c["comment_id"]
+        cur.execute("INSERT OR IGNORE INTO cluster_signatures (cluster_id, signature) VALUES (?, ?)",
+                    (cluster_id, minhash.to_bytes(sig)))
+        cur.executemany("INSERT OR IGNORE INTO lsh_buckets (bucket, cluster_id) VALUES (?, ?)",
+                        [(key, cluster_id) for key in keys])
+
+    cur.execute("INSERT OR REPLACE INTO comment_clusters (comment_id, cluster_id, duplicate) VALUES (?, ?, ?)",
+                (c["comment_id"], cluster_id, int(duplicate)))
+
+    ts = c.get("published_ts")
+    if not duplicate or ts is None:
+        return
+
+    window_ts = ts - ts % AGGREGATE_WINDOW
+    cur.execute("INSERT OR IGNORE INTO window_clusters (video_id, window_ts, cluster_id) VALUES (?, ?, ?)",
+                (c["video_id"], window_ts, cluster_id))
+    cur.execute("""
+        UPDATE window_aggregates
+        SET duplicate_comments = duplicate_comments + 1,
+            duplicate_clusters = duplicate_clusters + ?
+        WHERE video_id = ? AND window_ts = ?
+    """, (cur.rowcount, c["video_id"], window_ts))
+
+
+def rebuild_duplicate_index():
+    """
+    Rebuilds the near-duplicate clusters from scratch, replaying comments
+    oldest first so each cluster is named after its earliest comment,
+    then refreshes window_aggregates from them.
+    """
+    with transaction() as conn:
+        cur = conn.cursor()
+        for table in ("cluster_signatures", "lsh_buckets", "comment_clusters", "window_clusters"):
+            cur.execute(f"DELETE FROM {table}")
+
+        leaders = {}      # cluster_id -> signature
+        buckets = {}      # bucket key -> cluster_id
+        clusters = []
+        for comment_id, text in conn.execute("SELECT comment_id, text FROM comments ORDER BY published_ts"):
+            sig = minhash.signature(text)
+            if sig is None:
+                continue
+            keys = minhash.band_keys(sig)
+
+            candidates = {buckets[k] for k in keys if k in buckets}
+            cluster_id = _match_cluster(((cid, leaders[cid]) for cid in candidates), sig)
+            duplicate = cluster_id is not None
+            if not duplicate:
+                cluster_id = comment_id
+                leaders[cluster_id] = sig
+                for key in keys:
+                    buckets.setdefault(key, cluster_id)
+            clusters.append((comment_id, cluster_id, int(duplicate)))
+
+        cur.executemany("INSERT INTO cluster_signatures (cluster_id, signature) VALUES (?, ?)",
+                        [(cid, minhash.to_bytes(sig)) for cid, sig in leaders.items()])
+        cur.executemany("INSERT INTO lsh_buckets (bucket, cluster_id) VALUES (?, ?)", buckets.items())
+        cur.executemany("INSERT INTO comment_clusters (comment_id, cluster_id, duplicate) VALUES (?, ?, ?)",
+                        clusters)
+        # Tells incremental exports that already exported comments changed cluster
+        cur.execute("""
+            INSERT INTO meta (key, value) VALUES ('clusters_version', 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + 1
+        """)
+
+    rebuild_window_aggregates()
+
+
+def rebuild_window_aggregates(video_id=None):
+    """Recomputes window_aggregates from scratch (one pass over comments)."""
+    where_clause = "WHERE video_id = ?" if video_id else ""
+    params = (video_id,) if video_id else ()
+
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM window_aggregates {where_clause}", params)
+        cur.execute(f"DELETE FROM window_authors {where_clause}", params)
+        cur.execute(f"DELETE FROM window_clusters {where_clause}", params)
+
+        rows = conn.execute(f"""
+            SELECT c.video_id, c.author_id, c.text, c.sentiment, c.published_ts, cc.cluster_id, cc.duplicate
+            FROM comments c
+            LEFT JOIN comment_clusters cc ON cc.comment_id = c.comment_id
+            {where_clause.replace("video_id", "c.video_id")}
+            ORDER BY c.video_id, c.published_ts
+        """, params)
+
+        buckets = {}
+        authors = set()
+        clusters = set()
+        for vid, author, text, sentiment, ts, cluster_id, duplicate in rows:
+            if ts is None:
+                continue
+            key = (vid, ts - ts % AGGREGATE_WINDOW)
+            b = buckets.get(key)
+            if b is None:
+                b = buckets[key] = [0, 0, 0.0, 0.0, 0.0, 0.0, 0, 0.0, 0.0, ts, ts, 0, 0]
+            else:
+                # Rows arrive sorted, so last_ts is the previous comment in this bucket
+                gap = ts - b[10]
+                b[6] += 1
+                b[7] += gap
+                b[8] += gap * gap
+            length = len(text or "")
+            sentiment = sentiment or 0.0
+            b[0] += 1
+            b[2] += length
+            b[3] += length * length
+            b[4] += sentiment
+            b[5] += sentiment * sentiment
+            b[10] = ts
+            if author and (key, author) not in authors:
+                authors.add((key, author))
+                b[1] += 1
+            if duplicate:
+                b[11] += 1
+                if (key, cluster_id) not in clusters:
+                    clusters.add((key, cluster_id))
+                    b[12] += 1
+
+        cur.executemany("""
+            INSERT INTO window_aggregates (video_id, window_ts, total_comments, unique_authors,
+                                           sum_length, sum_length_sq, sum_sentiment, sum_sentiment_sq,
+                                           gap_count, sum_gap, sum_gap_sq, first_ts, last_ts,
+                                           duplicate_comments, duplicate_clusters)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [key + tuple(b) for key, b in buckets.items()])
+        cur.executemany("INSERT INTO window_authors (video_id, window_ts, author_id) VALUES (?, ?, ?)",
+                        [key + (author,) for key, author in authors])
+        cur.executemany("INSERT INTO window_clusters (video_id, window_ts, cluster_id) VALUES (?, ?, ?)",
+                        [key + (cluster_id,) for key, cluster_id in clusters])
+
+
+@instrument("window_query")
 def get_window_metrics(start_time, end_time, video_id=None):
-    norm_start = normalize_window(start_time)
-    norm_end = normalize_window(end_time)
+    start_ts, end_ts = to_epoch(start_time), to_epoch(end_time)
+    label = _iso(start_ts)
+
+    # A range that is exactly one aggregate bucket needs no scan at all
+    if video_id and start_ts % AGGREGATE_WINDOW == 0 and end_ts - start_ts == AGGREGATE_WINDOW:
+        metrics = get_bucket_metrics(video_id, start_ts)
+        if metrics:
+            return metrics
 
     conn = get_connection()
     cur = conn.cursor()
 
-    where_clause = "WHERE published_at BETWEEN ? AND ?"
-    params = [norm_start, norm_end]
+    where_clause = "WHERE published_ts BETWEEN :start AND :end"
+    params = {"start": start_ts, "end": end_ts, "label": label, "video_id": video_id}
     if video_id:
-        where_clause += " AND video_id = ?"
-        params.append(video_id)
+        where_clause += " AND video_id = :video_id"
 
 
     query = f"""
@@ -104,33 +771,38 @@ def get_window_metrics(start_time, end_time, video_id=None):
                 author_id,
                 sentiment,
                 LENGTH(text) as text_len,
-                unixepoch(published_at) - LAG(unixepoch(published_at)) OVER (ORDER BY published_at) AS gap
+                published_ts - LAG(published_ts) OVER (ORDER BY published_ts) AS gap,
+                cluster_id,
+                duplicate
             FROM comments
+            LEFT JOIN comment_clusters USING (comment_id)
             {where_clause}
         )
         SELECT 
             video_id,                                   -- Index 0
-            '{norm_start}',                             -- Index 1 (The window label)
+            :label,                                     -- Index 1 (The window label)
             COUNT(*) AS total_comments,                 -- Index 2
             COUNT(DISTINCT author_id) AS unique_authors, -- Index 3
             AVG(text_len),                              -- Index 4
             AVG(sentiment),                             -- Index 5
             MAX(0.0, AVG(sentiment * sentiment) - (AVG(sentiment) * AVG(sentiment))), -- Index 6
             AVG(gap),                                   -- Index 7
-            MAX(0.0, AVG(gap * gap) - (AVG(gap) * AVG(gap))) -- Index 8
+            MAX(0.0, AVG(gap * gap) - (AVG(gap) * AVG(gap))), -- Index 8
+            COALESCE(SUM(duplicate), 0),                -- Index 9
+            COUNT(DISTINCT CASE WHEN duplicate THEN cluster_id END) -- Index 10
         FROM Gaps
     """
 
     cur.execute(query, params)
     r = cur.fetchone()
-    conn.close()
 
     # Safety check: If no comments found
     if not r or r[2] == 0:
         return {
-            "video_id": video_id, "window": norm_start, "total_comments": 0,
+            "video_id": video_id, "window": label, "total_comments": 0,
             "unique_authors": 0, "avg_length": 0, "avg_sentiment": 0,
-            "sentiment_variance": 0, "avg_gap": 0, "gap_variance": 0
+            "sentiment_variance": 0, "avg_gap": 0, "gap_variance": 0,
+            "duplicate_comments": 0, "duplicate_clusters": 0
         }
 
 
@@ -143,20 +815,149 @@ def get_window_metrics(start_time, end_time, video_id=None):
         "avg_sentiment": r[5] or 0,
         "sentiment_variance": max(0.0, r[6]) if r[6] is not None else 0.0,
         "avg_gap": r[7] or 0,
-        "gap_variance": max(0.0, r[8]) if r[8] is not None else 0.0
+        "gap_variance": max(0.0, r[8]) if r[8] is not None else 0.0,
+        "duplicate_comments": r[9],
+        "duplicate_clusters": r[10]
     }
 
 
 
 
+@instrument("window_query")
 def get_all_window_metrics(video_id=None, polling_rate=600):
+    """
+    Metrics for every window, oldest first. Windows of AGGREGATE_WINDOW
+    seconds are read straight from window_aggregates (one row per window);
+    any other size falls back to scanning the comments table.
+    """
+    if polling_rate != AGGREGATE_WINDOW:
+        return _scan_all_window_metrics(video_id, polling_rate)
+
     conn = get_connection()
     cur = conn.cursor()
 
     where_clause = "WHERE video_id = ?" if video_id else ""
     params = (video_id,) if video_id else ()
 
-    window_expr = f"strftime('%Y-%m-%dT%H:%M:%SZ', (unixepoch(published_at) / {polling_rate}) * {polling_rate}, 'unixepoch')"
+    cur.execute(f"""
+        SELECT {AGGREGATE_COLUMNS}
+        FROM window_aggregates
+        {where_clause}
+        ORDER BY window_ts ASC, video_id
+    """, params)
+    rows = cur.fetchall()
+
+    previous_last = {}
+    windows = []
+    for r in rows:
+        windows.append(_metrics_from_aggregate(r, previous_last.get(r[0])))
+        previous_last[r[0]] = r[11]
+    return windows
+
+
+def _metrics_from_aggregate(r, previous_last_ts):
+    """
+    Turns one window_aggregates row into the metrics dict. The gap between
+    this bucket's first comment and the previous bucket's last comment is
+    stitched in here, matching LAG() over the whole video.
+    """
+    (vid, window_ts, n, authors, sum_len, sum_sent, sum_sent_sq, gap_n, sum_gap, sum_gap_sq, first_ts, _,
+     dup_comments, dup_clusters) = r
+
+    if previous_last_ts is not None:
+        boundary_gap = first_ts - previous_last_ts
+        gap_n += 1
+        sum_gap += boundary_gap
+        sum_gap_sq += boundary_gap * boundary_gap
+
+    avg_sentiment = sum_sent / n
+    avg_gap = sum_gap / gap_n if gap_n else 0
+
+    return {
+        "video_id": vid,
+        "window": datetime.fromtimestamp(window_ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "total_comments": n,
+        "unique_authors": authors,
+        "avg_length": sum_len / n,
+        "avg_sentiment": avg_sentiment,
+        "sentiment_variance": max(0.0, sum_sent_sq / n - avg_sentiment * avg_sentiment),
+        "avg_gap": avg_gap,
+        "gap_variance": max(0.0, sum_gap_sq / gap_n - avg_gap * avg_gap) if gap_n else 0.0,
+        "duplicate_comments": dup_comments or 0,
+        "duplicate_clusters": dup_clusters or 0
+    }
+
+
+def get_bucket_metrics(video_id, window_ts):
+    """Metrics for a single aggregate bucket: two indexed row reads, no comment scan."""
+    conn = get_connection()
+    cur = conn.cursor()
+
+    cur.execute(f"""
+        SELECT {AGGREGATE_COLUMNS}
+        FROM window_aggregates
+        WHERE video_id = ? AND window_ts = ?
+    """, (video_id, window_ts))
+    r = cur.fetchone()
+    if not r:
+        return None
+
+    cur.execute("""
+        SELECT last_ts FROM window_aggregates
+        WHERE video_id = ? AND window_ts < ?
+        ORDER BY window_ts DESC LIMIT 1
+    """, (video_id, window_ts))
+    previous = cur.fetchone()
+
+    return _metrics_from_aggregate(r, previous[0] if previous else None)
+
+
+def get_window_series(video_id, start_ts=None, end_ts=None, before=0):
+    """
+    Aggregate windows of one video with start_ts <= window_ts < end_ts,
+    oldest first, preceded by up to `before` earlier windows (the history
+    a rolling baseline needs to score the first of them).
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    start_ts = start_ts if start_ts is not None else -1 << 62
+    end_ts = end_ts if end_ts is not None else 1 << 62
+
+    # One row more than asked for: its last_ts is the first window's boundary gap
+    cur.execute(f"""
+        SELECT {AGGREGATE_COLUMNS}
+        FROM window_aggregates
+        WHERE video_id = ? AND window_ts < ?
+        ORDER BY window_ts DESC LIMIT ?
+    """, (video_id, start_ts, before + 1))
+    preceding = cur.fetchall()[::-1]
+
+    cur.execute(f"""
+        SELECT {AGGREGATE_COLUMNS}
+        FROM window_aggregates
+        WHERE video_id = ? AND window_ts >= ? AND window_ts < ?
+        ORDER BY window_ts
+    """, (video_id, start_ts, end_ts))
+    rows = cur.fetchall()
+
+    previous_last = None
+    if len(preceding) > before:
+        previous_last = preceding[0][11]
+        preceding = preceding[1:]
+
+    windows = []
+    for r in preceding + rows:
+        windows.append(_metrics_from_aggregate(r, previous_last))
+        previous_last = r[11]
+    return windows
+
+
+def _scan_all_window_metrics(video_id=None, polling_rate=600):
+    conn = get_connection()
+    cur = conn.cursor()
+
+    where_clause = "WHERE video_id = :video_id" if video_id else ""
+    params = {"video_id": video_id, "rate": polling_rate}
 
     query = f"""
         WITH TimedComments AS (
@@ -165,58 +966,117 @@ def get_all_window_metrics(video_id=None, polling_rate=600):
                 author_id,
                 sentiment,
                 LENGTH(text) as text_len,
-                unixepoch(published_at) as ts,
-                unixepoch(published_at) - LAG(unixepoch(published_at)) OVER (
-                    PARTITION BY video_id ORDER BY published_at
+                published_ts - LAG(published_ts) OVER (
+                    PARTITION BY video_id ORDER BY published_ts
                 ) AS gap,
-                strftime('%Y-%m-%dT%H:%M:%SZ', (unixepoch(published_at) / {polling_rate}) * {polling_rate}, 'unixepoch') AS window
+                (published_ts / :rate) * :rate AS window_ts,
+                cluster_id,
+                duplicate
             FROM comments
+            LEFT JOIN comment_clusters USING (comment_id)
             {where_clause}
         )
         SELECT
             video_id,
-            window,
+            window_ts,
             COUNT(*) as total_comments,
             COUNT(DISTINCT author_id) as unique_authors,
             AVG(text_len) as avg_length,
             AVG(sentiment) as avg_sentiment,
             MAX(0.0, AVG(sentiment * sentiment) - (AVG(sentiment) * AVG(sentiment))) as sentiment_variance,
             AVG(gap) as avg_gap,
-            MAX(0.0, AVG(gap * gap) - (AVG(gap) * AVG(gap))) as gap_variance
+            MAX(0.0, AVG(gap * gap) - (AVG(gap) * AVG(gap))) as gap_variance,
+            COALESCE(SUM(duplicate), 0) as duplicate_comments,
+            COUNT(DISTINCT CASE WHEN duplicate THEN cluster_id END) as duplicate_clusters
         FROM TimedComments
-        GROUP BY video_id, window
-        ORDER BY window ASC
+        GROUP BY video_id, window_ts
+        ORDER BY window_ts ASC
     """
 
     cur.execute(query, params)
     rows = cur.fetchall()
-    conn.close()
 
     return [{
         "video_id": r[0],
-        "window": r[1],
+        "window": datetime.fromtimestamp(r[1], timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
         "total_comments": r[2],
         "unique_authors": r[3],
         "avg_length": r[4] or 0,
         "avg_sentiment": r[5] or 0,
         "sentiment_variance": max(0.0, r[6]) if r[6] is not None else 0.0,
         "avg_gap": r[7] or 0,
-        "gap_variance": max(0.0, r[8]) if r[8] is not None else 0.0
-    } for r in rows]
+        "gap_variance": max(0.0, r[8]) if r[8] is not None else 0.0,
+        "duplicate_comments": r[9],
+        "duplicate_clusters": r[10]
+    } for r in rows if r[1] is not None]
 
 
-def insert_window_metrics(metrics):
-    """
-    Insert or update window metrics using named placeholders for clarity.
-    """
-    conn = get_connection()
-    cur = conn.cursor()
+# Numbers a newly stored embedding (a no-op for one that already has a number)
+INSERT_EMBEDDING_SEQ = "INSERT OR IGNORE INTO embedding_seq (comment_id) VALUES (?)"
+
+UPSERT_NEWEST_COMMENT_ID = """
+    INSERT INTO ingestion_state (video_id, newest_comment_id, updated_at)
+    VALUES (?, ?, strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+    ON CONFLICT(video_id) DO UPDATE SET
+        newest_comment_id = excluded.newest_comment_id,
+        updated_at = excluded.updated_at
+"""
+
+UPSERT_WINDOW_METRICS = """
+    INSERT INTO window_metrics (
+        video_id,
+        window_ts,
+        total_comments,
+        unique_authors,
+        avg_length,
+        avg_sentiment,
+        sentiment_variance,
+        avg_gap,
+        gap_variance,
+        coordination_score,
+        duplicate_comments,
+        duplicate_clusters
+    )
+    VALUES (
+        :video_id, 
+        :window_ts, 
+        :total_comments, 
+        :unique_authors, 
+        :avg_length, 
+        :avg_sentiment, 
+        :sentiment_variance, 
+        :avg_gap, 
+        :gap_variance, 
+        :coordination_score,
+        :duplicate_comments,
+        :duplicate_clusters
+    )
+    ON CONFLICT(video_id, window_ts) DO UPDATE SET
+        total_comments = excluded.total_comments,
+        unique_authors = excluded.unique_authors,
+        avg_length = excluded.avg_length,
+        avg_sentiment = excluded.avg_sentiment,
+        sentiment_variance = excluded.sentiment_variance,
+        avg_gap = excluded.avg_gap,
+        gap_variance = excluded.gap_variance,
+        coordination_score = excluded.coordination_score,
+        duplicate_comments = excluded.duplicate_comments,
+        duplicate_clusters = excluded.duplicate_clusters;
+"""
+
+
+# Moves a window to the end of the export queue (see columnar.export)
+MARK_WINDOW_UPDATED = """
+    INSERT OR REPLACE INTO window_updates (video_id, window_ts) VALUES (:video_id, :window_ts)
+"""
+
 
-    # 1. Prepare a clean copy of the dictionary for the SQL execution
+def _window_metrics_row(metrics):
+    # Prepare a clean copy of the dictionary for the SQL execution
     # This ensures we have all keys even if the input metrics dict is missing some
-    data = {
+    return {
         "video_id": metrics.get("video_id"),
-        "window_start": normalize_window(metrics.get("window", "")),
+        "window_ts": to_epoch(metrics.get("window")),
         "total_comments": metrics.get("total_comments", 0),
         "unique_authors": metrics.get("unique_authors", 0),
         "avg_length": metrics.get("avg_length", 0),
@@ -224,51 +1084,235 @@ def insert_window_metrics(metrics):
         "sentiment_variance": metrics.get("sentiment_variance", 0),
         "avg_gap": metrics.get("avg_gap", 0),
         "gap_variance": metrics.get("gap_variance", 0),
-        "coordination_score": metrics.get("coordination_score")
+        "coordination_score": metrics.get("coordination_score"),
+        "duplicate_comments": metrics.get("duplicate_comments", 0),
+        "duplicate_clusters": metrics.get("duplicate_clusters", 0)
     }
 
+
+def insert_window_metrics(metrics):
+    """
+    Insert or update window metrics using named placeholders for clarity.
+    """
     try:
-        cur.execute("""
-        INSERT INTO window_metrics (
-            video_id,
-            window_start,
-            total_comments,
-            unique_authors,
-            avg_length,
-            avg_sentiment,
-            sentiment_variance,
-            avg_gap,
-            gap_variance,
-            coordination_score
-        )
-        VALUES (
-            :video_id, 
-            :window_start, 
-            :total_comments, 
-            :unique_authors, 
-            :avg_length, 
-            :avg_sentiment, 
-            :sentiment_variance, 
-            :avg_gap, 
-            :gap_variance, 
-            :coordination_score
-        )
-        ON CONFLICT(video_id, window_start) DO UPDATE SET
-            total_comments = excluded.total_comments,
-            unique_authors = excluded.unique_authors,
-            avg_length = excluded.avg_length,
-            avg_sentiment = excluded.avg_sentiment,
-            sentiment_variance = excluded.sentiment_variance,
-            avg_gap = excluded.avg_gap,
-            gap_variance = excluded.gap_variance,
-            coordination_score = excluded.coordination_score;
-        """, data)
-
-        conn.commit()
+        with transaction() as conn:
+            row = _window_metrics_row(metrics)
+            conn.execute(UPSERT_WINDOW_METRICS, row)
+            conn.execute(MARK_WINDOW_UPDATED, row)
     except sqlite3.Error as e:
         print(f"Database error in insert_window_metrics: {e}")
-    finally:
-        conn.close()
+
+
+def insert_window_metrics_batch(metrics_list):
+    """Upserts many windows with one executemany in a single transaction."""
+    if not metrics_list:
+        return
+
+    try:
+        with transaction() as conn:
+            rows = [_window_metrics_row(m) for m in metrics_list]
+            conn.executemany(UPSERT_WINDOW_METRICS, rows)
+            conn.executemany(MARK_WINDOW_UPDATED, rows)
+    except sqlite3.Error as e:
+        print(f"Database error in insert_window_metrics_batch: {e}")
+
+
+def get_ingestion_state(video_id):
+    """Returns the saved checkpoint for a video, or None if it was never fetched."""
+    cur = get_connection().cursor()
+    cur.execute("""
+        SELECT next_page_token, newest_comment_id, backfill_complete
+        FROM ingestion_state
+        WHERE video_id = ?
+    """, (video_id,))
+    r = cur.fetchone()
+
+    if not r:
+        return None
+
+    return {
+        "video_id": video_id,
+        "next_page_token": r[0],
+        "newest_comment_id": r[1],
+        "backfill_complete": bool(r[2])
+    }
+
+
+def save_ingestion_state(video_id, next_page_token=None, newest_comment_id=None, backfill_complete=False):
+    """Upserts the full checkpoint for a video in its own transaction."""
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO ingestion_state (video_id, next_page_token, newest_comment_id, backfill_complete, updated_at)
+            VALUES (?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+            ON CONFLICT(video_id) DO UPDATE SET
+                next_page_token = excluded.next_page_token,
+                newest_comment_id = excluded.newest_comment_id,
+                backfill_complete = excluded.backfill_complete,
+                updated_at = excluded.updated_at
+        """, (video_id, next_page_token, newest_comment_id, int(backfill_complete)))
+
+
+def update_newest_comment_id(video_id, comment_id):
+    """Advances the live loop's stop_at_id without touching backfill progress."""
+    with transaction() as conn:
+        conn.execute(UPSERT_NEWEST_COMMENT_ID, (video_id, comment_id))
+
+
+def set_closed_until(video_id, window_ts):
+    """Moves a video's watermark; inserts before it mark their window dirty from now on."""
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO ingestion_state (video_id, closed_until, updated_at)
+            VALUES (?, ?, strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+            ON CONFLICT(video_id) DO UPDATE SET
+                closed_until = excluded.closed_until,
+                updated_at = excluded.updated_at
+        """, (video_id, window_ts))
+
+
+def take_dirty_windows(video_id):
+    """Pops the dirty window starts of a video, oldest first."""
+    with transaction() as conn:
+        rows = conn.execute("SELECT window_ts FROM dirty_windows WHERE video_id = ? ORDER BY window_ts",
+                            (video_id,)).fetchall()
+        conn.execute("DELETE FROM dirty_windows WHERE video_id = ?", (video_id,))
+    return [r[0] for r in rows]
+
+
+def get_cached_sentiments(text_hashes):
+    """Returns {text_hash: sentiment} for every hash already scored on a previous run."""
+    if not text_hashes:
+        return {}
+
+    cur = get_connection().cursor()
+    found = {}
+
+    # Stay well under SQLite's bound-parameter limit
+    for i in range(0, len(text_hashes), 500):
+        chunk = text_hashes[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        cur.execute(f"SELECT text_hash, sentiment FROM sentiment_cache WHERE text_hash IN ({placeholders})", chunk)
+        found.update(cur.fetchall())
+
+    return found
+
+
+def insert_cached_sentiments(rows):
+    """Stores (text_hash, sentiment) pairs in a single transaction."""
+    if not rows:
+        return
+
+    with transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO sentiment_cache (text_hash, sentiment) VALUES (?, ?)", rows)
+
+
+def get_embeddings(comment_ids):
+    """Returns {comment_id: vector_bytes} for every comment that has a stored embedding."""
+    if not comment_ids:
+        return {}
+
+    cur = get_connection().cursor()
+    found = {}
+
+    for i in range(0, len(comment_ids), 500):
+        chunk = comment_ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        cur.execute(f"SELECT comment_id, vector FROM comment_embeddings WHERE comment_id IN ({placeholders})", chunk)
+        found.update(cur.fetchall())
+
+    return found
+
+
+def insert_embeddings(rows):
+    """Stores (comment_id, vector_bytes) pairs in a single transaction."""
+    if not rows:
+        return
+
+    with transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO comment_embeddings (comment_id, vector) VALUES (?, ?)", rows)
+        conn.executemany(INSERT_EMBEDDING_SEQ, [(comment_id,) for comment_id, _ in rows])
+
+
+def insert_stats(ts, rows):
+    """Appends (metric, label, value) rows from instrumentation.snapshot() under one timestamp."""
+    with transaction() as conn:
+        conn.executemany("INSERT INTO stage_stats (ts, metric, label, value) VALUES (?, ?, ?, ?)",
+                         [(ts, metric, label, value) for metric, label, value in rows])
+
+
+def collect_table_rows():
+    """Metrics collector: db_rows gauges from each table's highest rowid (no full COUNT(*) scans)."""
+    conn = get_connection()
+    for table in ("comments", "window_metrics", "window_aggregates", "sentiment_cache"):
+        set_gauge("db_rows", table, conn.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").fetchone()[0])
+
+
+def count_embeddings():
+    return get_connection().execute("SELECT COUNT(*) FROM comment_embeddings").fetchone()[0]
+
+
+def iter_embeddings(after_seq=0, batch_size=10000):
+    """
+    Yields lists of (embedding_seq.seq, vector_bytes) for every stored
+    embedding numbered above `after_seq`, in seq order. Every new
+    embedding, including one added later for an old comment, gets a
+    higher seq, so the highest one seen is a resumable watermark.
+    """
+    cur = get_connection().cursor()
+    last = after_seq
+    while True:
+        cur.execute("""
+            SELECT s.seq, e.vector
+            FROM embedding_seq s
+            JOIN comment_embeddings e ON e.comment_id = s.comment_id
+            WHERE s.seq > ?
+            ORDER BY s.seq
+            LIMIT ?
+        """, (last, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield rows
+
+
+def get_comments_by_seq(seqs):
+    """Returns {seq: (comment_id, video_id, published_ts, text)}."""
+    if not seqs:
+        return {}
+
+    cur = get_connection().cursor()
+    found = {}
+
+    for i in range(0, len(seqs), 500):
+        chunk = [int(r) for r in seqs[i:i + 500]]
+        placeholders = ",".join("?" * len(chunk))
+        cur.execute(f"""
+            SELECT s.seq, c.comment_id, c.video_id, c.published_ts, c.text
+            FROM embedding_seq s
+            JOIN comments c ON c.comment_id = s.comment_id
+            WHERE s.seq IN ({placeholders})
+        """, chunk)
+        found.update((r[0], r[1:]) for r in cur.fetchall())
+
+    return found
+
+
+def get_embedding_seqs(comment_ids):
+    """Returns {comment_id: seq} for the comments that have a stored embedding."""
+    if not comment_ids:
+        return {}
+
+    cur = get_connection().cursor()
+    found = {}
+
+    for i in range(0, len(comment_ids), 500):
+        chunk = comment_ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        cur.execute(f"SELECT comment_id, seq FROM embedding_seq WHERE comment_id IN ({placeholders})", chunk)
+        found.update(cur.fetchall())
+
+    return found
 
 
 def normalize_window(window_str):
@@ -1,45 +1,288 @@
+import asyncio
+import queue
+import threading
 import requests
+import aiohttp
 import time
-from config import YTAPIURL
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import recording
+from instrumentation import timed, increment, set_gauge
+from config import YTAPIURL, MAX_CONCURRENT_REQUESTS, DAILY_QUOTA_UNITS, STREAM_PREFETCH_PAGES
 
-def fetch_comments(api_key, video_id, page_token=None):
+# commentThreads.list costs 1 quota unit per page, regardless of maxResults
+COMMENT_THREADS_COST = 1
+# maxResults sent with every commentThreads request
+PAGE_SIZE = 100
+
+# YouTube resets the daily quota at midnight Pacific time
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+# One pooled keep-alive session for every blocking request in this process
+session = requests.Session()
+
+
+class QuotaBudget:
+    """
+    Tracks how many API units each key has spent today and refuses
+    requests that would push a key past its daily allowance.
+
+    Processes sharing one key (shards) attach the same shared_state();
+    spend is then counted across all of them, for all keys together.
+    `share` is the fraction of what remains that this process plans its
+    polling around (see scheduler.py); it does not limit spending.
+    """
+
+    def __init__(self, daily_units=DAILY_QUOTA_UNITS):
+        self.daily_units = daily_units
+        self.spent = {}
+        self.day = None
+        self.shared = None
+        self.share = 1.0
+
+    @staticmethod
+    def shared_state(context):
+        """[day ordinal, units spent] in shared memory, for attach() in every process."""
+        return context.Array("q", 2)
+
+    def attach(self, shared, share=1.0):
+        self.shared = shared
+        self.share = share
+
+    def _roll_day(self):
+        today = datetime.now(QUOTA_TIMEZONE).date()
+        if self.shared is not None:
+            # Caller holds the shared lock
+            if self.shared[0] != today.toordinal():
+                self.shared[0] = today.toordinal()
+                self.shared[1] = 0
+        elif today != self.day:
+            self.day = today
+            self.spent = {}
+
+    def remaining(self, api_key):
+        if self.shared is not None:
+            with self.shared.get_lock():
+                self._roll_day()
+                return self.daily_units - self.shared[1]
+        self._roll_day()
+        return self.daily_units - self.spent.get(api_key, 0)
+
+    def seconds_until_reset(self):
+        now = datetime.now(QUOTA_TIMEZONE)
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), QUOTA_TIMEZONE)
+        return max(1.0, (midnight - now).total_seconds())
+
+    def try_spend(self, api_key, units=COMMENT_THREADS_COST):
+        """Reserves `units` for this key. Returns False if the budget is exhausted."""
+        if self.shared is not None:
+            with self.shared.get_lock():
+                if self.remaining(api_key) < units:
+                    return False
+                self.shared[1] += units
+                return True
+        if self.remaining(api_key) < units:
+            return False
+        self.spent[api_key] = self.spent.get(api_key, 0) + units
+        return True
+
+
+# Shared across sync and async fetches so both draw from the same budget
+quota_budget = QuotaBudget()
+
+
+class PageTokenRejected(Exception):
+    """The API refused a request's pageToken (HTTP 400 invalidPageToken), e.g. a saved one that expired."""
+
+
+def _page_token_rejected(response, page_token):
+    if not page_token or response.status_code != 400:
+        return False
+    try:
+        errors = response.json().get("error", {}).get("errors", [])
+    except ValueError:
+        return False
+    return any(e.get("reason") == "invalidPageToken" for e in errors)
+
+
+def _build_params(api_key, video_id, page_token=None):
     params = {
         "part": "snippet",
         "videoId": video_id,
         "key": api_key,
-        "maxResults": 100,
+        "maxResults": PAGE_SIZE,
         "order": "time",
         "textFormat": "plainText"
     }
 
     if page_token:
         params["pageToken"] = page_token
+    return params
+
+
+def fetch_comments(api_key, video_id, page_token=None):
+    # Returns None when the quota is spent or the request fails (worth retrying
+    # later); raises PageTokenRejected when retrying the same token never will work.
+
+    # Offline: recorded pages cost no quota and need no network
+    if recording.source:
+        return recording.source.fetch(video_id, page_token)
+
+    if not quota_budget.try_spend(api_key):
+        print(f"Quota exhausted for today, skipping fetch for {video_id}")
+        return None
+
+    params = _build_params(api_key, video_id, page_token)
 
     try:
-        response = requests.get(YTAPIURL, params=params)
-        response.raise_for_status()
-        return response.json()
+        with timed("api_request"):
+            response = session.get(YTAPIURL, params=params)
+            if _page_token_rejected(response, page_token):
+                raise PageTokenRejected(f"pageToken rejected for {video_id}")
+            response.raise_for_status()
+            data = response.json()
+        increment("api_pages")
+        increment("comments_fetched", len(data.get("items", [])))
+        if recording.recorder:
+            recording.recorder.record(video_id, page_token, data)
+        return data
 
     except requests.RequestException as e:
         print(f"API request error: {e}")
         return None
 
 
+def iter_comment_pages(api_key, video_id, stop_at_id=None, page_token=None):
+    """
+    Yields (items, next_page_token) one API page at a time, newest first.
+    Stops early once stop_at_id is seen, yielding only the items before it.
+    A failed request or spent quota just ends the pages; a page_token the
+    API rejects raises PageTokenRejected.
+    """
+    while True:
+        data = fetch_comments(api_key, video_id, page_token)
+        if not data:
+            return
+
+        items = data.get("items", [])
+        page_token = data.get("nextPageToken")
+
+        # Check if we've reached a comment we already have
+        for i, item in enumerate(items):
+            if stop_at_id and item['id'] == stop_at_id:
+                if i:
+                    yield items[:i], None
+                return
+
+        yield items, page_token
+
+        if not page_token:
+            return
+
+
+def prefetch_pages(pages, max_pages=STREAM_PREFETCH_PAGES):
+    """
+    Pulls pages from `pages` on a background thread so the next request is
+    in flight while the caller processes the current one. The queue is
+    bounded, so the fetcher blocks once it is `max_pages` ahead.
+    """
+    buffer = queue.Queue(maxsize=max_pages)
+    done = object()
+    stop = threading.Event()
+    error = []
+
+    def put(item):
+        # Blocks while the consumer is behind, but gives up once it has gone away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+        except Exception as e:
+            # Raised to the consumer after the pages that came before it
+            error.append(e)
+        finally:
+            put(done)
+
+    worker = threading.Thread(target=producer, daemon=True)
+    worker.start()
+
+    try:
+        while True:
+            page = buffer.get()
+            set_gauge("queue_depth", "prefetch", buffer.qsize())
+            if page is done:
+                if error:
+                    raise error[0]
+                return
+            yield page
+    finally:
+        # Consumer stopped early (or crashed): let the producer exit
+        stop.set()
+
+
 def fetch_all_comments(api_key, video_id, stop_at_id=None):
+    all_items = []
+    for items, _ in iter_comment_pages(api_key, video_id, stop_at_id=stop_at_id):
+        all_items.extend(items)
+    return all_items
+
+
+async def fetch_comments_async(http, api_key, video_id, page_token=None, quota=quota_budget):
+    """Async twin of fetch_comments that reuses the caller's aiohttp session."""
+    if recording.source:
+        return recording.source.fetch(video_id, page_token)
+
+    if not quota.try_spend(api_key):
+        print(f"Quota exhausted for today, skipping fetch for {video_id}")
+        return None
+
+    params = _build_params(api_key, video_id, page_token)
+
+    try:
+        with timed("api_request"):
+            async with http.get(YTAPIURL, params=params) as response:
+                response.raise_for_status()
+                data = await response.json()
+        increment("api_pages")
+        increment("comments_fetched", len(data.get("items", [])))
+        if recording.recorder:
+            recording.recorder.record(video_id, page_token, data)
+        return data
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"API request error: {e}")
+        return None
+
+
+async def fetch_all_comments_async(http, api_key, video_id, stop_at_id=None, quota=quota_budget):
+    """
+    Same paging and stop_at_id semantics as fetch_all_comments, except that
+    a failed request (or spent quota) returns None instead of the pages
+    before it: a poll that stops short must not move the caller's stop_at_id
+    past comments it never fetched, nor count as a quiet poll.
+    """
     page_token = None
     all_items = []
 
     while True:
-        data = fetch_comments(api_key, video_id, page_token)
+        data = await fetch_comments_async(http, api_key, video_id, page_token, quota)
         if not data:
-            break
+            return None
 
         items = data.get("items", [])
 
-        # Check if we've reached a comment we already have
         for item in items:
             if stop_at_id and item['id'] == stop_at_id:
-                return all_items  # Stop immediately and return what we found
+                return all_items
             all_items.append(item)
 
         page_token = data.get("nextPageToken")
@@ -49,6 +292,97 @@ def fetch_all_comments(api_key, video_id, stop_at_id=None):
     return all_items
 
 
+class ConcurrentFetcher:
+    def __init__(self, concurrency=MAX_CONCURRENT_REQUESTS):
+        """
+        One event loop on a background thread and one aiohttp session that
+        outlive any single call, so every live round reuses the keep-alive
+        connections (and TLS sessions) of the rounds before it. Both start
+        on first use; close() releases them.
+        """
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._http = None
+
+    def _session(self):
+        # Only ever called on the loop thread
+        if self._http is None:
+            # The connector caps open sockets; each call's semaphore caps videos being paged at once
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=60)
+            self._http = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._http
+
+    async def _fetch_many(self, api_key, video_ids, stop_ids, concurrency, quota):
+        http = self._session()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_one(video_id):
+            async with semaphore:
+                items = await fetch_all_comments_async(
+                    http, api_key, video_id, stop_at_id=stop_ids.get(video_id), quota=quota
+                )
+                return video_id, items
+
+        return dict(await asyncio.gather(*(fetch_one(v) for v in video_ids)))
+
+    def fetch(self, api_key, video_ids, stop_ids, concurrency, quota):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+            loop = self._loop
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._fetch_many(api_key, video_ids, stop_ids, concurrency, quota), loop
+        )
+        try:
+            return future.result()
+        except BaseException:
+            # Ctrl+C while waiting: don't leave the round running on the loop
+            future.cancel()
+            raise
+
+    async def _close_session(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._close_session(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = self._thread = None
+
+
+# Lives as long as the process (or until close_fetcher), like `session` above
+concurrent_fetcher = ConcurrentFetcher()
+
+
+def fetch_all_comments_concurrent(api_key, video_ids, stop_ids=None,
+                                  concurrency=MAX_CONCURRENT_REQUESTS, quota=quota_budget):
+    """
+    Fetches every video in parallel over pooled keep-alive connections,
+    kept open between calls. Returns {video_id: items}, where each items
+    list is exactly what fetch_all_comments(api_key, video_id,
+    stop_at_id=stop_ids[video_id]) would return, or None where a request
+    failed (see fetch_all_comments_async).
+    """
+    return concurrent_fetcher.fetch(api_key, list(video_ids), stop_ids or {}, concurrency, quota)
+
+
+def close_fetcher():
+    """Closes the pooled connections and the event loop behind fetch_all_comments_concurrent."""
+    concurrent_fetcher.close()
+
+
 def parse_comment(item, video_id):
     top_level = item.get("snippet", {}).get("topLevelComment", {})
     snippet = top_level.get("snippet", {})
@@ -63,4 +397,4 @@ def parse_comment(item, video_id):
         "text": snippet.get("textOriginal", ""),
         "published_at": snippet.get("publishedAt"),
         "fetched_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,200 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import METRICS_ENABLED
+
+# Per-process counters for the hot path, exposed in the Prometheus text
+# format. While disabled, timed() hands back one shared no-op context and
+# every other call returns after a single flag check, so instrumented code
+# costs next to nothing. Pipeline inference workers are separate processes;
+# what they record stays there, the parent sees the stages around them.
+
+ENABLED = METRICS_ENABLED
+PREFIX = "ytcba_"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+# family -> (type, help, label name, buckets)
+FAMILIES = {
+    "stage_seconds": ("histogram", "Wall time of each pipeline stage.", "stage", LATENCY_BUCKETS),
+    "batch_size": ("histogram", "Texts per model forward pass.", "model", SIZE_BUCKETS),
+    "items_total": ("counter", "Items processed, by kind.", "kind", None),
+    "queue_depth": ("gauge", "Items waiting in a pipeline queue.", "queue", None),
+    "db_rows": ("gauge", "Rows per table (highest rowid).", "table", None),
+}
+
+_NULL = nullcontext()
+_lock = threading.Lock()
+_values = {}       # (family, label) -> Histogram or float
+_collectors = []   # Called before every scrape/snapshot to refresh gauges
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("stage_seconds", self.stage, time.perf_counter() - self.start)
+
+
+def observe(family, label, value):
+    """Adds one observation to a histogram family."""
+    if not ENABLED:
+        return
+    with _lock:
+        histogram = _values.get((family, label))
+        if histogram is None:
+            histogram = _values[(family, label)] = Histogram(FAMILIES[family][3])
+        histogram.observe(value)
+
+
+def increment(kind, n=1):
+    """Increments items_total{kind}."""
+    if not ENABLED:
+        return
+    with _lock:
+        _values[("items_total", kind)] = _values.get(("items_total", kind), 0) + n
+
+
+def set_gauge(family, label, value):
+    if not ENABLED:
+        return
+    with _lock:
+        _values[(family, label)] = value
+
+
+def timed(stage):
+    """Context manager recording the block's latency under stage_seconds{stage}."""
+    return _Timer(stage) if ENABLED else _NULL
+
+
+def instrument(stage):
+    """Decorator form of timed() for functions with several exits."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _Timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_collector(fn):
+    """Registers a zero-argument function that refreshes gauges (e.g. DB row counts)."""
+    if fn not in _collectors:
+        _collectors.append(fn)
+
+
+def _collect():
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception as e:
+            print(f"Metrics collector {fn.__name__} failed: {e}")
+
+
+def _escape(label):
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    _collect()
+    with _lock:
+        items = sorted(_values.items(), key=lambda item: (item[0][0], str(item[0][1])))
+        lines = []
+        current = None
+        for (family, label), value in items:
+            kind, help_text, label_name, buckets = FAMILIES[family]
+            name = PREFIX + family
+            if family != current:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                current = family
+            labels = f'{label_name}="{_escape(label)}"'
+
+            if kind != "histogram":
+                lines.append(f"{name}{{{labels}}} {value}")
+                continue
+
+            cumulative = 0
+            for bound, n in zip(list(buckets) + ["+Inf"], value.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {value.sum}")
+            lines.append(f"{name}_count{{{labels}}} {value.count}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    """Flat (metric, label, value) rows; histograms contribute their _count and _sum."""
+    _collect()
+    rows = []
+    with _lock:
+        for (family, label), value in _values.items():
+            if isinstance(value, Histogram):
+                rows.append((family + "_count", str(label), value.count))
+                rows.append((family + "_sum", str(label), value.sum))
+            else:
+                rows.append((family, str(label), value))
+    return rows
+
+
+def save_stats():
+    """Appends the current snapshot to the stage_stats table."""
+    if not ENABLED:
+        return
+    from database import insert_stats
+    insert_stats(int(time.time()), snapshot())
+
+
+def start_server(port, host="127.0.0.1"):
+    """Serves /metrics on a daemon thread. Returns the server (None if disabled)."""
+    if not ENABLED or not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes every few seconds would flood the console
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics endpoint: http://{host}:{port}/metrics")
+    return server
@@ -1,120 +1,269 @@
-from datetime import datetime, timezone
-from database import init_db, insert_comments_batch, get_window_metrics, get_all_window_metrics, insert_window_metrics
-from ingestion import fetch_all_comments, parse_comment
-from config import YTAPI, POLL_INTERVAL
-from analysis.rollingbaseline import RollingBaseline
-from analysis.sentiment import sentiment_pipeline, sentiment_score
-from analysis.abnormal_patterns import detect_abnormal_patterns
+from database import (init_db, insert_comments_batch, get_all_window_metrics, get_window_series, insert_window_metrics,
+                      insert_window_metrics_batch,
+                      get_ingestion_state, save_ingestion_state, update_newest_comment_id, close_connection,
+                      to_epoch, collect_table_rows, set_closed_until, take_dirty_windows, AGGREGATE_WINDOW)
+from ingestion import fetch_all_comments_concurrent, close_fetcher, prefetch_pages, parse_comment
+from config import (YTAPI, POLL_INTERVAL, STREAM_FLUSH_COMMENTS, PIPELINE_WORKERS, BULK_REPLAY, EMBED_AT_INGEST,
+                    ANN_ENABLED, SHARD_WORKERS, METRICS_PORT, METRICS_STATS_TABLE, ALLOWED_LATENESS)
+from analysis.rollingbaseline import create_baseline
+from analysis.sentiment import score_texts, model_tag
+from analysis.sentiment_cache import SentimentCache
+from analysis.embeddings import embed_comments
+from analysis.ann import get_index
+from analysis.models import registry
+from pipeline import run_pipelined_backfill, score_comments, iter_backfill_pages
+from analysis.abnormal_patterns import detect_abnormal_patterns, classify_alerts, collect_evidence_batch
+from scheduler import PollScheduler, rate_from_windows
+import instrumentation
+import recording
 import time
 
 API_KEY = YTAPI
 VIDEOS = ["VgsC_aBquUE"]
 
+# Bot floods repeat the same text thousands of times; only score each one once
+sentiment_cache = SentimentCache(score_texts, namespace=model_tag)
+
 def main(test_mode=False):
     if not API_KEY:
         raise RuntimeError("YOUTUBE_API_KEY not set in environment")
 
+    if SHARD_WORKERS > 0 and not test_mode:
+        # One process (and one SQLite shard) per partition of the fleet
+        from sharding import run_sharded
+        run_sharded(VIDEOS, SHARD_WORKERS)
+        return
+
+    monitor(VIDEOS, test_mode)
+
+
+def monitor(videos, test_mode=False, stop=None, heartbeat=None, metrics_port=METRICS_PORT):
+    """
+    Backfills, replays and then live-monitors `videos` against the current
+    database. `stop` (an Event) ends the live loop after the current round;
+    `heartbeat` is called once per round so a coordinator can see progress.
+    """
     init_db()
-    baselines = {v: RollingBaseline() for v in VIDEOS}
+    # Both are no-ops unless METRICS_ENABLED
+    instrumentation.register_collector(collect_table_rows)
+    instrumentation.start_server(metrics_port)
+    baselines = {v: create_baseline() for v in videos}
     latest_ids = {}
 
     # --- STEP 1: INITIAL HISTORICAL POPULATION ---
     print("Performing initial historical fetch and replay...")
-    for v in VIDEOS:
-        # 1. Fetch EVERYTHING
-        items = fetch_all_comments(API_KEY, v)
-
-        if items:
-            # Save the NEWEST ID now so the while-loop doesn't fetch history again
-            latest_ids[v] = items[0]['id']
+    if PIPELINE_WORKERS > 0:
+        # Fetch, inference and DB writes overlap across every video at once
+        latest_ids.update(run_pipelined_backfill(API_KEY, videos))
+    else:
+        # Load the sentiment model up front so the first page isn't stuck behind it
+        registry.warm("sentiment", *(["similarity"] if EMBED_AT_INGEST else []))
+
+        for v in videos:
+            state = get_ingestion_state(v)
+
+            if state and state["backfill_complete"]:
+                # Backfilled on a previous run: the live loop resumes from the saved ID
+                latest_ids[v] = state["newest_comment_id"]
+            else:
+                # 1. Stream EVERYTHING (or the rest of an interrupted backfill), saving page by page
+                newest_id = stream_and_save_comments(API_KEY, v, checkpoint=True)
+
+                if newest_id:
+                    # Save the NEWEST ID now so the while-loop doesn't fetch history again
+                    latest_ids[v] = newest_id
+
+    # 2. Index the stored embeddings so alerts can search past narratives
+    if ANN_ENABLED:
+        ann_index = get_index()
+        ann_index.sync()
+        ann_index.maybe_rebuild()
+
+    # Start of each video's first window the live loop has not closed yet.
+    # Only closed windows are replayed; still-filling ones are left to the live loop.
+    watermark = closed_watermark()
+    closed_until = {}
+    recent_rates = {}
+    for v in videos:
+        # 3. Replay (Must return MULTIPLE windows to work correctly)
+        windows = replay_historical(baselines[v], video_id=v, end_ts=watermark)
 
-            # 2. Process and save
-            process_and_save_comments(items, v)
+        # Comments landing in a replayed window from now on are late
+        take_dirty_windows(v)  # Marked before this replay, which already counted them
+        closed_until[v] = watermark
+        set_closed_until(v, watermark)
+        recent_rates[v] = rate_from_windows(windows, recording.now().timestamp())
 
-        # 3. Replay (Must return MULTIPLE windows to work correctly)
-        replay_historical(baselines[v], video_id=v)
+    print(sentiment_cache.report())
 
     if test_mode:
         return
 
-    last_window_start = datetime.now(timezone.utc)
+    # Busy videos are polled often, quiet ones rarely (all of them right away)
+    scheduler = PollScheduler(videos, API_KEY, recording.now().timestamp(),
+                              rates={v: r for v, r in recent_rates.items() if r is not None})
 
     # --- STEP 2: LIVE MONITORING LOOP ---
     try:
         while True:
-            # We use a fixed window end so all videos in this "round" share the same timeframe
-            window_end = datetime.now(timezone.utc)
+            round_start = time.perf_counter()
+
+            # Poll the videos that are due in parallel, each stopping at the
+            # ID we caught during the historical fetch (or previous loop)
+            due = scheduler.due(recording.now().timestamp())
+            fetched = fetch_all_comments_concurrent(API_KEY, due, stop_ids=latest_ids) if due else {}
+            polled_at = recording.now().timestamp()
+
+            watermark = closed_watermark()
 
-            for video_id in VIDEOS:
-                # Use the ID we caught during the historical fetch (or previous loop)
-                stop_id = latest_ids.get(video_id)
-                items = fetch_all_comments(API_KEY, video_id, stop_at_id=stop_id)
+            for video_id in videos:
+                items = fetched.get(video_id)
+                if video_id in fetched:
+                    # None: the poll failed, which says nothing about the comment rate
+                    scheduler.record(video_id, None if items is None else len(items), polled_at)
 
                 if items:
+                    # The new stop_at_id is committed with the comments, never before them
+                    process_and_save_comments(items, video_id, newest_comment_id=items[0]['id'])
                     latest_ids[video_id] = items[0]['id']
-                    process_and_save_comments(items, video_id)
-
-                # Compute metrics for the specific time since the last loop
-                metrics = get_window_metrics(
-                    last_window_start.isoformat(),
-                    window_end.isoformat(),
-                    video_id=video_id  # IMPORTANT: ensure this function filters by video!
-                )
-
-                # Only evaluate and update if there's actually data in this window
-                # (prevents polluting baseline with empty '0' windows if video is quiet)
-                if metrics["total_comments"] > 0:
-                    z = baselines[video_id].evaluate(metrics)
-                    if z:
-                        detect_abnormal_patterns(z, metrics, video_id)
-
-
-                        score = baselines[video_id].coordination_score(z)
-                    else:
-                        score = None
-
-                    metrics["coordination_score"] = score
-
-                    insert_window_metrics({
-                        "video_id": video_id,
-                        "window": last_window_start.strftime('%Y-%m-%d %H:%M:%S'),
-                        "total_comments": metrics["total_comments"],
-                        "unique_authors": metrics["unique_authors"],
-                        "avg_length": metrics.get("avg_length", 0),
-                        "avg_sentiment": metrics.get("avg_sentiment", 0),
-                        "sentiment_variance": metrics.get("sentiment_variance", 0),
-                        "avg_gap": metrics.get("avg_gap", 0),
-                        "gap_variance": metrics.get("gap_variance", 0),
-                        "coordination_score": score
-                    })
-
-                    baselines[video_id].update(metrics)
-
-            last_window_start = window_end  # Move the window forward
+
+                # 1. Late comments in windows that were already closed
+                dirty = take_dirty_windows(video_id)
+                if dirty:
+                    baselines[video_id] = rescore_late_windows(baselines[video_id], video_id, dirty,
+                                                               closed_until[video_id])
+
+                # 2. Windows that closed since the last round, oldest first (polled or not)
+                if watermark > closed_until[video_id]:
+                    close_windows(baselines[video_id], video_id, closed_until[video_id], watermark)
+                    closed_until[video_id] = watermark
+                    set_closed_until(video_id, watermark)
+
+            # New embeddings go to the index's delta; retraining runs off the loop
+            if ANN_ENABLED:
+                ann_index.sync()
+                ann_index.maybe_rebuild(background=True)
+
+            instrumentation.observe("stage_seconds", "live_round", time.perf_counter() - round_start)
+            if METRICS_STATS_TABLE:
+                instrumentation.save_stats()
+            if heartbeat:
+                heartbeat()
             if test_mode: break
-            time.sleep(POLL_INTERVAL)
+            if recording.exhausted(videos):
+                print("Replay finished: no recorded polls left for the monitored videos.")
+                break
+
+            # Wake for the next poll or the next window to close, whichever is first
+            wake = watermark + AGGREGATE_WINDOW + ALLOWED_LATENESS
+            next_poll = scheduler.next_poll()
+            if next_poll is not None:
+                wake = min(wake, next_poll)
+            if recording.sleep(max(0.0, wake - recording.now().timestamp()), stop):
+                break
     except KeyboardInterrupt:
         print("\nShutting down live monitoring cleanly...")
     finally:
-        # If you have any final cleanup, it goes here
-        pass
+        # Closes the pooled API connections, then checkpoints the WAL and releases the DB connection
+        close_fetcher()
+        close_connection()
+
+
+def closed_watermark():
+    """
+    Event-time watermark: start of the first window that is not final yet.
+    Windows ending ALLOWED_LATENESS before the clock (wall or recorded,
+    see recording.py) are final.
+    """
+    watermark = int(recording.now().timestamp()) - ALLOWED_LATENESS
+    return watermark - watermark % AGGREGATE_WINDOW
+
+
+def close_windows(baseline, video_id, start_ts, end_ts):
+    """
+    Scores, alerts on and saves every window of `video_id` starting in
+    [start_ts, end_ts), oldest first, then feeds it to the baseline. These
+    are the same event-time buckets the replay uses.
+    """
+    # Only non-empty windows exist in window_aggregates
+    # (prevents polluting baseline with empty '0' windows if video is quiet)
+    for metrics in get_window_series(video_id, start_ts, end_ts):
+        z = baseline.evaluate(metrics)
+        if z:
+            detect_abnormal_patterns(z, metrics, video_id)
+            score = baseline.coordination_score(z)
+        else:
+            score = None
+
+        metrics["coordination_score"] = score
+        insert_window_metrics(metrics)
+        baseline.update(metrics)
+
+
+def rescore_late_windows(baseline, video_id, dirty, closed_until):
+    """
+    Recomputes closed windows that received late comments (`dirty`, window
+    starts oldest first), the window after each (its boundary gap moved)
+    and the scores of the max_windows windows whose baseline history
+    included them. Nothing else is replayed. Returns the baseline to keep
+    using: rebuilt if the corrected windows are part of its history.
+    """
+    from analysis.vectorized import score_window_series
+
+    max_windows = baseline.max_windows
+    # The max_windows windows before the first dirty one are its (unchanged) history
+    windows = get_window_series(video_id, dirty[0], closed_until, before=max_windows)
+    starts = [to_epoch(w["window"]) for w in windows]
+    first = starts.index(dirty[0])
+    last = starts.index(dirty[-1])
+    stop = min(len(windows), last + 2 + max_windows)
+
+    print(f"Late comments in {len(dirty)} closed window(s) of {video_id}, "
+          f"rescoring {stop - first} from {windows[first]['window']}")
+
+    dirty = set(dirty)  # Only these can raise new alerts; the rest just get new scores
+    for w, ts, (z, score) in zip(windows[first:stop], starts[first:stop],
+                                 score_window_series(windows[:stop], max_windows, baseline.warmup)[first:]):
+        w["coordination_score"] = score
+        if z and ts in dirty:
+            detect_abnormal_patterns(z, w, video_id)
 
+    insert_window_metrics_batch(windows[first:stop])
 
-def replay_historical(baseline, video_id=None):
+    if len(windows) - (last + 2) >= max_windows:
+        return baseline
+
+    # The live baseline remembers the corrected windows' old values
+    rebuilt = create_baseline()
+    for w in get_window_series(video_id, closed_until, closed_until, before=max_windows):
+        rebuilt.update(w)
+    return rebuilt
+
+
+def replay_historical(baseline, video_id=None, bulk=BULK_REPLAY, end_ts=None):
     """
     Reprocess historical comments into window metrics
     and populate the rolling baseline.
 
     This analyzes data window-by-window so the baseline
     reflects historical behavior before live data.
+    With `end_ts`, only windows starting before it are replayed.
+    Returns the replayed windows.
     """
     print("Starting historical replay...")
 
     windows = get_all_window_metrics(video_id,POLL_INTERVAL)
+    if end_ts is not None:
+        windows = [w for w in windows if to_epoch(w["window"]) < end_ts]
 
     if not windows:
         print("No historical windows found.")
-        return
+        return []
+
+    # The bulk path assumes it is building the baseline from nothing
+    if bulk and baseline._size() == 0:
+        replay_historical_bulk(baseline, windows, video_id)
+        return windows
 
     for w in windows:
         # 1. INITIALIZE SCORE (Prevents the UnboundLocalError)
@@ -136,31 +285,103 @@ def replay_historical(baseline, video_id=None):
         baseline.update(w)
 
     print("Historical replay complete.")
+    return windows
+
+
+def stream_and_save_comments(api_key, video_id, stop_at_id=None, flush_size=STREAM_FLUSH_COMMENTS,
+                             checkpoint=False):
+    """
+    Backfills a video without holding it in memory. Pages are prefetched
+    into a small bounded queue and flushed through parsing, sentiment and
+    the DB whenever `flush_size` raw items have accumulated, so memory
+    stays flat no matter how many comments the video has.
+
+    With checkpoint=True, progress is saved to ingestion_state after every
+    flush (always on a page boundary) and an unfinished backfill resumes
+    from its saved nextPageToken instead of page one (see iter_backfill_pages).
+
+    Returns the newest comment ID seen (or None if nothing was fetched).
+    """
+    state = get_ingestion_state(video_id) if checkpoint else None
+    # A resumed backfill keeps the newest ID recorded by its first page
+    newest_id = state["newest_comment_id"] if state and state["next_page_token"] else None
+
+    buffer = []
+    saved = 0
+    pages_seen = 0
+    next_token = None
+
+    pages = prefetch_pages(iter_backfill_pages(api_key, video_id, state, stop_at_id=stop_at_id))
+    for items, next_token, newest_id in pages:
+        pages_seen += 1
+
+        buffer.extend(items)
+        if len(buffer) >= flush_size:
+            saved += len(process_and_save_comments(buffer, video_id))
+            buffer = []
+            if checkpoint:
+                save_ingestion_state(video_id, next_token, newest_id, backfill_complete=next_token is None)
 
+    if buffer:
+        saved += len(process_and_save_comments(buffer, video_id))
 
-def process_and_save_comments(items, video_id):
+    if checkpoint and pages_seen:
+        # next_token is only None once the final page has been processed;
+        # a failed request leaves it pointing at the page to retry
+        save_ingestion_state(video_id, next_token, newest_id, backfill_complete=next_token is None)
+
+    print(f"Saved {saved} comments for {video_id}")
+    return newest_id
+
+
+def replay_historical_bulk(baseline, windows, video_id=None):
+    """
+    Same results as the window-by-window replay, computed as whole-series
+    NumPy arrays. Alert evidence only runs for windows that trip a
+    threshold, and every window_metrics row is written in one transaction.
+    """
+    from analysis.vectorized import score_window_series
+
+    alerting = []
+    for w, (z, score) in zip(windows, score_window_series(windows, baseline.max_windows, baseline.warmup)):
+        w["coordination_score"] = score
+        if z and classify_alerts(z, w):
+            alerting.append((z, w))
+
+    # Evidence for every alerting window comes back from one batched query
+    evidence = collect_evidence_batch([w for _, w in alerting])
+    for z, w in alerting:
+        detect_abnormal_patterns(z, w, w["video_id"], evidence=evidence[(w["video_id"], to_epoch(w["window"]))])
+
+    insert_window_metrics_batch(windows)
+
+    # Leave the baseline exactly where the per-window loop would have
+    for w in windows[-baseline.max_windows:]:
+        baseline.update(w)
+
+    print(f"Historical replay complete ({len(windows)} windows).")
+
+
+@instrumentation.instrument("process_comments")
+def process_and_save_comments(items, video_id, newest_comment_id=None):
     # 1. Parse API items
     comments = [parse_comment(item, video_id) for item in items]
     comments = [c for c in comments if c is not None]
 
     if not comments:
+        if newest_comment_id:
+            update_newest_comment_id(video_id, newest_comment_id)
         return []
 
-    # 2. Batch-process sentiment
-    valid_comments = [c for c in comments if c["text"].strip()]
-    if valid_comments:
-        texts = [c["text"] for c in valid_comments]
-        results = sentiment_pipeline(texts, batch_size=32, truncation=True, max_length=512)
-
-        for comment, result in zip(valid_comments, results):
-            comment["sentiment"] = sentiment_score(result)
+    # 2. Batch-process sentiment (every comment leaves with a sentiment key, even invalid ones)
+    score_comments(comments, sentiment_cache)
 
-    # 3. Ensure every comment has a sentiment key before DB insert, even those that were invalid
-    for comment in comments:
-        comment.setdefault("sentiment", 0.0)
+    # 3. Sentence vectors for alert-time similarity, stored with the comments
+    if EMBED_AT_INGEST:
+        embed_comments(comments)
 
     # 4. ONE database trip for the entire batch (Way faster!)
-    insert_comments_batch(comments)
+    insert_comments_batch(comments, checkpoint=(video_id, newest_comment_id) if newest_comment_id else None)
 
     return comments
 
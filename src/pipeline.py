@@ -0,0 +1,290 @@
+import multiprocessing
+import queue
+import signal
+import threading
+import database
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from database import insert_comments_batch, get_ingestion_state, save_ingestion_state
+from ingestion import iter_comment_pages, parse_comment, PageTokenRejected
+from instrumentation import set_gauge
+from config import (PIPELINE_WORKERS, PIPELINE_QUEUE_PAGES, PIPELINE_WRITE_ROWS, MAX_CONCURRENT_REQUESTS,
+                    EMBED_AT_INGEST)
+
+_DONE = object()
+
+# Set once per worker process by _init_worker
+_worker_cache = None
+
+
+def score_comments(comments, cache):
+    """Fills in comment["sentiment"] for a list of parsed comments, in place."""
+    valid_comments = [c for c in comments if c["text"].strip()]
+    if valid_comments:
+        scores = cache.score([c["text"] for c in valid_comments])
+
+        for comment, score in zip(valid_comments, scores):
+            comment["sentiment"] = score
+
+    # Every comment needs a sentiment key before DB insert, even those that were invalid
+    for comment in comments:
+        comment.setdefault("sentiment", 0.0)
+
+    return comments
+
+
+def iter_backfill_pages(api_key, video_id, state=None, stop_at_id=None):
+    """
+    Yields (items, next_page_token, newest_comment_id) through one video's
+    backfill, resuming from the checkpoint in `state` (its ingestion_state
+    row) when that has a page token. newest_comment_id is where the live
+    loop stops afterwards: the first comment of the backfill's first page.
+
+    Tokens expire: if the API rejects the saved one, the checkpoint is
+    cleared and the backfill starts over from the newest page right away.
+    Spent quota or a failed request only end the pages early and leave the
+    checkpoint alone, so the next run resumes from it. Both the serial and
+    the pipelined backfill page through here.
+    """
+    page_token = state["next_page_token"] if state else None
+    newest_id = state["newest_comment_id"] if page_token else None
+    seen = False
+
+    while True:
+        try:
+            for items, next_token in iter_comment_pages(api_key, video_id, stop_at_id=stop_at_id,
+                                                        page_token=page_token):
+                seen = True
+                if items and newest_id is None:
+                    newest_id = items[0]['id']
+                yield items, next_token, newest_id
+            return
+        except PageTokenRejected:
+            if seen:
+                # A token from this run; the checkpoint now points at it, so the next run starts over
+                print(f"Page token rejected partway through {video_id}, stopping its backfill here")
+                return
+
+        print(f"Saved page token for {video_id} was rejected, restarting its backfill from the newest page")
+        save_ingestion_state(video_id, None, None, backfill_complete=False)
+        page_token = newest_id = None
+
+
+def _init_worker(threads, db_path):
+    """Loads the model once per worker process."""
+    global _worker_cache
+    import torch
+    from analysis.models import registry
+    from analysis.sentiment import score_texts, model_tag
+    from analysis.sentiment_cache import SentimentCache
+
+    # The coordinator owns Ctrl+C and drains the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The sentiment cache must hit the same database as the parent
+    database.DB_PATH = db_path
+
+    # Importing the embedding module registers the similarity model
+    if EMBED_AT_INGEST:
+        import analysis.embeddings
+        registry.warm("similarity")
+    registry.warm("sentiment")
+    # Split the cores between workers instead of oversubscribing them
+    torch.set_num_threads(threads)
+    _worker_cache = SentimentCache(score_texts, namespace=model_tag)
+
+
+def _score_in_worker(comments):
+    score_comments(comments, _worker_cache)
+    if EMBED_AT_INGEST:
+        from analysis.embeddings import embed_comments
+        embed_comments(comments)
+    return comments
+
+
+class _Writer(threading.Thread):
+    def __init__(self, results, newest_ids, batch_rows):
+        """
+        The only thread that writes comments. Batches scored pages into
+        large transactions, then advances each video's checkpoint through
+        the longest run of consecutive pages that are safely on disk.
+        """
+        super().__init__(daemon=True)
+        self.results = results
+        self.newest_ids = newest_ids
+        self.batch_rows = batch_rows
+        self.saved = 0
+
+        self.next_seq = defaultdict(int)     # video_id -> first page not yet checkpointed
+        self.written = defaultdict(dict)     # video_id -> {seq: next_page_token}
+
+    def run(self):
+        rows, pages = [], []
+
+        while True:
+            try:
+                item = self.results.get(timeout=1.0)
+            except queue.Empty:
+                item = None
+
+            if item is _DONE:
+                break
+
+            set_gauge("queue_depth", "results", self.results.qsize())
+            if item is not None:
+                video_id, seq, next_token, comments = item
+                rows.extend(comments)
+                pages.append((video_id, seq, next_token))
+
+            # Flush when the batch is big enough, or whenever the queue goes idle
+            if pages and (len(rows) >= self.batch_rows or item is None):
+                self._flush(rows, pages)
+                rows, pages = [], []
+
+        self._flush(rows, pages)
+
+    def _flush(self, rows, pages):
+        if rows:
+            insert_comments_batch(rows)
+            self.saved += len(rows)
+
+        touched = set()
+        for video_id, seq, next_token in pages:
+            self.written[video_id][seq] = next_token
+            touched.add(video_id)
+
+        for video_id in touched:
+            done = self.written[video_id]
+            if self.next_seq[video_id] not in done:
+                continue
+
+            # Pages finish out of order; only checkpoint a contiguous prefix
+            while self.next_seq[video_id] in done:
+                token = done.pop(self.next_seq[video_id])
+                self.next_seq[video_id] += 1
+
+            save_ingestion_state(video_id, token, self.newest_ids.get(video_id), backfill_complete=token is None)
+
+
+def _fetch_videos(api_key, video_ids, pages, newest_ids, stop):
+    """Fetcher thread: pages through each assigned video, resuming from its checkpoint."""
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        while not stop.is_set():
+            try:
+                video_id = video_ids.pop()
+            except IndexError:
+                return
+
+            state = get_ingestion_state(video_id)
+            if state and state["backfill_complete"]:
+                newest_ids[video_id] = state["newest_comment_id"]
+                continue
+
+            if state and state["next_page_token"]:
+                newest_ids[video_id] = state["newest_comment_id"]
+
+            for seq, (items, next_token, newest_id) in enumerate(iter_backfill_pages(api_key, video_id, state)):
+                if stop.is_set():
+                    return
+                if newest_id is not None:
+                    newest_ids[video_id] = newest_id
+                if not put((video_id, seq, items, next_token)):
+                    return
+    finally:
+        put(_DONE)
+
+
+def run_pipelined_backfill(api_key, video_ids, workers=PIPELINE_WORKERS, queue_pages=PIPELINE_QUEUE_PAGES,
+                           write_rows=PIPELINE_WRITE_ROWS):
+    """
+    Backfills every video with fetch, inference and storage overlapped:
+
+        fetcher threads -> bounded page queue -> inference worker processes
+                        -> bounded result queue -> single SQLite writer thread
+
+    Checkpoints in ingestion_state advance as pages land on disk, so an
+    interrupted run resumes like the serial backfill. Ctrl+C stops the
+    fetchers, lets in-flight pages finish and flushes the writer before
+    re-raising.
+
+    Returns {video_id: newest_comment_id}.
+    """
+    from analysis.sentiment import cpu_threads
+
+    stop = threading.Event()
+    pages = queue.Queue(maxsize=queue_pages)
+    results = queue.Queue(maxsize=queue_pages)
+    newest_ids = {}
+
+    remaining = list(reversed(video_ids))
+    fetchers = [
+        threading.Thread(target=_fetch_videos, args=(api_key, remaining, pages, newest_ids, stop), daemon=True)
+        for _ in range(max(1, min(len(video_ids), MAX_CONCURRENT_REQUESTS)))
+    ]
+    writer = _Writer(results, newest_ids, write_rows)
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def on_scored(video_id, seq, next_token, future):
+        in_flight.release()
+        if future.exception():
+            # Leaving the gap stalls this video's checkpoint, so the page is refetched on resume
+            print(f"Inference failed for {video_id} page {seq}: {future.exception()}")
+            return
+        results.put((video_id, seq, next_token, future.result()))
+
+    # spawn, not fork: the fetcher threads are already running
+    context = multiprocessing.get_context("spawn")
+    threads = max(1, cpu_threads() // workers)
+    interrupted = False
+
+    writer.start()
+    for f in fetchers:
+        f.start()
+
+    print(f"Pipelined backfill: {len(fetchers)} fetchers, {workers} inference workers")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(threads, database.DB_PATH)) as pool:
+        try:
+            active = len(fetchers)
+            while active:
+                page = pages.get()
+                set_gauge("queue_depth", "pages", pages.qsize())
+                if page is _DONE:
+                    active -= 1
+                    continue
+
+                video_id, seq, items, next_token = page
+                comments = [parse_comment(item, video_id) for item in items]
+                comments = [c for c in comments if c is not None]
+
+                if not comments:
+                    results.put((video_id, seq, next_token, []))
+                    continue
+
+                in_flight.acquire()
+                future = pool.submit(_score_in_worker, comments)
+                future.add_done_callback(
+                    lambda f, v=video_id, s=seq, t=next_token: on_scored(v, s, t, f)
+                )
+        except KeyboardInterrupt:
+            interrupted = True
+            print("\nDraining pipeline: finishing in-flight pages before exit...")
+            stop.set()
+        # Leaving the block waits for every submitted page to finish
+
+    results.put(_DONE)
+    writer.join()
+    print(f"Pipelined backfill saved {writer.saved} comments")
+
+    if interrupted:
+        raise KeyboardInterrupt
+    return newest_ids
@@ -0,0 +1,234 @@
+import atexit
+import glob
+import gzip
+import heapq
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+import database
+from config import API_RECORD, API_REPLAY, RECORDING_DIR, RECORDING_SEGMENT_PAGES, REPLAY_SPEED
+
+# Record/replay of raw commentThreads pages. Recording appends every page
+# the API returns to gzip-compressed NDJSON segments, one JSON object per
+# line: {"t": fetch time, "video_id", "page_token", "page": raw response}.
+# Replay serves those pages back to ingestion.fetch_comments (and its async
+# twin) in recorded order, so the whole pipeline runs with no network and
+# no quota. The live loop reads its clock through now()/sleep() below,
+# which follow the recorded timeline during replay.
+
+
+def default_dir():
+    return RECORDING_DIR or os.path.join(os.path.dirname(database.DB_PATH), "recordings")
+
+
+class PageRecorder:
+    def __init__(self, directory=None, segment_pages=RECORDING_SEGMENT_PAGES):
+        """Appends pages to rotating segments; thread-safe (fetcher threads and the event loop share it)."""
+        self.directory = directory or default_dir()
+        self.segment_pages = segment_pages
+        self._lock = threading.Lock()
+        self._file = None
+        self._pages = 0
+        self._segment = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _open(self):
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(self.directory, f"pages-{stamp}-{os.getpid()}-{self._segment:04d}.ndjson.gz")
+        self._segment += 1
+        self._pages = 0
+        # Text mode over gzip; a segment is only complete once closed
+        return gzip.open(path, "wt", encoding="utf-8")
+
+    def record(self, video_id, page_token, page):
+        line = json.dumps({"t": time.time(), "video_id": video_id, "page_token": page_token, "page": page})
+        with self._lock:
+            if self._file is None:
+                self._file = self._open()
+            self._file.write(line + "\n")
+            self._pages += 1
+            if self._pages >= self.segment_pages:
+                self._file.close()
+                self._file = None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _segment_pages(path):
+    """(record, path, offset) for every readable page of one segment; offset is where its line starts."""
+    offset = 0
+    try:
+        # Binary mode: offsets count uncompressed bytes, which GzipFile.seek() understands
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                yield json.loads(line), path, offset
+                offset += len(line)
+    except (EOFError, json.JSONDecodeError):
+        # A segment cut short by a crash: keep the pages before the damage
+        print(f"Recording segment {os.path.basename(path)} is truncated, using what was readable")
+
+
+def _recorded_pages(directory=None):
+    """
+    (record, path, offset) for every recorded page, oldest fetch first,
+    streamed without holding more than one page per writing process.
+    Each process writes its segments one after another in fetch order
+    (pages-<stamp>-<pid>-<n>), so its segments are chained and only the
+    processes' streams are merged.
+    """
+    writers = defaultdict(list)
+    for path in sorted(glob.glob(os.path.join(directory or default_dir(), "*.ndjson.gz"))):
+        parts = os.path.basename(path).split("-")
+        writers[parts[2] if len(parts) == 4 else path].append(path)
+
+    # Stable: pages fetched in the same instant keep file order
+    return heapq.merge(*(itertools.chain.from_iterable(map(_segment_pages, paths)) for paths in writers.values()),
+                       key=lambda page: page[0]["t"])
+
+
+def read_segments(directory=None):
+    """Every recorded page (as dicts), oldest fetch first, across all segments. A generator."""
+    for record, _, _ in _recorded_pages(directory):
+        yield record
+
+
+class ReplaySource:
+    def __init__(self, directory=None, speed=REPLAY_SPEED):
+        """
+        Serves recorded pages by (video_id, page_token), each key's pages in
+        the order they were fetched: repeated live polls of a video's first
+        page come back one recording per poll.
+
+        Only where each page sits (segment and uncompressed offset) is kept
+        in memory; a page is read back from its segment when served.
+
+        The simulated clock starts at the first recording and moves forward
+        with every page served and every sleep(); `speed` sets how much real
+        time a simulated second takes (0 = none at all).
+        """
+        self.speed = speed
+        self._pages = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._segment = (None, None)  # (path, open GzipFile) read from last
+        self.remaining = 0
+        self.clock = None
+        for record, path, offset in _recorded_pages(directory):
+            self._pages[(record["video_id"], record["page_token"])].append((record["t"], path, offset))
+            self.remaining += 1
+            if self.clock is None:
+                self.clock = record["t"]
+        if self.clock is None:
+            self.clock = time.time()
+
+    def _read(self, path, offset):
+        # Pages are mostly asked for in recorded order, so the segment is usually still open
+        if self._segment[0] != path:
+            if self._segment[1] is not None:
+                self._segment[1].close()
+            self._segment = (path, gzip.open(path, "rb"))
+        f = self._segment[1]
+        f.seek(offset)
+        return json.loads(f.readline())["page"]
+
+    def fetch(self, video_id, page_token=None):
+        """The next recorded page for this request, or None (like a failed request) once they run out."""
+        with self._lock:
+            pages = self._pages.get((video_id, page_token or None))
+            if not pages:
+                return None
+            t, path, offset = pages.popleft()
+            self.remaining -= 1
+            self.clock = max(self.clock, t)
+            return self._read(path, offset)
+
+    def has_polls(self, video_ids):
+        """True while any of these videos still has a recorded first page, i.e. a live poll to serve."""
+        with self._lock:
+            return any(self._pages.get((video_id, None)) for video_id in video_ids)
+
+    def advance(self, seconds):
+        with self._lock:
+            self.clock += seconds
+
+
+recorder = PageRecorder() if API_RECORD and not API_REPLAY else None
+source = ReplaySource() if API_REPLAY else None
+
+if recorder:
+    atexit.register(recorder.close)
+
+
+def now():
+    """Current time for the live loop: recorded time during replay, wall clock otherwise."""
+    if source:
+        return datetime.fromtimestamp(source.clock, timezone.utc)
+    return datetime.now(timezone.utc)
+
+
+def sleep(seconds, stop=None):
+    """
+    Waits between live rounds. During replay the simulated clock advances by
+    `seconds` while only seconds / REPLAY_SPEED really pass. Returns True
+    if `stop` was set while waiting.
+    """
+    if source:
+        source.advance(seconds)
+        seconds = seconds / source.speed if source.speed else 0
+    if stop is not None:
+        return stop.wait(seconds)
+    time.sleep(seconds)
+    return False
+
+
+def exhausted(video_ids=None):
+    """
+    True once a replay has served every recorded page or, given the
+    monitored `video_ids`, none of them has a live poll left. Pages that
+    are never asked for (other videos, backfill pages of a database that
+    is already backfilled) would otherwise keep the replay going forever.
+    """
+    if source is None:
+        return False
+    return source.remaining == 0 or (video_ids is not None and not source.has_polls(video_ids))
+
+
+def load_recording(directory=None, flush_pages=50):
+    """
+    Feeds every recorded page straight through parse_comment and
+    process_and_save_comments, as fast as scoring and SQLite allow.
+    Returns the number of comments processed; comments seen again by later
+    live polls count each time but are only stored once.
+    """
+    from main import process_and_save_comments
+
+    buffers = defaultdict(list)
+    saved = 0
+    pages = 0
+    for record in read_segments(directory):
+        buffers[record["video_id"]].extend(record["page"].get("items", []))
+        pages += 1
+        if pages % flush_pages == 0:
+            for video_id, items in buffers.items():
+                saved += len(process_and_save_comments(items, video_id))
+            buffers.clear()
+
+    for video_id, items in buffers.items():
+        saved += len(process_and_save_comments(items, video_id))
+    return saved
+
+
+if __name__ == "__main__":
+    # python recording.py [DIRECTORY]: load a recording into the configured database
+    database.init_db()
+    start = time.perf_counter()
+    processed = load_recording(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"Processed {processed} recorded comments in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,103 @@
+import heapq
+import math
+import random
+from config import (POLL_INTERVAL, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_TARGET_COMMENTS, POLL_RATE_SMOOTHING,
+                    POLL_JITTER)
+from database import to_epoch
+from ingestion import quota_budget, PAGE_SIZE
+
+# Per-video poll timing for the live loop. Next-poll times sit in a heap;
+# after each poll a video's interval is re-derived from its smoothed
+# comment rate (aiming for POLL_TARGET_COMMENTS new comments per poll) and
+# stretched when the whole fleet would outspend what is left of the day's
+# quota. Windows close on their own clock in main.py, not when polled.
+
+
+class PollScheduler:
+    def __init__(self, video_ids, api_key, now, rates=None, quota=quota_budget, seed=None):
+        """
+        Every video is due at `now`. `rates` ({video_id: comments per
+        second}, e.g. from the replayed windows) seeds the estimates; the
+        first poll itself is not used, since it covers an unknown span.
+        """
+        self.api_key = api_key
+        self.quota = quota
+        self.rates = dict(rates or {})
+        self.last_poll = {}
+        self.intervals = {v: self._interval(v) for v in video_ids}
+        self._random = random.Random(seed)
+        self._heap = [(now, v) for v in video_ids]
+        heapq.heapify(self._heap)
+
+    def due(self, now):
+        """Pops every video whose poll time has come, most overdue first."""
+        videos = []
+        while self._heap and self._heap[0][0] <= now:
+            videos.append(heapq.heappop(self._heap)[1])
+        return videos
+
+    def next_poll(self):
+        """Time of the earliest scheduled poll (None once nothing is scheduled)."""
+        return self._heap[0][0] if self._heap else None
+
+    def record(self, video_id, new_comments, now):
+        """
+        Folds one poll's new comments into the rate estimate and schedules
+        the next poll. Returns its delay. new_comments=None (the fetch
+        failed or the quota was spent) leaves the estimate alone: the next
+        poll that gets through covers the whole span since the last one.
+        """
+        if new_comments is not None:
+            previous_poll = self.last_poll.get(video_id)
+            self.last_poll[video_id] = now
+            if previous_poll is not None and now > previous_poll:
+                sample = new_comments / (now - previous_poll)
+                previous = self.rates.get(video_id)
+                self.rates[video_id] = sample if previous is None else (
+                    POLL_RATE_SMOOTHING * sample + (1 - POLL_RATE_SMOOTHING) * previous
+                )
+
+        # Jittered, then bounded by POLL_MIN/MAX_INTERVAL. Only the quota stretch
+        # may go past the maximum, up to the quota reset.
+        self.intervals[video_id] = self._interval(video_id)
+        pressure = self._quota_pressure()
+        delay = self.intervals[video_id] * pressure * self._random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        upper = self.quota.seconds_until_reset() if pressure > 1 else POLL_MAX_INTERVAL
+        delay = max(POLL_MIN_INTERVAL, min(upper, delay))
+
+        heapq.heappush(self._heap, (now + delay, video_id))
+        return delay
+
+    def _interval(self, video_id):
+        rate = self.rates.get(video_id)
+        if rate is None:
+            return min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, POLL_INTERVAL))
+        if rate <= 0:
+            return POLL_MAX_INTERVAL
+        return min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, POLL_TARGET_COMMENTS / rate))
+
+    def _quota_pressure(self):
+        """
+        How many times faster than the remaining quota allows the current
+        intervals would spend it (never below 1). Every poll costs one page
+        plus one per PAGE_SIZE comments it is expected to bring back.
+        """
+        demand = 0.0
+        for video_id, interval in self.intervals.items():
+            pages = max(1, math.ceil(self.rates.get(video_id, 0.0) * interval / PAGE_SIZE))
+            demand += pages / interval
+
+        # A shard only plans with its share of a budget the whole fleet draws from
+        supply = self.quota.remaining(self.api_key) * self.quota.share / self.quota.seconds_until_reset()
+        if supply <= 0:
+            return math.inf
+        return max(1.0, demand / supply)
+
+
+def rate_from_windows(windows, now, recent=6):
+    """Comments per second from the start of the last `recent` stored windows until `now` (None without any)."""
+    if not windows:
+        return None
+    tail = windows[-recent:]
+    span = now - to_epoch(tail[0]["window"])
+    return sum(w["total_comments"] for w in tail) / span if span > 0 else None
@@ -0,0 +1,196 @@
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import time
+import database
+from config import (SHARD_WORKERS, SHARD_VNODES, SHARD_MAX_RESTARTS, SHARD_STALL_SECONDS,
+                    SHARD_SHUTDOWN_SECONDS, METRICS_PORT)
+
+# Tables exposed by the merged read view, one UNION ALL over every shard each
+MERGED_TABLES = ("comments", "window_metrics", "window_aggregates", "ingestion_state")
+
+
+def _ring_hash(key):
+    """Stable 64-bit position on the ring (Python's hash() is salted per process)."""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of video IDs onto shards. Each shard owns `vnodes`
+    points on the ring and a video belongs to the first point at or after
+    its own hash, so growing the fleet from n to n + 1 shards only moves
+    about 1 / (n + 1) of the videos (and their baselines and history).
+    """
+
+    def __init__(self, shards, vnodes=SHARD_VNODES):
+        self.shards = shards
+        points = sorted((_ring_hash(f"shard-{s}#{v}"), s) for s in range(shards) for v in range(vnodes))
+        self._keys = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, video_id):
+        i = bisect.bisect_left(self._keys, _ring_hash(video_id)) % len(self._keys)
+        return self._owners[i]
+
+    def partition(self, video_ids):
+        """{shard: [video_id, ...]} for every shard, in input order."""
+        parts = {s: [] for s in range(self.shards)}
+        for video_id in video_ids:
+            parts[self.shard_for(video_id)].append(video_id)
+        return parts
+
+
+def shard_db_path(shard, base=None):
+    """data/comments.db -> data/comments-shard3.db"""
+    root, ext = os.path.splitext(base or database.DB_PATH)
+    return f"{root}-shard{shard}{ext}"
+
+
+def _run_shard(shard, video_ids, db_path, threads, stop, heartbeats, quota, quota_share):
+    """Worker process: monitors its own videos against its own database."""
+    # Ctrl+C reaches the whole process group; only the coordinator reacts
+    # to it and then asks the workers to stop through `stop`
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    database.DB_PATH = db_path
+    import ingestion
+    # Every shard draws from the coordinator's one daily budget
+    ingestion.quota_budget.attach(quota, quota_share)
+    import analysis.sentiment
+    analysis.sentiment.INFERENCE_THREADS = threads  # Split the cores between shards
+    from main import monitor
+
+    def heartbeat():
+        heartbeats.put((shard, time.time()))
+
+    heartbeat()
+    # Each worker serves its own /metrics, on the ports after METRICS_PORT
+    metrics_port = METRICS_PORT + 1 + shard if METRICS_PORT else 0
+    monitor(video_ids, stop=stop, heartbeat=heartbeat, metrics_port=metrics_port)
+
+
+def run_sharded(video_ids, shards=SHARD_WORKERS):
+    """
+    Coordinator: partitions the fleet, starts one process per non-empty
+    shard, restarts crashed workers (up to SHARD_MAX_RESTARTS each), warns
+    about workers that stop sending heartbeats, and shuts everything down
+    on Ctrl+C.
+    """
+    from analysis.sentiment import cpu_threads
+    from ingestion import QuotaBudget
+
+    parts = {s: videos for s, videos in HashRing(shards).partition(video_ids).items() if videos}
+    if not parts:
+        print("No videos to monitor.")
+        return
+
+    # spawn: workers must not inherit the coordinator's SQLite connections
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    heartbeats = context.Queue()
+    threads = max(1, cpu_threads() // len(parts))
+    quota = QuotaBudget.shared_state(context)
+
+    processes, last_beat, stalled = {}, {}, set()
+    restarts = {s: 0 for s in parts}
+
+    def start(shard):
+        process = context.Process(
+            target=_run_shard, name=f"shard-{shard}",
+            args=(shard, parts[shard], shard_db_path(shard), threads, stop, heartbeats, quota,
+                  len(parts[shard]) / len(video_ids)),
+        )
+        process.start()
+        processes[shard] = process
+        last_beat[shard] = time.time()
+
+    # 1. Start one worker per shard
+    for shard, videos in parts.items():
+        print(f"Shard {shard}: {len(videos)} video(s) -> {shard_db_path(shard)}")
+        start(shard)
+
+    try:
+        # 2. Supervise until every worker has exited for good
+        while any(p.is_alive() for p in processes.values()):
+            try:
+                shard, beat = heartbeats.get(timeout=1.0)
+                last_beat[shard] = beat
+                stalled.discard(shard)
+            except queue.Empty:
+                pass
+
+            now = time.time()
+            for shard, process in list(processes.items()):
+                if not process.is_alive():
+                    if process.exitcode == 0 or process.exitcode is None:
+                        continue
+                    if restarts[shard] >= SHARD_MAX_RESTARTS:
+                        if restarts[shard] == SHARD_MAX_RESTARTS:
+                            print(f"!!! Shard {shard} exited with {process.exitcode}; restart limit reached !!!")
+                            restarts[shard] += 1
+                        continue
+                    restarts[shard] += 1
+                    print(f"!!! Shard {shard} exited with {process.exitcode}; "
+                          f"restarting ({restarts[shard]}/{SHARD_MAX_RESTARTS}) !!!")
+                    start(shard)
+                elif now - last_beat[shard] > SHARD_STALL_SECONDS and shard not in stalled:
+                    # Backfills legitimately run long without a round, so only warn
+                    stalled.add(shard)
+                    print(f"Shard {shard}: no heartbeat for {now - last_beat[shard]:.0f}s")
+    except KeyboardInterrupt:
+        print("\nStopping shards...")
+    finally:
+        # 3. Graceful shutdown: workers finish their round, then get terminated
+        stop.set()
+        for process in processes.values():
+            process.join(timeout=SHARD_SHUTDOWN_SECONDS)
+        for shard, process in processes.items():
+            if process.is_alive():
+                print(f"Shard {shard} did not stop in {SHARD_SHUTDOWN_SECONDS}s, terminating.")
+                process.terminate()
+                process.join()
+
+
+def open_merged_view(shards=SHARD_WORKERS, tables=MERGED_TABLES):
+    """
+    Read-only connection over every shard database: each of `tables` is a
+    TEMP VIEW that UNION ALLs the shards' copies, so existing queries run
+    unchanged against the whole fleet. SQLite attaches at most 10
+    databases unless compiled with a higher SQLITE_MAX_ATTACHED.
+    """
+    conn = sqlite3.connect(":memory:", uri=True)
+    attached = []
+    for shard in range(shards):
+        path = shard_db_path(shard)
+        if os.path.exists(path):
+            conn.execute(f"ATTACH DATABASE ? AS shard{shard}", (f"file:{path}?mode=ro",))
+            attached.append(f"shard{shard}")
+
+    if not attached:
+        raise FileNotFoundError(f"No shard databases next to {database.DB_PATH}")
+
+    for table in tables:
+        union = " UNION ALL ".join(f"SELECT * FROM {schema}.{table}" for schema in attached)
+        conn.execute(f"CREATE TEMP VIEW {table} AS {union}")
+    return conn
+
+
+def get_merged_window_metrics(video_id=None, shards=SHARD_WORKERS):
+    """Saved window_metrics rows across all shards, oldest first."""
+    conn = open_merged_view(shards, tables=("window_metrics",))
+    conn.row_factory = sqlite3.Row
+    try:
+        if video_id:
+            rows = conn.execute(
+                "SELECT * FROM window_metrics WHERE video_id = ? ORDER BY window_ts", (video_id,)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM window_metrics ORDER BY window_ts, video_id").fetchall()
+        return [dict(r) for r in rows]
+    finally:
+        conn.close()